@@ -0,0 +1,3 @@
+"""
+Benchmarks for the vocabulary loader, using a local stand-in for the triple store.
+"""
@@ -0,0 +1,155 @@
+"""
+This file contains a generator for synthetic SKOS vocabularies, with the yaml and config files
+to load them.
+"""
+import argparse
+import os
+from typing import IO, Iterator
+
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+DCT_TITLE = "http://purl.org/dc/terms/title"
+
+# Every concept has this many narrower concepts, resulting in a balanced hierarchy
+BRANCHING = 10
+
+SKOSMOS_CONFIG = """:{name} a skosmos:Vocabulary, void:Dataset ;
+    dc:title "{name}"@en ;
+    skosmos:shortName "{name}" ;
+    skosmos:language "en", "nl" ;
+    skosmos:defaultLanguage "en" ;
+    skosmos:showTopConcepts "true" ;
+    void:uriSpace "{base}" ;
+    void:sparqlEndpoint <${{SPARQL_ENDPOINT}}> ;
+    skosmos:sparqlGraph <{graph}>
+.
+"""
+
+VOCABULARY_YAML = """config:
+  refresh: Yes
+  refreshInterval: 0
+  type: file
+  location: {name}.config
+
+source:
+  type: {source_type}
+  location: {location}
+  format: {format}
+"""
+
+
+def concept_statements(base: str, index: int) -> Iterator[tuple[str, str, str]]:
+    """
+    Get the triples describing a single concept.
+    :param base:    The namespace of the vocabulary.
+    :param index:   The number of the concept.
+    :return: Tuples of subject, predicate and object, in N-Triples syntax.
+    """
+    concept = f"<{base}c{index}>"
+    scheme = f"<{base}scheme>"
+    yield concept, f"<{RDF_TYPE}>", f"<{SKOS}Concept>"
+    yield concept, f"<{SKOS}inScheme>", scheme
+    yield concept, f"<{SKOS}prefLabel>", f'"Concept {index}"@en'
+    yield concept, f"<{SKOS}prefLabel>", f'"Begrip {index}"@nl'
+    yield concept, f"<{SKOS}altLabel>", f'"Term {index}"@en'
+    yield concept, f"<{SKOS}notation>", f'"{index:08d}"'
+    if index < BRANCHING:
+        yield concept, f"<{SKOS}topConceptOf>", scheme
+    else:
+        yield concept, f"<{SKOS}broader>", f"<{base}c{index // BRANCHING - 1}>"
+
+
+def vocabulary_statements(base: str, triples: int) -> Iterator[tuple[str, str, str]]:
+    """
+    Get the triples of a vocabulary with (at least) the given size.
+    :param base:    The namespace of the vocabulary.
+    :param triples: The number of triples.
+    :return:
+    """
+    scheme = f"<{base}scheme>"
+    yield scheme, f"<{RDF_TYPE}>", f"<{SKOS}ConceptScheme>"
+    yield scheme, f"<{DCT_TITLE}>", '"Benchmark vocabulary"@en'
+    count = 2
+    index = 0
+    while count < triples:
+        for statement in concept_statements(base, index):
+            count += 1
+            yield statement
+        index += 1
+
+
+def write_vocabulary(fp: IO, base: str, triples: int, vocab_format: str = "nt") -> int:
+    """
+    Write a synthetic SKOS vocabulary.
+    :param fp:              The (text) file to write to.
+    :param base:            The namespace of the vocabulary.
+    :param triples:         The (minimum) number of triples.
+    :param vocab_format:    nt or ttl.
+    :return: The number of triples written.
+    """
+    count = 0
+    subject = None
+    for statement in vocabulary_statements(base, triples):
+        count += 1
+        if vocab_format == "nt":
+            fp.write(" ".join(statement) + " .\n")
+        elif statement[0] == subject:
+            fp.write(f" ;\n    {statement[1]} {statement[2]}")
+        else:
+            fp.write(" .\n" if subject is not None else "")
+            fp.write(" ".join(statement))
+            subject = statement[0]
+    if vocab_format != "nt" and subject is not None:
+        fp.write(" .\n")
+    return count
+
+
+def write_vocabulary_files(data_dir: str, name: str, triples: int, vocab_format: str = "nt",
+                           files_url: str = "") -> int:
+    """
+    Write a synthetic vocabulary with its yaml and Skosmos config to a data dir.
+    :param data_dir:        The directory to write to.
+    :param name:            The name of the vocabulary, also used for the files.
+    :param triples:         The (minimum) number of triples.
+    :param vocab_format:    nt or ttl.
+    :param files_url:       When given, the source is fetched from this url instead of read
+                            from the data dir.
+    :return: The number of triples written.
+    """
+    base = f"https://example.com/benchmark/{name}/"
+    with open(os.path.join(data_dir, f"{name}.{vocab_format}"), 'w', encoding='utf-8') as fp:
+        count = write_vocabulary(fp, base, triples, vocab_format)
+    with open(os.path.join(data_dir, f"{name}.config"), 'w', encoding='utf-8') as fp:
+        fp.write(SKOSMOS_CONFIG.format(name=name, base=base, graph=base.rstrip('/')))
+    location = f"{name}.{vocab_format}"
+    with open(os.path.join(data_dir, f"{name}.yaml"), 'w', encoding='utf-8') as fp:
+        fp.write(VOCABULARY_YAML.format(
+            name=name,
+            source_type="fetch" if files_url else "file",
+            location=f"{files_url}/{location}" if files_url else location,
+            format=vocab_format,
+        ))
+    return count
+
+
+def main() -> None:
+    """
+    Write synthetic vocabularies from the command line.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("data_dir", help="Directory to write the files to")
+    parser.add_argument("--triples", type=int, default=1000, help="Triples per vocabulary")
+    parser.add_argument("--vocabularies", type=int, default=1, help="Number of vocabularies")
+    parser.add_argument("--format", choices=["nt", "ttl"], default="nt")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    for number in range(args.vocabularies):
+        count = write_vocabulary_files(args.data_dir, f"benchmark{number}", args.triples,
+                                       args.format)
+        print(f"Wrote benchmark{number} ({count} triples)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Benchmark the loader (entrypoint.py) against the stand-in triple store, using synthetic
+vocabularies. Every phase runs the loader in a separate process and reports its wall time,
+throughput, peak memory and the requests it made.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.generate import write_vocabulary_files
+from benchmarks.store import StandInStore, StoreState
+
+REPOSITORY_DIR = Path(__file__).resolve().parent.parent
+
+# Phases which start with an empty store, the others keep the data of the previous phase
+COLD_PHASES = ["cold"]
+
+
+def parse_env(values: list[str]) -> dict[str, str]:
+    """
+    Parse KEY=VALUE arguments.
+    :param values:
+    :return:
+    """
+    env = {}
+    for value in values:
+        key, _, setting = value.partition("=")
+        env[key] = setting
+    return env
+
+
+def run_loader(env: dict[str, str], log_path: str) -> tuple[int, float, int]:
+    """
+    Run the loader in a separate process.
+    :param env:         The environment of the loader.
+    :param log_path:    The file the output of the loader is written to.
+    :return: The exit code, the wall time in seconds and the peak RSS in KiB (on Linux).
+    """
+    with open(log_path, 'w', encoding='utf-8') as log:
+        start = time.monotonic()
+        with subprocess.Popen([sys.executable, str(REPOSITORY_DIR / "entrypoint.py")],
+                              env=env, cwd=REPOSITORY_DIR, stdout=log,
+                              stderr=subprocess.STDOUT) as process:
+            _, status, usage = os.wait4(process.pid, 0)
+            # Popen.wait() must not wait for the process again
+            process.returncode = os.waitstatus_to_exitcode(status)
+        return process.returncode, time.monotonic() - start, usage.ru_maxrss
+
+
+def loader_env(args: argparse.Namespace, store: StandInStore, work_dir: str) -> dict[str, str]:
+    """
+    Get the environment for running the loader against the stand-in store.
+    :param args:        The command line arguments.
+    :param store:
+    :param work_dir:    The directory containing the data and config dirs.
+    :return:
+    """
+    env = dict(os.environ)
+    env.update({
+        'DATA': os.path.join(work_dir, "data"),
+        'CONFIG_DIR': os.path.join(work_dir, "config"),
+        'DATABASE_TYPE': args.database,
+        'SPARQL_ENDPOINT': store.sparql_endpoint(args.database),
+        'STORE_READY_TIMEOUT': "30",
+    })
+    env.update(parse_env(args.env))
+    return env
+
+
+def run_phase(store: StandInStore, env: dict[str, str], phase: str, log_path: str) -> dict:
+    """
+    Run the loader once and collect its statistics.
+    :param store:
+    :param env:         The environment of the loader.
+    :param phase:       The name of the phase, 'cold' starts with an empty store.
+    :param log_path:    The file the output of the loader is written to.
+    :return:
+    """
+    if phase in COLD_PHASES:
+        store.state = StoreState(files_dir=store.state.files_dir)
+    store.state.reset_statistics()
+    exit_code, elapsed, peak_rss = run_loader(env, log_path)
+    if exit_code != 0:
+        print(f"Loader failed in phase {phase}:")
+        with open(log_path, encoding='utf-8') as log:
+            print("".join(log.readlines()[-20:]))
+    return {
+        'phase': phase,
+        'exit_code': exit_code,
+        'seconds': elapsed,
+        'peak_rss_kib': peak_rss,
+        **store.state.reset_statistics(),
+    }
+
+
+def benchmark_size(args: argparse.Namespace, triples: int, work_dir: str) -> list[dict]:
+    """
+    Run all phases for one vocabulary size.
+    :param args:        The command line arguments.
+    :param triples:     The number of triples per vocabulary.
+    :param work_dir:    An empty directory for the data and config.
+    :return: A result for every phase.
+    """
+    data_dir = os.path.join(work_dir, "data")
+    os.makedirs(data_dir)
+    os.makedirs(os.path.join(work_dir, "config"))
+    shutil.copy(REPOSITORY_DIR / "config-docker-compose.ttl", os.path.join(data_dir, "config.ttl"))
+
+    store = StandInStore(StoreState(files_dir=data_dir))
+    store.start()
+    try:
+        files_url = f"{store.base_url}/files" if args.source == "fetch" else ""
+        start = time.monotonic()
+        total = sum(write_vocabulary_files(data_dir, f"benchmark{number}", triples,
+                                           args.format, files_url)
+                    for number in range(args.vocabularies))
+        results = [{'phase': "generate", 'seconds': time.monotonic() - start}]
+
+        env = loader_env(args, store, work_dir)
+        for number, phase in enumerate(args.phases):
+            log_path = os.path.join(work_dir, f"loader-{number}-{phase}.log")
+            results.append(run_phase(store, env, phase, log_path))
+    finally:
+        store.stop()
+
+    for result in results:
+        result['triples'] = total
+        seconds = result['seconds']
+        result['triples_per_second'] = total / seconds if seconds else 0.0
+    return results
+
+
+def print_results(results: list[dict]) -> None:
+    """
+    Print the results as a table.
+    :param results:
+    :return:
+    """
+    print(f"{'triples':>10} {'phase':<10} {'seconds':>9} {'triples/s':>11} {'peak MiB':>9} "
+          f"{'sent MiB':>9}  requests")
+    for result in results:
+        requests = " ".join(f"{kind}={count}"
+                            for kind, count in sorted(result.get('requests', {}).items()))
+        peak = f"{result['peak_rss_kib'] / 1024:.1f}" if 'peak_rss_kib' in result else "-"
+        sent = f"{result['uploaded_bytes'] / 1024 / 1024:.1f}" if 'uploaded_bytes' in result \
+            else "-"
+        print(f"{result['triples']:>10} {result['phase']:<10} {result['seconds']:>9.2f} "
+              f"{result['triples_per_second']:>11.0f} {peak:>9} {sent:>9}  {requests}")
+
+
+def main() -> None:
+    """
+    Run the benchmarks from the command line.
+    :return:
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--triples", type=int, nargs="+", default=[1000, 100000],
+                        help="Vocabulary sizes to benchmark (1000 up to 10000000)")
+    parser.add_argument("--vocabularies", type=int, default=1,
+                        help="Number of vocabularies of each size")
+    parser.add_argument("--format", choices=["nt", "ttl"], default="nt")
+    parser.add_argument("--database", choices=["graphdb", "fuseki"], default="graphdb")
+    parser.add_argument("--source", choices=["file", "fetch"], default="file",
+                        help="Read the vocabularies from the data dir or fetch them over HTTP")
+    parser.add_argument("--phases", nargs="+", default=["cold", "refresh"],
+                        help="Loader runs, 'cold' starts with an empty store")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment variables for the loader")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for triples in args.triples:
+        with tempfile.TemporaryDirectory(prefix="skosmos-benchmark-") as work_dir:
+            size_results = benchmark_size(args, triples, work_dir)
+        for result in size_results:
+            result['size'] = triples
+        results.extend(size_results)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
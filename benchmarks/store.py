@@ -0,0 +1,471 @@
+"""
+This file contains a local HTTP stand-in for the triple store, implementing the SPARQL query,
+SPARQL update and graph store endpoints the GraphDB and Fuseki connectors use. Uploaded data is
+counted and discarded, only the metadata (timestamps and digests) is kept.
+"""
+import json
+import os
+import re
+import threading
+import uuid
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+from src.database import DIGEST_PREDICATE, TIMESTAMP_PREDICATE
+
+GRAPHDB_REPOSITORY = "/repositories/skosmos"
+FUSEKI_DATASET = "/skosmos"
+
+METADATA_ROW = re.compile(r'\(<([^>]*)> ("[^"]*"|\d+)\)')
+MOVE = re.compile(r'MOVE <([^>]*)> TO <([^>]*)>')
+CLEAR = re.compile(r'CLEAR (?:SILENT )?GRAPH <([^>]*)>')
+DROP = re.compile(r'DROP (?:SILENT )?GRAPH <([^>]*)>')
+# The terms of an N-Quads line: IRIs, blank nodes and literals
+QUAD_TERM = re.compile(r'<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?')
+
+
+def multipart_lines(body: bytes, content_type: str) -> int:
+    """
+    Count the lines of the files in a multipart/form-data body.
+    :param body:
+    :param content_type:    The Content-Type header, with the boundary.
+    :return:
+    """
+    boundary = b'--' + content_type.split('boundary=', 1)[1].encode('utf-8')
+    # Every part ends with a line break before the next boundary
+    return sum(part.split(b'\r\n\r\n', 1)[1].count(b'\n') - 1
+               for part in body.split(boundary)[1:-1])
+
+
+class StoreState:
+    """
+    The data kept by the stand-in store, and the request statistics.
+    """
+
+    def __init__(self, files_dir: Optional[str] = None):
+        """
+        Create a new StoreState.
+        :param files_dir:   Directory served on /files/, for vocabularies of type 'fetch'.
+        """
+        self.files_dir = files_dir
+        self.repository_exists = False
+        self.graphs: dict[str, int] = {}
+        # The timestamps and digests of the graphs, by predicate
+        self.metadata: dict[str, dict[str, str]] = {TIMESTAMP_PREDICATE: {}, DIGEST_PREDICATE: {}}
+        self.requests: Counter = Counter()
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+
+
+    def count(self, kind: str, uploaded: int = 0) -> None:
+        """
+        Count a request.
+        :param kind:        The type of request, e.g. 'query' or 'upload'.
+        :param uploaded:    The number of bytes in the request body.
+        :return:
+        """
+        with self.lock:
+            self.requests[kind] += 1
+            self.uploaded_bytes += uploaded
+
+
+    def reset_statistics(self) -> dict:
+        """
+        Get the request statistics since the last reset, and reset them.
+        :return:
+        """
+        with self.lock:
+            statistics = {
+                'requests': dict(self.requests),
+                'uploaded_bytes': self.uploaded_bytes,
+            }
+            self.requests.clear()
+            self.uploaded_bytes = 0
+        return statistics
+
+
+    def apply_update(self, update: str) -> None:
+        """
+        Apply the parts of a SPARQL update the loader depends on: metadata, MOVE and DROP.
+        :param update:
+        :return:
+        """
+        with self.lock:
+            for operation in update.split(" ;\n"):
+                move = MOVE.search(operation)
+                if move is not None:
+                    self.graphs[move.group(2)] = self.graphs.pop(move.group(1), 0)
+                    continue
+                drop = DROP.search(operation)
+                if drop is not None:
+                    self.graphs.pop(drop.group(1), None)
+                    continue
+                for predicate, values in self.metadata.items():
+                    if f"<{predicate}>" in operation and "VALUES" in operation:
+                        for graph, value in METADATA_ROW.findall(operation):
+                            values[graph] = value.strip('"')
+
+
+    def commit(self, changes: dict[str, list]) -> None:
+        """
+        Apply the changes of a transaction to the graphs.
+        :param changes: For each graph, whether it is cleared and the number of lines added.
+        :return:
+        """
+        with self.lock:
+            for graph, (cleared, lines) in changes.items():
+                self.graphs[graph] = (0 if cleared else self.graphs.get(graph, 0)) + lines
+
+
+    def add_quads(self, lines: list[bytes]) -> None:
+        """
+        Count N-Quads per graph, keeping the metadata triples of the default graph.
+        :param lines:
+        :return:
+        """
+        with self.lock:
+            for line in lines:
+                terms = QUAD_TERM.findall(line.decode('utf-8'))
+                if len(terms) == 4:
+                    graph = terms[3].strip('<>')
+                    self.graphs[graph] = self.graphs.get(graph, 0) + 1
+                elif len(terms) == 3 and terms[1].strip('<>') in self.metadata:
+                    value = terms[2].split('^^')[0].strip('"')
+                    self.metadata[terms[1].strip('<>')][terms[0].strip('<>')] = value
+
+
+    def query_results(self, query: str) -> dict:
+        """
+        Answer the metadata queries of the loader, other queries get no results.
+        :param query:
+        :return: SPARQL JSON results.
+        """
+        with self.lock:
+            if f"<{TIMESTAMP_PREDICATE}>" in query:
+                variable, values = "timestamp", dict(self.metadata[TIMESTAMP_PREDICATE])
+            elif f"<{DIGEST_PREDICATE}>" in query:
+                variable, values = "digest", dict(self.metadata[DIGEST_PREDICATE])
+            else:
+                variable, values = "value", {}
+        return {
+            'head': {'vars': ["graph", variable]},
+            'results': {'bindings': [
+                {'graph': {'type': 'uri', 'value': graph},
+                 variable: {'type': 'literal', 'value': value}}
+                for graph, value in values.items()
+            ]},
+        }
+
+
+class StoreRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the loader to the stand-in store.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server: "StandInStore"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Don't log every request.
+        """
+
+
+    def read_body(self) -> Iterator[bytes]:
+        """
+        Read the request body in blocks, supporting chunked transfers.
+        :return:
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while self.rfile.readline() not in [b'\r\n', b'\n', b'']:
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            block = self.rfile.read(min(remaining, 1024 * 1024))
+            if not block:
+                return
+            remaining -= len(block)
+            yield block
+
+
+    def respond(self, status: int, body: bytes = b'', content_type: str = 'text/plain') -> None:
+        """
+        Send a response.
+        :param status:
+        :param body:
+        :param content_type:
+        :return:
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serve the size endpoint (readiness probe), graphs and files for 'fetch' vocabularies.
+        """
+        state = self.server.state
+        path = urlparse(self.path).path
+        if path.endswith("/size"):
+            state.count('probe')
+            if not state.repository_exists:
+                self.respond(404)
+            else:
+                self.respond(200, str(sum(state.graphs.values())).encode())
+            return
+        params = parse_qs(urlparse(self.path).query)
+        graph = (params.get('context') or params.get('graph') or [None])[0]
+        if graph is not None:
+            # The data itself isn't kept, so a graph is returned as placeholder triples
+            state.count('download')
+            lines = state.graphs.get(graph.strip('<>'), 0)
+            self.respond(200, b''.join(f"<urn:x-stand-in:{line}> <urn:x-stand-in:p> "
+                                       f"<urn:x-stand-in:o> .\n".encode() for line in range(lines)),
+                         'application/n-triples')
+            return
+        if path.startswith("/files/") and state.files_dir is not None:
+            state.count('fetch')
+            file_path = os.path.join(state.files_dir, os.path.basename(path))
+            if not os.path.isfile(file_path):
+                self.respond(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.path.getsize(file_path)))
+            self.end_headers()
+            with open(file_path, 'rb') as fp:
+                while block := fp.read(1024 * 1024):
+                    self.wfile.write(block)
+            return
+        self.respond(404)
+
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """
+        Create the GraphDB repository, replace a graph, or act in a transaction.
+        """
+        path = urlparse(self.path).path
+        if path.startswith(f"{GRAPHDB_REPOSITORY}/transactions/"):
+            self.transaction_action(path.rsplit('/', 1)[1])
+            return
+        if path == GRAPHDB_REPOSITORY:
+            for _ in self.read_body():
+                pass
+            self.server.state.count('setup')
+            self.server.state.repository_exists = True
+            self.respond(201)
+            return
+        self.upload(append=False)
+
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Create the Fuseki dataset, run SPARQL queries and updates, or append to a graph.
+        """
+        state = self.server.state
+        path = urlparse(self.path).path
+        if path == "/$/datasets":
+            state.count('setup')
+            state.repository_exists = True
+            self.respond(200)
+            return
+        if path == f"{GRAPHDB_REPOSITORY}/transactions":
+            state.count('transaction')
+            self.send_response(201)
+            transaction = str(uuid.uuid4())
+            self.server.transactions[transaction] = {}
+            self.send_header('Location', f"http://{self.headers['Host']}{path}/{transaction}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            body = b''.join(self.read_body())
+            form = parse_qs(body.decode('utf-8'))
+            if 'query' in form:
+                state.count('query', len(body))
+                results = state.query_results(form['query'][0])
+                self.respond(200, json.dumps(results).encode(), 'application/sparql-results+json')
+            else:
+                state.count('update', len(body))
+                update = form.get('update', [''])[0]
+                if any(f"TO <{graph}>" in update for graph in self.server.rejected_graphs):
+                    self.respond(400, b'Rejected by the stand-in store')
+                    return
+                state.apply_update(update)
+                self.respond(204)
+            return
+        self.upload(append=True)
+
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """
+        Roll back a transaction.
+        """
+        self.server.transactions.pop(urlparse(self.path).path.rsplit('/', 1)[1], None)
+        self.respond(204)
+
+
+    def count_lines(self) -> tuple[int, int]:
+        """
+        Read the request body, counting its lines.
+        :return: The size of the body and the number of lines.
+        """
+        size = 0
+        lines = 0
+        decompressor = None
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for block in self.read_body():
+            size += len(block)
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            lines += block.count(b'\n')
+        return size, lines
+
+
+    def transaction_action(self, transaction: str) -> None:
+        """
+        Clear or add to graphs in a transaction, or commit it.
+        :param transaction:
+        :return:
+        """
+        state = self.server.state
+        params = parse_qs(urlparse(self.path).query)
+        action = params.get('action', [''])[0]
+        changes = self.server.transactions.get(transaction)
+        if changes is None:
+            self.respond(404)
+        elif action == "COMMIT":
+            state.count('commit')
+            state.commit(self.server.transactions.pop(transaction))
+            self.respond(200)
+        elif action == "UPDATE":
+            update = b''.join(self.read_body()).decode('utf-8')
+            for graph in CLEAR.findall(update):
+                changes[graph] = [True, 0]
+            self.respond(204)
+        elif action == "ADD":
+            size, lines = self.count_lines()
+            state.count('upload', size)
+            graph = (params.get('context') or ['default'])[0].strip('<>')
+            changes.setdefault(graph, [False, 0])[1] += lines
+            self.respond(204)
+        else:
+            self.respond(400)
+
+
+    def upload(self, append: bool) -> None:
+        """
+        Receive data for a graph on the graph store endpoint.
+        :param append:
+        :return:
+        """
+        params = parse_qs(urlparse(self.path).query)
+        graph = (params.get('context') or params.get('graph') or ['default'])[0].strip('<>')
+        # Quads without a graph parameter are added to their own graphs
+        content_type = self.headers.get('Content-Type', '')
+        quads = graph == 'default' and content_type.startswith('application/n-quads')
+        # Fuseki adds all files of a multipart upload to the graph in one transaction
+        files = [] if content_type.startswith('multipart/form-data') else None
+        size = 0
+        lines = 0
+        pending = b''
+        decompressor = None
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        state = self.server.state
+        for block in self.read_body():
+            size += len(block)
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            lines += block.count(b'\n')
+            if quads:
+                *complete, pending = (pending + block).split(b'\n')
+                state.add_quads(complete)
+            if files is not None:
+                files.append(block)
+        state.count('upload', size)
+        if files is not None:
+            lines = multipart_lines(b''.join(files), content_type)
+        if graph in self.server.rejected_graphs:
+            self.respond(400, b'Rejected by the stand-in store')
+            return
+        if quads:
+            state.add_quads([pending])
+            self.respond(204)
+            return
+        with state.lock:
+            state.graphs[graph] = (state.graphs.get(graph, 0) if append else 0) + lines
+        self.respond(204 if append else 201)
+
+
+class StandInStore(ThreadingHTTPServer):
+    """
+    A local triple store stand-in, answering on 127.0.0.1 on a free port.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, state: StoreState):
+        """
+        Create a new StandInStore.
+        :param state:   The (shared) state of the store.
+        """
+        super().__init__(("127.0.0.1", 0), StoreRequestHandler)
+        self.state = state
+        # The open GraphDB transactions, with their changes
+        self.transactions: dict[str, dict[str, list]] = {}
+        # Uploads to and moves into these graphs are rejected with a 400, to test failing loads
+        self.rejected_graphs: set[str] = set()
+        self._thread: Optional[threading.Thread] = None
+
+
+    @property
+    def base_url(self) -> str:
+        """
+        The base url of the server.
+        """
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+    def sparql_endpoint(self, database_type: str) -> str:
+        """
+        Get the SPARQL_ENDPOINT to configure the loader with.
+        :param database_type: graphdb or fuseki
+        :return:
+        """
+        if database_type == "fuseki":
+            return f"{self.base_url}{FUSEKI_DATASET}"
+        return f"{self.base_url}{GRAPHDB_REPOSITORY}"
+
+
+    def start(self) -> None:
+        """
+        Serve requests in a background thread.
+        :return:
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+
+    def stop(self) -> None:
+        """
+        Stop serving requests.
+        :return:
+        """
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
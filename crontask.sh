@@ -1,4 +1,6 @@
 #!/usr/bin/env bash
+# The environment of the container, saved by entrypoint_cron.sh (before set -x, it has passwords)
+. /app/cron.env
 set -x
 
 /app/entrypoint.py
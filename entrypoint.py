@@ -5,16 +5,64 @@ The python entrypoint initializes the Skosmos dataset before starting the applic
 """
 
 import glob
+import hashlib
 import importlib
 import os
-import shutil
+import signal
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import replace
 from pathlib import Path
-from typing import IO
+from typing import IO, Iterator, Optional
 
-from src.database import DatabaseConnector
-from src.exceptions import InvalidConfigurationException, VocabularyLoadingException
-from src.vocabularies import get_file_from_config, get_graph, load_vocab_yaml, get_vocab_format
+import requests
+import yaml
+
+from src.archive import ArchiveRecord, ArchiveSettings, SourceArchive
+from src.batches import BatchLoader, BatchProgress, BatchSettings, supports_batches
+from src.bulk import can_bulk_load, encode_blocks, merged_lines
+from src.database import (
+    DEFAULT_DATASET_TIMEOUT, DatabaseConnector, MetadataWriter, check_status, sparql_iri,
+    staging_graph
+)
+from src.context import LoadContext, LoadOptions, PreparedVocabulary, env_flag
+from src.convert import can_convert, convert_source
+from src.delta import DELTA_FORMATS, DeltaLoader, DeltaSettings, forget_snapshot
+from src.exceptions import (
+    InvalidConfigurationException,
+    VocabularyLoadingException,
+    VocabularyNotModifiedException
+)
+from src.digest import spool_with_digest
+from src.hierarchy import HierarchyCollector, HierarchySettings, collecting, materialize_hierarchy
+from src.http_cache import HttpCache
+from src.metrics import METRICS_FORMATS, CountingReader, RunMetrics
+from src.prefetch import Prefetched, PrefetchSettings, SourcePrefetcher
+from src.replicas import ReplicatedDatabase
+from src.restore import bulk_restore
+from src.scheduler import RefreshScheduler
+from src.skosmos_config import CONFIG_DIR, append_file, write_base_config, write_skosmos_config
+from src.sources import open_source, store_validators, take_source
+from src.vocabularies import (
+    get_file_from_config,
+    get_graph,
+    get_vocab_format,
+    load_vocab_yaml,
+    read_config
+)
+from src.warmup import WarmupSettings, warm_up_graph
+
+# Errors of a single vocabulary in daemon mode, it is retried later while the others continue
+VOCABULARY_ERRORS = (VocabularyLoadingException, InvalidConfigurationException,
+                     requests.RequestException, OSError, yaml.YAMLError, KeyError, ValueError)
+# Errors of the store in daemon mode, retried after STORE_RETRY_DELAY (doubling up to the rescan
+# interval)
+STORE_ERRORS = (VocabularyLoadingException, requests.RequestException, OSError, KeyError,
+                ValueError)
+STORE_RETRY_DELAY = 10
 
 
 def construct_database(db_type: str = "graphdb") -> DatabaseConnector:
@@ -32,61 +80,696 @@ def construct_database(db_type: str = "graphdb") -> DatabaseConnector:
     connector =  module.create_connector()
     if not isinstance(connector, DatabaseConnector):
         raise InvalidConfigurationException(f"'{db_type}' doesn't extend DatabaseConnector")
+    connector.compress_uploads = env_flag("UPLOAD_COMPRESSION")
+    replicas = []
+    for endpoint in os.environ.get("REPLICA_ENDPOINTS", "").split(","):
+        if endpoint.strip():
+            replica = module.create_connector(endpoint.strip())
+            replica.compress_uploads = connector.compress_uploads
+            replicas.append(replica)
+    if replicas:
+        print(f"Writing to {len(replicas)} replica(s)")
+        return ReplicatedDatabase(connector, replicas)
     return connector
 
 
-def append_file(source: IO, dest: str):
+def store_vocabulary_data(context: LoadContext, source_data: dict, vocab_file: IO,
+                          graph_name: str, append: bool = False) -> Optional[int]:
+    """
+    Upload an opened vocabulary file to the database.
+    :param context: The state of the run (database connection, data dir, caches).
+    :param source_data: Dict containing the information where the vocab was found.
+    :param vocab_file: The opened vocabulary.
+    :param graph_name: The name of the graph to put the vocabulary into.
+    :param append: Boolean, when true this doesn't overwrite the graph but appends.
+    :return: The HTTP status of the database, None for batch loads. Failures raise a
+             VocabularyLoadingException.
+    """
+    extension = get_vocab_format(source_data)
+    settings = context.options.batches
+    batch_size = int(source_data.get('batch_size', settings.batch_size))
+    if batch_size > 0 and supports_batches(extension):
+        loader = BatchLoader(context.database, replace(settings, batch_size=batch_size))
+        loader.load(vocab_file, graph_name, extension, append)
+        return None
+    status = check_status(context.database.add_vocabulary(vocab_file, graph_name, extension,
+                                                          append), graph_name)
+    if not append:
+        # The graph is replaced, so an interrupted batch load can't be resumed anymore
+        BatchProgress(settings.progress_dir, graph_name).clear()
+    return status
+
+
+def store_tweaks(context: LoadContext, tweaks_data: dict, tweaks_file: IO,
+                 graph_name: str) -> None:
     """
-    Append source to dest file.
-    :param source:  A file pointer to a source file.
-    :param dest:    The path of the destination file.
+    Append the tweaks of a vocabulary to its graph.
+    :param context:
+    :param tweaks_data: The tweaks configuration from the yaml.
+    :param tweaks_file: The opened tweaks.
+    :param graph_name: The graph the source was uploaded to.
     :return:
     """
-    with open(dest, "a+", encoding='utf-8') as df:
-        for line in source:
-            try:
-                line = line.decode()
-            except (UnicodeDecodeError, AttributeError):
-                pass
-            df.write(line)
+    with context.metrics.phase("tweaks") as record:
+        tweaks = CountingReader(tweaks_file)
+        record['status'] = store_vocabulary_data(context, tweaks_data, tweaks, graph_name, True)
+        record['bytes'] = tweaks.bytes_read
 
 
-def load_vocabulary_data(database: DatabaseConnector, source_data: dict, data_dir: str,
-                    graph_name: str, append: bool = False) -> None:
+def upload_graph(context: LoadContext, graph_name: str) -> str:
     """
-    Load a vocabulary using the source data from the yaml.
-    :param database: The database connector for connecting to the vocabulary storage.
-    :param source_data: Dict containing the information where to find the vocab.
-    :param data_dir: Dir containing local files.
-    :param graph_name: The name of the graph to put the vocabulary into.
-    :param append: Boolean, when true this doesn't overwrite the graph but appends.
+    Get the graph a vocabulary is uploaded to, which is a staging graph when staging is enabled.
+    :param context:
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :return:
+    """
+    return staging_graph(graph_name) if context.options.staging else graph_name
+
+
+def publish_graph(context: LoadContext, graph_name: str, target: str) -> None:
+    """
+    Replace the live graph with the staging graph, when the vocabulary was staged.
+    :param context:
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :param target: The graph the vocabulary was uploaded to.
     :return:
     """
-    with get_file_from_config(source_data, data_dir) as vocab_file:
-        database.add_vocabulary(vocab_file, graph_name, get_vocab_format(source_data), append)
+    if target != graph_name:
+        print(f"Moving staged data into {graph_name}")
+        context.database.move_graph(target, graph_name)
 
 
-def load_vocabulary(database: DatabaseConnector, configuration: dict, data_dir: str,
-                    graph_name: str) -> None:
+def discard_staging(context: LoadContext, graph_name: str) -> None:
+    """
+    Remove the staging graph of a load which failed, the live graph is left as it is. The
+    staging graph of an interrupted batch load is kept, the next attempt resumes it.
+    :param context:
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :return:
+    """
+    target = upload_graph(context, graph_name)
+    if target != graph_name and not BatchProgress(context.options.batches.progress_dir,
+                                                  target).interrupted():
+        print(f"Dropping the staged data of {graph_name}")
+        try:
+            context.database.sparql_update(f"DROP SILENT GRAPH {sparql_iri(target)}")
+        except requests.RequestException as e:
+            print(f"Dropping the staged data of {graph_name} failed: {e}")
+
+
+def use_delta(context: LoadContext, configuration: dict, source_data: dict) -> bool:
+    """
+    Check if the source of a vocabulary is loaded as a delta. This isn't done for vocabularies
+    with tweaks, since a delta can't remove triples which were dropped from the tweaks, nor
+    for those with a materialized hierarchy in the same graph.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param source_data: The source configuration which is used.
+    :return:
+    """
+    hierarchy = context.options.hierarchy
+    return (bool(source_data.get('delta', context.options.delta.enabled))
+            and "tweaks" not in configuration
+            and not (source_data.get('materialize', hierarchy.enabled)
+                     and not hierarchy.graph_suffix)
+            and get_vocab_format(source_data) in DELTA_FORMATS)
+
+
+def converted_source(context: LoadContext, source_data: dict, source: IO) -> tuple[dict, IO]:
+    """
+    Convert a source to the format the database parses fastest, when enabled.
+    :param context:
+    :param source_data: The source configuration which is used.
+    :param source: The opened source.
+    :return: The source configuration with the format of the converted source, and the source.
+    """
+    source_format = get_vocab_format(source_data)
+    target_format = context.database.ingest_format
+    if (not source_data.get('convert', context.options.convert)
+            or not can_convert(source_format, target_format)):
+        return source_data, source
+    print(f"Converting {source_format} to {target_format} while uploading")
+    return {**source_data, 'format': target_format}, convert_source(source, source_format,
+                                                                   target_format)
+
+
+@contextmanager
+def upload_source(context: LoadContext, configuration: dict, source: tuple[dict, IO],
+                  graph_name: str, collector: Optional[HierarchyCollector]) -> Iterator[str]:
+    """
+    Upload the source of a vocabulary, as a delta when enabled. The graph is published when the
+    with block (adding the tweaks) completes.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param source: The source configuration which is used, and the opened source.
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :param collector: Collects the hierarchy links of the source, None when not materializing.
+    :return: The graph the tweaks are added to.
+    """
+    target = upload_graph(context, graph_name)
+    counter = CountingReader(source[1])
+    source_data, source_file = converted_source(context, source[0], counter)
+    source_file = collecting(collector, source_file, get_vocab_format(source_data))
+    if not use_delta(context, configuration, source_data):
+        # A delta against the last snapshot would no longer match the graph
+        forget_snapshot(context.options.delta, graph_name)
+        with context.metrics.phase("upload") as record:
+            record['status'] = store_vocabulary_data(context, source_data, source_file, target)
+            record['bytes'] = counter.bytes_read
+        yield target
+        publish_graph(context, graph_name, target)
+        return
+
+    loader = DeltaLoader(context.database, context.options.delta, graph_name)
+    try:
+        with context.metrics.phase("upload", delta=True) as record:
+            def full_load(fp: IO) -> None:
+                record['delta'] = False
+                record['status'] = store_vocabulary_data(context, source_data, fp, target)
+            if loader.load(source_file, full_load):
+                # The live graph was updated in place
+                target = graph_name
+            record['bytes'] = counter.bytes_read
+        yield target
+        publish_graph(context, graph_name, target)
+        # Only reached when the graph is loaded, failed uploads (and tweaks) raise
+        loader.commit()
+    finally:
+        loader.discard()
+
+
+def combines_tweaks(context: LoadContext, source_data: dict) -> bool:
+    """
+    Check if the tweaks of a vocabulary are uploaded together with its source. Sources which are
+    loaded in batches are not combined.
+    :param context:
+    :param source_data: The source configuration which is used.
+    :return:
+    """
+    batch_size = int(source_data.get('batch_size', context.options.batches.batch_size))
+    return context.options.batches.combine_tweaks and (
+        batch_size <= 0 or not supports_batches(get_vocab_format(source_data)))
+
+
+def upload_combined(context: LoadContext, source: tuple[dict, IO], tweaks: tuple[dict, IO],
+                    graph_name: str, collector: Optional[HierarchyCollector]) -> None:
+    """
+    Upload the source and tweaks of a vocabulary together, so the database commits the graph
+    once. N-Triples and Turtle are merged into a single N-Triples request, other formats are
+    added in a single transaction when the database supports it.
+    :param context:
+    :param source: The source configuration which is used, and the opened source.
+    :param tweaks: The tweaks configuration from the yaml, and the opened tweaks.
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :param collector: Collects the hierarchy links, None when not materializing.
+    :return:
+    """
+    target = upload_graph(context, graph_name)
+    # A delta against the last snapshot would no longer match the graph
+    forget_snapshot(context.options.delta, graph_name)
+    readers = [CountingReader(source[1]), CountingReader(tweaks[1])]
+    formats = [get_vocab_format(source[0]), get_vocab_format(tweaks[0])]
+    with context.metrics.phase("upload", tweaks=True) as record:
+        if all(can_bulk_load(extension) for extension in formats):
+            print(f"Merging the tweaks of {graph_name} into its source")
+            lines = merged_lines(list(zip(readers, formats)))
+            record['status'] = check_status(context.database.add_vocabulary(
+                encode_blocks(lines if collector is None else collector.lines(lines)), target,
+                "nt"), graph_name)
+        else:
+            record['status'] = check_status(context.database.add_vocabulary_parts(
+                [(collecting(collector, reader, extension), extension)
+                 for reader, extension in zip(readers, formats)], target), graph_name)
+        record['bytes'] = sum(reader.bytes_read for reader in readers)
+    store_hierarchy(context, collector, graph_name, target)
+    # The graph is replaced, so an interrupted batch load can't be resumed anymore
+    BatchProgress(context.options.batches.progress_dir, graph_name).clear()
+    publish_graph(context, graph_name, target)
+
+
+def store_hierarchy(context: LoadContext, collector: Optional[HierarchyCollector],
+                    graph_name: str, target: str, published: bool = False) -> None:
+    """
+    Add the derived triples of the hierarchy of a vocabulary, when it is materialized. Triples in
+    the graph itself are added before it is published, a companion graph is only replaced after
+    it was published, so it never describes a graph which readers don't see.
+    :param context:
+    :param collector: The hierarchy links collected during the upload, None when not materializing.
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :param target: The graph the vocabulary was uploaded to, the graph itself once published.
+    :param published: Whether the vocabulary was published.
+    :return:
+    """
+    if collector is None or bool(context.options.hierarchy.graph_suffix) != published:
+        return
+    with context.metrics.phase("hierarchy") as record:
+        record['triples'], record['status'] = materialize_hierarchy(
+            context.database, collector, context.options.hierarchy, graph_name, target)
+        check_status(record['status'], graph_name)
+    companion = context.options.hierarchy.graph(graph_name, target)
+    if companion != target:
+        # A timestamp makes the companion graph a loaded graph, which replicas copy
+        context.metadata.set_timestamp(companion, int(time.time()))
+
+
+def upload_vocabulary(context: LoadContext, configuration: dict, source: tuple[dict, IO],
+                      tweaks_file: Optional[IO], graph_name: str) -> None:
+    """
+    Upload the source of a vocabulary and its tweaks, together when enabled. When this fails,
+    the staging graph is dropped instead of being published.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param source: The source configuration which is used, and the opened source.
+    :param tweaks_file: The opened tweaks, None when the vocabulary has no tweaks.
+    :param graph_name: The graph Skosmos reads the vocabulary from.
+    :return:
+    """
+    collector = None
+    if source[0].get('materialize', context.options.hierarchy.enabled):
+        collector = HierarchyCollector()
+    try:
+        if tweaks_file is not None and combines_tweaks(context, source[0]):
+            upload_combined(context, source, (configuration["tweaks"], tweaks_file), graph_name,
+                            collector)
+        else:
+            with upload_source(context, configuration, source, graph_name, collector) as target:
+                if tweaks_file is not None:
+                    print(f"Tweaks found for {graph_name}. Loading")
+                    tweaks_data = configuration["tweaks"]
+                    store_tweaks(context, tweaks_data, collecting(
+                        collector, tweaks_file, get_vocab_format(tweaks_data)), target)
+                store_hierarchy(context, collector, graph_name, target)
+    except Exception:
+        discard_staging(context, graph_name)
+        raise
+    store_hierarchy(context, collector, graph_name, graph_name, True)
+
+
+def archive_record(context: LoadContext, configuration: dict, graph_name: str,
+                   source_data: dict) -> ArchiveRecord:
+    """
+    Start recording the files of a load for the archive. Local files and sources restored from
+    the archive aren't archived.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param graph_name:
+    :param source_data: The source configuration which is used.
+    :return:
+    """
+    archive = None
+    if (context.options.archive.enabled and source_data.get('type') != 'file'
+            and not source_data.get('archived')):
+        archive = SourceArchive(context.options.archive)
+    return ArchiveRecord(archive, configuration, graph_name)
+
+
+def load_vocabulary(context: LoadContext, configuration: dict, graph_name: str,
+                    conditional: bool = False,
+                    prefetched: Optional[Prefetched] = None) -> Optional[str]:
     """
     Load a vocabulary and its tweaks using the configuration from the yaml.
-    :param database:
+    :param context:
     :param configuration:
-    :param data_dir:
     :param graph_name:
+    :param conditional: Only use this when the graph is completely loaded (see is_complete), an
+                        unchanged source raises a VocabularyNotModifiedException.
+    :param prefetched: The prefetched vocabulary, when its source was opened in advance.
+    :return: The content digest of the loaded data, when digests are enabled.
+    """
+    if context.digests is not None:
+        return load_vocabulary_if_changed(context, configuration, graph_name, conditional,
+                                          prefetched)
+
+    source_data, source_file = take_source(context, configuration, graph_name, conditional,
+                                           prefetched)
+    with archive_record(context, configuration, graph_name, source_data) as record, \
+            ExitStack() as stack:
+        source_file = stack.enter_context(record.tee("source", source_data, source_file))
+        tweaks_file = None
+        if "tweaks" in configuration:
+            tweaks_data = configuration["tweaks"]
+            tweaks_file = stack.enter_context(record.tee(
+                "tweaks", tweaks_data, get_file_from_config(tweaks_data, context.data_dir)))
+        upload_vocabulary(context, configuration, (source_data, source_file), tweaks_file,
+                          graph_name)
+        # Failed uploads raise, so only sources which are in the graph are archived
+        store_validators(context, configuration, source_data, source_file)
+        record.commit()
+    return None
+
+
+def load_vocabulary_if_changed(context: LoadContext, configuration: dict, graph_name: str,
+                               conditional: bool = False,
+                               prefetched: Optional[Prefetched] = None) -> str:
+    """
+    Load a vocabulary and its tweaks, unless their content digest matches the loaded one.
+    The data is buffered in spool files while computing the digest.
+    :param context:
+    :param configuration:
+    :param graph_name:
+    :param conditional: Whether the graph is completely loaded, otherwise the digest isn't compared.
+    :param prefetched:
+    :return: The content digest of the loaded data.
+    """
+    loaded_digest = context.digests.get(graph_name) if conditional else None
+    digest = hashlib.sha256()
+    with ExitStack() as stack:
+        source_data, source_file = take_source(context, configuration, graph_name, conditional,
+                                               prefetched)
+        record = stack.enter_context(archive_record(context, configuration, graph_name,
+                                                    source_data))
+        source_file = record.tee("source", source_data, source_file)
+        source_spool = spool_with_digest(stack, source_file, digest,
+                                         f"source:{get_vocab_format(source_data)}")
+
+        tweaks_spool = None
+        if "tweaks" in configuration:
+            tweaks_data = configuration["tweaks"]
+            tweaks_spool = spool_with_digest(
+                stack, record.tee("tweaks", tweaks_data,
+                                  get_file_from_config(tweaks_data, context.data_dir)),
+                digest, f"tweaks:{get_vocab_format(tweaks_data)}")
+
+        hex_digest = digest.hexdigest()
+        if loaded_digest != hex_digest:
+            upload_vocabulary(context, configuration, (source_data, source_spool), tweaks_spool,
+                              graph_name)
+            # Failed uploads raise, so only sources which are in the graph are archived
+            record.commit(hex_digest)
+        store_validators(context, configuration, source_data, source_file)
+
+    if loaded_digest == hex_digest:
+        raise VocabularyNotModifiedException(graph_name)
+    return hex_digest
+
+
+def is_complete(context: LoadContext, graph: str, loaded_vocabs: dict[str, int]) -> bool:
+    """
+    Check if a graph is completely loaded, so it doesn't have to be loaded again when its source
+    is unchanged. A graph with an interrupted batch load isn't, even though it has a timestamp.
+    :param context:
+    :param graph:
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
     :return:
     """
-    try:
-        load_vocabulary_data(database, configuration["source"], data_dir, graph_name)
-    except VocabularyLoadingException as e:
-        if "fallback" in configuration:
-            print("Primary source failed to load. Using fallback")
-            load_vocabulary_data(database, configuration["fallback"], data_dir, graph_name)
-        else:
-            raise e
-    if "tweaks" in configuration:
-        print(f"Tweaks found for {graph_name}. Loading")
-        load_vocabulary_data(database, configuration["tweaks"], data_dir, graph_name, True)
+    return graph in loaded_vocabs and not BatchProgress(
+        context.options.batches.progress_dir, upload_graph(context, graph)).interrupted()
+
+
+def refresh_interval(vocab_config: dict) -> Optional[float]:
+    """
+    Get the refresh interval of a vocabulary in seconds.
+    :param vocab_config: The configuration from the yaml.
+    :return: The interval, or None when the vocabulary isn't refreshed.
+    """
+    if not vocab_config['config'].get('refresh', False):
+        return None
+    return float(vocab_config['config'].get('refreshInterval', 0)) * 3600
+
+
+def needs_reload(vocab_config: dict, graph: str, loaded_vocabs: dict[str, int]) -> bool:
+    """
+    Check if a vocabulary needs to be (re)loaded.
+    :param vocab_config: The configuration from the yaml.
+    :param graph: The graph of the vocabulary.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :return:
+    """
+    if graph not in loaded_vocabs:
+        return True
+    interval = refresh_interval(vocab_config)
+    if interval is None:
+        return False
+    return time.time() - loaded_vocabs[graph] > interval
+
+
+def prepare_vocabulary(context: LoadContext, vocab: str,
+                       loaded_vocabs: dict[str, int]) -> PreparedVocabulary:
+    """
+    Read the yaml and config of a vocabulary, and check if it needs to be (re)loaded.
+    :param context:
+    :param vocab: The path of the yaml file describing the vocabulary.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :return:
+    """
+    vocab_config = load_vocab_yaml(Path(vocab))
+    # The config is fetched once, for finding the graph and for the Skosmos config
+    with context.metrics.phase("config"):
+        config = read_config(vocab_config['config'], context.data_dir)
+        graph = get_graph(config)
+    print(f"Graph: {graph}")
+    # Fail early, instead of when the metadata of all vocabularies is written
+    sparql_iri(graph)
+    # An interrupted batch load is resumed, even when the vocabulary isn't due for a refresh
+    return PreparedVocabulary(vocab_config, config, graph,
+                              needs_reload(vocab_config, graph, loaded_vocabs)
+                              or not is_complete(context, graph, loaded_vocabs))
+
+
+def archived_vocabularies(context: LoadContext, archive: SourceArchive, vocabs: list[str],
+                          loaded_vocabs: dict[str, int]) -> list[tuple[str, dict, str, dict]]:
+    """
+    Find the vocabularies which can be restored from the archive, because their graph isn't in
+    the store. Only the yaml is read, so this doesn't need the network.
+    :param context:
+    :param archive:
+    :param vocabs: The paths of the yaml files.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :return: The vocabularies, with the configuration loading their archived files, their graph
+             and the archived version.
+    """
+    restorable = []
+    for vocab in vocabs:
+        configuration = load_vocab_yaml(Path(vocab))
+        found = archive.find(configuration)
+        if found is None or found[0] in loaded_vocabs:
+            continue
+        graph, version = found
+        restored = {key: value for key, value in configuration.items()
+                    if key not in ["source", "tweaks", "fallback"]}
+        # The delta snapshot describes the graph which is no longer in the store
+        restored["source"] = {**archive.part_data(version, "source", context.data_dir),
+                              'delta': False}
+        if "tweaks" in version['parts']:
+            restored["tweaks"] = archive.part_data(version, "tweaks", context.data_dir)
+        restorable.append((vocab, restored, graph, version))
+    return restorable
+
+
+def restore_archived(context: LoadContext, vocabs: list[str],
+                     loaded_vocabs: dict[str, int]) -> None:
+    """
+    Restore the graphs which aren't in the store from the archive, e.g. after the store was
+    recreated. The graphs keep the time their sources were loaded, so they are refreshed from
+    their sources as usual afterwards.
+    :param context:
+    :param vocabs: The paths of the yaml files.
+    :param loaded_vocabs: The loaded graphs and their timestamps, the restored graphs are added.
+    :return:
+    """
+    if not context.options.archive.enabled:
+        return
+    restorable = archived_vocabularies(context, SourceArchive(context.options.archive), vocabs,
+                                       loaded_vocabs)
+    if context.options.archive.bulk_restore and not loaded_vocabs:
+        restorable = bulk_restore(context, restorable, loaded_vocabs)
+    for vocab, restored, graph, version in restorable:
+        print(f"Restoring {graph} from the archive")
+        with context.metrics.vocabulary(Path(vocab).stem):
+            try:
+                with context.metrics.phase("restore"):
+                    digest = load_vocabulary(context, restored, graph)
+            except (VocabularyLoadingException, requests.RequestException, OSError) as e:
+                print(f"Failed to restore {graph}: {e}")
+                continue
+        if context.digests is not None:
+            context.digests[graph] = digest
+        context.metadata.set_timestamp(graph, version['loaded'], digest)
+        loaded_vocabs[graph] = version['loaded']
+        warm_up_graph(context.database, graph, context.options.warmup, context.data_dir,
+                      context.metrics)
+    context.metadata.flush()
+
+
+def prefetch_vocabulary(context: LoadContext, vocab: str,
+                        loaded_vocabs: dict[str, int]) -> Prefetched:
+    """
+    Prepare a vocabulary and open its source, when it is loaded from a remote source. Runs on
+    the prefetch thread, errors opening the source are raised when it is taken.
+    :param context:
+    :param vocab: The path of the yaml file describing the vocabulary.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :return:
+    """
+    with context.metrics.vocabulary(Path(vocab).stem):
+        prepared = prepare_vocabulary(context, vocab, loaded_vocabs)
+        if not prepared.reload or prepared.configuration['source'].get('type') == 'file':
+            # Local files are read directly
+            return Prefetched(prepared)
+        try:
+            return Prefetched(prepared, open_source(context, prepared.configuration, prepared.graph,
+                                                    is_complete(context, prepared.graph,
+                                                                loaded_vocabs)))
+        except (VocabularyLoadingException, VocabularyNotModifiedException, OSError) as e:
+            return Prefetched(prepared, error=e)
+
+
+@contextmanager
+def prefetch_sources(context: LoadContext, vocabs: list[str],
+                     loaded_vocabs: dict[str, int]) -> Iterator[Optional[SourcePrefetcher]]:
+    """
+    Prefetch the sources of the vocabularies in the background, when enabled.
+    :param context:
+    :param vocabs: The paths of the yaml files, in the order they are processed.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :return: The prefetcher, None when prefetching is disabled.
+    """
+    if context.options.prefetch.depth <= 0:
+        yield None
+        return
+    with SourcePrefetcher(context.options.prefetch,
+                          lambda vocab: prefetch_vocabulary(context, vocab, loaded_vocabs)) \
+            as prefetcher:
+        prefetcher.start(vocabs)
+        yield prefetcher
+
+
+def process_vocabulary(context: LoadContext, vocab: str, loaded_vocabs: dict[str, int],
+                       prefetcher: Optional[SourcePrefetcher] = None,
+                       keep_failed: bool = False) -> Optional[str]:
+    """
+    Load a single vocabulary (if needed) and return its Skosmos configuration.
+    :param context: The state of the run (database connection, data dir, caches).
+    :param vocab: The path of the yaml file describing the vocabulary.
+    :param loaded_vocabs: The loaded graphs and their timestamps, from the database.
+    :param prefetcher: Prepares the vocabulary and downloads its source, when prefetching.
+    :param keep_failed: Log a failed load and still return the config, so Skosmos keeps serving
+                        what is in the store. Otherwise the error is raised.
+    :return: The contents of the vocabulary config, or None when the vocab is skipped.
+    """
+    with context.metrics.vocabulary(Path(vocab).stem):
+        try:
+            prefetched = None
+            if prefetcher is not None:
+                prefetched = prefetcher.take(vocab)
+                prepared = prefetched.value
+            else:
+                prepared = prepare_vocabulary(context, vocab, loaded_vocabs)
+
+            if prepared.reload:
+                print(f"Loading vocabulary {vocab}")
+                graph = prepared.graph
+                try:
+                    # Conditional requests are only safe when the graph is actually in the store
+                    digest = load_vocabulary(context, prepared.configuration, graph,
+                                             is_complete(context, graph, loaded_vocabs),
+                                             prefetched)
+                    context.metadata.set_timestamp(graph, int(time.time()), digest)
+                    print(f"... DONE ({vocab})")
+                    warm_up_graph(context.database, graph, context.options.warmup,
+                                  context.data_dir, context.metrics)
+                except VocabularyNotModifiedException:
+                    print(f"... NOT MODIFIED ({vocab})")
+                    context.metadata.touch(graph, int(time.time()))
+                except (VocabularyLoadingException, requests.RequestException) as e:
+                    if not keep_failed:
+                        raise
+                    # Nothing is recorded, so the vocabulary is loaded again on the next run
+                    print(f"... FAILED ({vocab}): {e}")
+
+            # Doing this last makes sure the vocab isn't added to the config when there's a problem
+            return prepared.config
+        except InvalidConfigurationException as e:
+            print(f"Invalid configuration: {e}")
+            print(f"Skipping vocab '{vocab}'")
+            return None
+
+
+def create_context(database: DatabaseConnector, data_dir: str) -> LoadContext:
+    """
+    Create the state for loading vocabularies, configured using the environment.
+    :param database: The database connector for connecting to the vocabulary storage.
+    :param data_dir: Dir containing local files.
+    :return:
+    """
+    metrics = RunMetrics(os.environ.get("LOG_FORMAT", "text") == "json")
+    metadata = MetadataWriter(database, int(os.environ.get("METADATA_FLUSH_SIZE", "0")), metrics,
+                              env_flag("TOUCH_UNCHANGED"))
+    options = LoadOptions(
+        staging=env_flag("STAGING_LOAD"),
+        convert=env_flag("CONVERT_SOURCES"),
+        delta=DeltaSettings(
+            snapshot_dir=f"{data_dir}/.cache/snapshots",
+            enabled=env_flag("DELTA_LOAD"),
+            max_fraction=float(os.environ.get("DELTA_MAX_FRACTION", "0.1")),
+            batch_size=int(os.environ.get("DELTA_BATCH_SIZE", "10000")),
+        ),
+    )
+    options.prefetch = PrefetchSettings(
+        depth=int(os.environ.get("PREFETCH_DEPTH", "0")),
+        disk_budget=int(os.environ.get("PREFETCH_DISK_BUDGET_MB", "1024")) * 1024 * 1024,
+        spool_dir=os.environ.get("PREFETCH_DIR", f"{data_dir}/.cache/prefetch"),
+        hedge_deadline=float(os.environ.get("HEDGE_DEADLINE", "0")),
+        hedge_min_throughput=int(os.environ.get("HEDGE_MIN_THROUGHPUT_KB", "0")) * 1024,
+    )
+    options.archive = ArchiveSettings(
+        archive_dir=f"{data_dir}/.cache/sources",
+        enabled=env_flag("SOURCE_ARCHIVE"),
+        keep=int(os.environ.get("SOURCE_ARCHIVE_KEEP", "1")),
+        bulk_restore=env_flag("BULK_RESTORE"),
+        bulk_graphs=int(os.environ.get("BULK_RESTORE_GRAPHS", "0")),
+        bulk_timeout=float(os.environ.get("BULK_RESTORE_TIMEOUT", str(DEFAULT_DATASET_TIMEOUT))),
+    )
+    options.batches = BatchSettings(
+        batch_size=int(os.environ.get("LOAD_BATCH_SIZE", "0")),
+        concurrency=int(os.environ.get("LOAD_BATCH_CONCURRENCY", "1")),
+        retries=int(os.environ.get("LOAD_BATCH_RETRIES", "3")),
+        progress_dir=f"{data_dir}/.cache/batches",
+        combine_tweaks=env_flag("COMBINE_TWEAKS"),
+    )
+    options.hierarchy = HierarchySettings(
+        enabled=env_flag("MATERIALIZE_HIERARCHY"),
+        graph_suffix=os.environ.get("HIERARCHY_GRAPH_SUFFIX", ""),
+    )
+    options.warmup = WarmupSettings(
+        enabled=env_flag("WARMUP"),
+        queries_dir=os.environ.get("WARMUP_QUERIES") or None,
+        concurrency=int(os.environ.get("WARMUP_CONCURRENCY", "4")),
+        budget=float(os.environ.get("WARMUP_BUDGET", "30")),
+    )
+    context = LoadContext(database, data_dir, metadata, metrics=metrics, options=options)
+    if env_flag("HTTP_CACHE", True):
+        context.cache = HttpCache(f"{data_dir}/.cache/http")
+    if env_flag("CONTENT_DIGEST"):
+        context.digests = database.get_loaded_digests()
+    return context
+
+
+def sync_replicas(context: LoadContext) -> None:
+    """
+    Let the replicas which are behind on the primary store catch up, when there are replicas.
+    :param context:
+    :return:
+    """
+    if isinstance(context.database, ReplicatedDatabase):
+        context.database.sync(context.metrics)
+
+
+def export_metrics(context: LoadContext) -> None:
+    """
+    Write the metrics of the run to $DATA/metrics (or METRICS_DIR), in the formats set in
+    METRICS_FORMAT.
+    :param context:
+    :return:
+    """
+    formats = []
+    for metrics_format in os.environ.get("METRICS_FORMAT", "").split(","):
+        metrics_format = metrics_format.strip()
+        if metrics_format in METRICS_FORMATS:
+            formats.append(metrics_format)
+        elif metrics_format:
+            print(f"Unknown METRICS_FORMAT '{metrics_format}', ignoring it")
+    context.metrics.export(os.environ.get("METRICS_DIR", f"{context.data_dir}/metrics"), formats)
 
 
 def main() -> None:
@@ -96,60 +779,147 @@ def main() -> None:
     """
     data = os.environ["DATA"]
     database_type = os.environ.get("DATABASE_TYPE", "graphdb")
+    concurrency = max(1, int(os.environ.get("LOAD_CONCURRENCY", "1")))
 
-    if os.path.isfile(f'{data}/config.ttl'):
-        shutil.copy(f'{data}/config.ttl', '/config/config-docker-compose.ttl')
-    else:
-        shutil.copy('/app/config-docker-compose.ttl', '/config/config-docker-compose.ttl')
-
-    if os.path.isfile(f'{data}/config-ext.ttl'):
-        with open(f'{data}/config-ext.ttl', 'r', encoding='utf-8') as f:
-            append_file(f, '/config/config-docker-compose.ttl')
+    write_base_config(data)
 
     database = construct_database(database_type)
 
+    database.wait_until_ready(float(os.environ.get("STORE_READY_TIMEOUT", "300")))
     database.setup()
 
+    context = create_context(database, data)
+
     loaded_vocabs = database.get_loaded_vocabs()
 
-    vocabs = glob.glob(f'{data}/*.yaml')
+    vocabs = sorted(glob.glob(f'{data}/*.yaml'))
 
-    for vocab in vocabs:
-        path = Path(vocab)
+    try:
+        sync_replicas(context)
+        restore_archived(context, vocabs, loaded_vocabs)
+        with prefetch_sources(context, vocabs, loaded_vocabs) as prefetcher, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(process_vocabulary, context, vocab, loaded_vocabs, prefetcher, True)
+                for vocab in vocabs
+            ]
+            # Collect the results in the order of the yaml files, so the config is deterministic
+            for vocab, future in zip(vocabs, futures):
+                try:
+                    config = future.result()
+                except (VocabularyLoadingException, requests.RequestException) as e:
+                    # E.g. the config of the vocabulary couldn't be read
+                    print(f"Failed to load vocab '{vocab}': {e}")
+                    print(f"Skipping vocab '{vocab}'")
+                    continue
+                if config is not None:
+                    append_file([config], f"{CONFIG_DIR}/config-docker-compose.ttl")
+    finally:
+        # Also record the vocabularies which did load when another one failed
+        context.metadata.flush()
+        export_metrics(context)
+
+
+def reschedule(scheduler: RefreshScheduler, vocab: str, config: Optional[str],
+               loaded_vocabs: dict[str, int]) -> None:
+    """
+    Schedule the next refresh of a vocabulary which was processed in daemon mode.
+    :param scheduler:
+    :param vocab: The path of the yaml file describing the vocabulary.
+    :param config: The Skosmos config of the vocabulary, None when it was skipped.
+    :param loaded_vocabs: The loaded graphs and their timestamps, before it was processed.
+    :return:
+    """
+    if config is None:
+        scheduler.retry(vocab)
+        return
+    vocab_config = load_vocab_yaml(Path(vocab))
+    graph = get_graph(config)
+    last_loaded = loaded_vocabs.get(graph, 0)
+    if needs_reload(vocab_config, graph, loaded_vocabs):
+        last_loaded = time.time()
+    scheduler.schedule(vocab, last_loaded, refresh_interval(vocab_config))
+
+
+def daemon() -> None:
+    """
+    Keep running, refreshing every vocabulary when its refreshInterval has passed. Replaces
+    running main() from cron, and also writes the final (env substituted) Skosmos config.
+    :return:
+    """
+    data = os.environ["DATA"]
+    concurrency = max(1, int(os.environ.get("LOAD_CONCURRENCY", "1")))
+    scheduler = RefreshScheduler(float(os.environ.get("DAEMON_JITTER", "0.1")),
+                                 float(os.environ.get("DAEMON_MIN_INTERVAL", "3600")),
+                                 float(os.environ.get("DAEMON_RESCAN_INTERVAL", "300")))
+
+    stop = threading.Event()
+    for sig in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    database = construct_database(os.environ.get("DATABASE_TYPE", "graphdb"))
+    database.wait_until_ready(float(os.environ.get("STORE_READY_TIMEOUT", "300")))
+    database.setup()
+    context = create_context(database, data)
+    restore_archived(context, sorted(glob.glob(f'{data}/*.yaml')), database.get_loaded_vocabs())
+    configs: dict[str, str] = {}
 
-        vocab_config = load_vocab_yaml(path)
+    def process(vocab: str, loaded_vocabs: dict[str, int],
+                prefetcher: Optional[SourcePrefetcher]) -> Optional[str]:
+        if stop.is_set():
+            return configs.get(vocab)
+        try:
+            config = process_vocabulary(context, vocab, loaded_vocabs, prefetcher)
+            reschedule(scheduler, vocab, config, loaded_vocabs)
+            return config
+        except VOCABULARY_ERRORS as e:
+            print(f"Failed to load vocab '{vocab}': {e}")
+            scheduler.retry(vocab)
+            return configs.get(vocab)
 
+    def process_due(vocabs: list[str], due: list[str]) -> None:
+        print(f"Processing {len(due)} vocabularies")
+        sync_replicas(context)
+        loaded_vocabs = database.get_loaded_vocabs()
+        if context.digests is not None:
+            context.digests = database.get_loaded_digests()
         try:
-            with get_file_from_config(vocab_config['config'], data) as config:
-                graph = get_graph(config)
-                print(f"Graph: {graph}")
-
-            reload = False
-            if graph not in loaded_vocabs:
-                reload = True
-            elif vocab_config['config'].get('refresh', False):
-                interval = vocab_config['config'].get('refreshInterval', 0)
-                diff = (time.time() - loaded_vocabs[graph]) / 3600
-                reload = diff > interval
-
-            if reload:
-                print(f"Loading vocabulary {vocab}")
-                load_vocabulary(database, vocab_config, data, graph)
-                if graph in loaded_vocabs:
-                    database.update_timestamp(graph, int(time.time()))
-                else:
-                    database.set_timestamp(graph, int(time.time()))
-                print("... DONE")
+            with prefetch_sources(context, due, loaded_vocabs) as prefetcher, \
+                    ThreadPoolExecutor(max_workers=concurrency) as executor:
+                configs.update(zip(due, executor.map(
+                    lambda vocab: process(vocab, loaded_vocabs, prefetcher), due)))
+        finally:
+            try:
+                context.metadata.flush()
+            finally:
+                export_metrics(context)
+                context.metrics.clear()
+        for vocab in list(configs):
+            if vocab not in vocabs or configs[vocab] is None:
+                del configs[vocab]
+        write_skosmos_config(data, [configs[vocab] for vocab in vocabs if vocab in configs])
 
-            # Doing this last makes sure the vocab isn't added to the config when there's a problem
-            with get_file_from_config(vocab_config['config'], data) as config:
-                append_file(config, "/config/config-docker-compose.ttl")
-        except InvalidConfigurationException as e:
-            print(f"Invalid configuration: {e}")
-            print(f"Skipping vocab '{vocab}'")
-            continue
+    failures = 0
+    while not stop.is_set():
+        vocabs = sorted(glob.glob(f'{data}/*.yaml'))
+        due = scheduler.due(vocabs)
+        if due:
+            try:
+                process_due(vocabs, due)
+                failures = 0
+            except STORE_ERRORS as e:
+                # E.g. the store is down, the vocabularies which are due are retried after a while
+                failures += 1
+                delay = min(scheduler.rescan_interval, STORE_RETRY_DELAY * 2 ** (failures - 1))
+                print(f"Processing the vocabularies failed: {e}, retrying in {delay:.0f}s")
+                stop.wait(delay)
+                continue
+        stop.wait(scheduler.seconds_until_next())
+    print("Stopped")
 
 
 if __name__ == "__main__":
-    time.sleep(10)
-    main()
+    if "--daemon" in sys.argv[1:]:
+        daemon()
+    else:
+        main()
@@ -1,6 +1,13 @@
 #!/usr/bin/env bash
 
+if [ "${LOADER_MODE}" = "daemon" ]; then
+  # The daemon schedules the refreshes and writes config.ttl itself
+  exec /app/entrypoint.py --daemon
+fi
+
 /usr/bin/envsubst < /app/crontab > /etc/cron.d/crontab
+# Cron starts its jobs with an empty environment, the job loads the settings of the container from here
+(umask 077 && export -p > /app/cron.env)
 
 /app/entrypoint.py
 
@@ -0,0 +1,313 @@
+"""
+This file contains the archive of the last loaded sources and tweaks of each graph. The files are
+stored compressed and content addressed, so cold starts can restore the graphs without downloading
+them, and failing sources can fall back to their last loaded version.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import IO, Optional
+
+from src.database import DEFAULT_DATASET_TIMEOUT
+from src.metrics import CountingReader
+from src.vocabularies import get_vocab_format
+
+
+# Manifests are read and written by the load threads of a run
+MANIFEST_LOCK = threading.Lock()
+
+
+@dataclass
+class ArchiveSettings:
+    """
+    Settings for archiving the loaded sources.
+    """
+    archive_dir: str
+    enabled: bool = False
+    # Number of loaded versions kept per graph
+    keep: int = 1
+    # Restore an empty store with N-Quads requests, instead of a few requests per graph
+    bulk_restore: bool = False
+    # Number of graphs per bulk request, 0 sends all graphs in one request
+    bulk_graphs: int = 0
+    # Seconds to wait for the response to a bulk request
+    bulk_timeout: float = DEFAULT_DATASET_TIMEOUT
+
+
+def yaml_key(configuration: dict) -> str:
+    """
+    Create a key identifying what the yaml of a vocabulary loads.
+    :param configuration: The configuration from the yaml.
+    :return:
+    """
+    # The refresh settings don't change what is loaded
+    config = {key: value for key, value in configuration.get('config', {}).items()
+              if key not in ["refresh", "refreshInterval"]}
+    sections = {'config': config, 'source': configuration.get('source'),
+                'tweaks': configuration.get('tweaks')}
+    serialized = json.dumps(sections, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class ArchivingReader(CountingReader):
+    """
+    Wraps an opened source, writing a compressed copy of the data read from it to a file.
+    """
+
+    def __init__(self, fp: IO, copy_path: str):
+        """
+        Create a new ArchivingReader.
+        :param fp:          The opened file or http response.
+        :param copy_path:   The file the copy is written to.
+        """
+        super().__init__(fp)
+        self.digest = hashlib.sha256()
+        # Set when the end of the source is read, only complete copies are archived
+        self.complete = False
+        self._copy = gzip.GzipFile(copy_path, 'wb', compresslevel=6)
+
+
+    def _count(self, data):
+        data = super()._count(data)
+        chunk = data.encode('utf-8') if isinstance(data, str) else data
+        if not chunk:
+            self.complete = True
+        elif not self._copy.closed:
+            self.digest.update(chunk)
+            self._copy.write(chunk)
+        return data
+
+
+    def __iter__(self):
+        yield from super().__iter__()
+        self.complete = True
+
+
+    def finish(self) -> None:
+        """
+        Finish writing the copy.
+        :return:
+        """
+        self._copy.close()
+
+
+    def close(self) -> None:
+        """
+        Close the source and the copy.
+        :return:
+        """
+        try:
+            super().close()
+        finally:
+            self.finish()
+
+
+class ArchiveRecord:
+    """
+    Records the files of a single load of a graph, they are added to the archive when the load
+    is committed. Without an archive, the files are passed through unchanged.
+    """
+
+    def __init__(self, archive: Optional["SourceArchive"], configuration: dict, graph_name: str):
+        """
+        Create a new ArchiveRecord.
+        :param archive:         The archive, None when archiving is disabled for this load.
+        :param configuration:   The configuration from the yaml.
+        :param graph_name:
+        """
+        self.archive = archive
+        self.graph_name = graph_name
+        self.key = yaml_key(configuration)
+        self._parts: dict[str, tuple[str, ArchivingReader, str]] = {}
+
+
+    def tee(self, part: str, part_data: dict, fp: IO) -> IO:
+        """
+        Copy a file into the archive while it is read.
+        :param part:        The name of the file, e.g. 'source' or 'tweaks'.
+        :param part_data:   The configuration the file was opened from.
+        :param fp:          The opened file.
+        :return: The file to read from instead.
+        """
+        if self.archive is None:
+            return fp
+        handle, copy_path = tempfile.mkstemp(suffix=".tmp", dir=self.archive.objects_dir)
+        os.close(handle)
+        reader = ArchivingReader(fp, copy_path)
+        self._parts[part] = get_vocab_format(part_data), reader, copy_path
+        return reader
+
+
+    def commit(self, digest: Optional[str] = None) -> None:
+        """
+        Add the files to the archive, once they are loaded into the graph. Nothing is archived
+        when a file wasn't read completely.
+        :param digest:  The content digest of the load, when digests are enabled.
+        :return:
+        """
+        if self.archive is None:
+            return
+        for part, (_, reader, _) in self._parts.items():
+            reader.finish()
+            if not reader.complete:
+                print(f"The {part} of {self.graph_name} wasn't read completely, not archiving it")
+                return
+        parts = {part: (copy_path, reader.digest.hexdigest(), part_format)
+                 for part, (part_format, reader, copy_path) in self._parts.items()}
+        self.archive.add_version(self.graph_name, self.key, parts, digest)
+
+
+    def discard(self) -> None:
+        """
+        Remove the copies which weren't added to the archive.
+        :return:
+        """
+        for _, reader, copy_path in self._parts.values():
+            reader.finish()
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+        self._parts.clear()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.discard()
+
+
+class SourceArchive:
+    """
+    On-disk archive of the sources and tweaks loaded into each graph. The files are stored gzip
+    compressed and named by the sha256 of their contents, a manifest per graph lists its versions.
+    """
+
+    def __init__(self, settings: ArchiveSettings):
+        """
+        Create a new SourceArchive.
+        :param settings:
+        """
+        self.settings = settings
+        self.objects_dir = os.path.join(settings.archive_dir, "objects")
+        self.graphs_dir = os.path.join(settings.archive_dir, "graphs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.graphs_dir, exist_ok=True)
+
+
+    def _manifest_path(self, graph_name: str) -> str:
+        key = hashlib.sha256(graph_name.encode('utf-8')).hexdigest()
+        return os.path.join(self.graphs_dir, f"{key}.json")
+
+
+    def object_path(self, digest: str) -> str:
+        """
+        Get the location of an archived file.
+        :param digest: The sha256 of the contents of the file.
+        :return:
+        """
+        return os.path.join(self.objects_dir, f"{digest}.gz")
+
+
+    def _read_manifest(self, path: str) -> dict:
+        try:
+            with open(path, encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+
+    def versions(self, graph_name: str) -> list[dict]:
+        """
+        Get the archived versions of a graph, the last loaded one first.
+        :param graph_name:
+        :return:
+        """
+        return self._read_manifest(self._manifest_path(graph_name)).get('versions', [])
+
+
+    def add_version(self, graph_name: str, key: str, parts: dict[str, tuple[str, str, str]],
+                    digest: Optional[str] = None) -> None:
+        """
+        Add a loaded version of a graph, removing the versions beyond the retention limit.
+        :param graph_name:
+        :param key:     Identifies the yaml the version was loaded with.
+        :param parts:   The compressed copies by name, with the sha256 of their contents and their
+                        format.
+        :param digest:  The content digest of the load, when digests are enabled.
+        :return:
+        """
+        with MANIFEST_LOCK:
+            for copy_path, object_digest, _ in parts.values():
+                os.replace(copy_path, self.object_path(object_digest))
+            version = {
+                'loaded': int(time.time()),
+                'key': key,
+                'digest': digest,
+                'parts': {part: {'object': object_digest, 'format': part_format}
+                          for part, (_, object_digest, part_format) in parts.items()},
+            }
+            versions = [version] + self.versions(graph_name)
+            manifest = {'graph': graph_name, 'versions': versions[:max(1, self.settings.keep)]}
+            path = self._manifest_path(graph_name)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as fp:
+                json.dump(manifest, fp)
+            os.replace(f"{path}.tmp", path)
+            if len(versions) > len(manifest['versions']):
+                self._collect_garbage()
+
+
+    def _collect_garbage(self) -> None:
+        """
+        Remove the archived files which no version refers to anymore.
+        """
+        referenced = set()
+        for name in os.listdir(self.graphs_dir):
+            if name.endswith(".json"):
+                manifest = self._read_manifest(os.path.join(self.graphs_dir, name))
+                for version in manifest.get('versions', []):
+                    referenced.update(part['object'] for part in version['parts'].values())
+        for name in os.listdir(self.objects_dir):
+            if name.endswith(".gz") and name[:-len(".gz")] not in referenced:
+                os.remove(os.path.join(self.objects_dir, name))
+
+
+    def find(self, configuration: dict) -> Optional[tuple[str, dict]]:
+        """
+        Find the graph a yaml was last loaded into, using the yaml only.
+        :param configuration: The configuration from the yaml.
+        :return: The graph and its last archived version, None when the yaml wasn't archived.
+        """
+        key = yaml_key(configuration)
+        for name in sorted(os.listdir(self.graphs_dir)):
+            if not name.endswith(".json"):
+                continue
+            manifest = self._read_manifest(os.path.join(self.graphs_dir, name))
+            versions = manifest.get('versions', [])
+            if versions and versions[0]['key'] == key:
+                return manifest['graph'], versions[0]
+        return None
+
+
+    def part_data(self, version: dict, part: str, data_dir: str) -> Optional[dict]:
+        """
+        Get the configuration for opening an archived file as a local file.
+        :param version: The archived version.
+        :param part:    The name of the file, e.g. 'source' or 'tweaks'.
+        :param data_dir: The data directory of the application, which contains the archive.
+        :return: None when the version doesn't have this file.
+        """
+        if part not in version['parts']:
+            return None
+        archived = version['parts'][part]
+        return {
+            'type': 'file',
+            'location': os.path.relpath(self.object_path(archived['object']), data_dir),
+            'format': archived['format'],
+            'archived': True,
+        }
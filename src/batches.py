@@ -0,0 +1,469 @@
+"""
+This file contains functions for loading large vocabularies in batches.
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Optional
+
+import requests
+
+from src.database import DatabaseConnector, check_status
+from src.exceptions import VocabularyLoadingException
+from src.vocabularies import decode_lines
+
+LINE_FORMATS = ["nt", "ntriples", "nq", "nquads"]
+TURTLE_FORMATS = ["ttl", "turtle"]
+
+# Starts a blank node label, which only identifies the same blank node within one request
+BLANK_NODE_LABEL = "_:"
+
+# Interesting characters when looking for the end of a Turtle statement
+TURTLE_TOKEN = re.compile(r'[<"\'#\[\]().]')
+TURTLE_STRING = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'')
+TURTLE_AT_DIRECTIVE = re.compile(r'(?:\s|#[^\n]*)*@(?:prefix|base)\b')
+TURTLE_SPARQL_DIRECTIVE = re.compile(
+    r'(?:\s|#[^\n]*)*(?:PREFIX\s+[^\s:]*:\s*|BASE\s*)<[^>]*>$',
+    re.IGNORECASE
+)
+
+
+@dataclass
+class BatchSettings:
+    """
+    Settings for loading vocabularies in batches.
+    """
+    # Number of triples (or Turtle statements) per request, 0 disables batches
+    batch_size: int = 0
+    concurrency: int = 1
+    retries: int = 3
+    # Directory for keeping track of interrupted loads, None disables resuming
+    progress_dir: Optional[str] = None
+    # Send the tweaks in the same request (or transaction) as a source which isn't batched
+    combine_tweaks: bool = False
+
+
+def supports_batches(extension: str) -> bool:
+    """
+    Check if vocabularies of this format can be split into batches.
+    :param extension:
+    :return:
+    """
+    return extension in LINE_FORMATS + TURTLE_FORMATS
+
+
+def iter_line_batches(fp: IO, batch_size: int) -> Iterator[str]:
+    """
+    Split an N-Triples/N-Quads file into batches of batch_size triples.
+    :param fp:
+    :param batch_size:
+    :return:
+    """
+    batch = []
+    count = 0
+    for line in decode_lines(fp):
+        batch.append(line)
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            count += 1
+        if count >= batch_size:
+            yield ''.join(batch)
+            batch = []
+            count = 0
+    if count:
+        yield ''.join(batch)
+
+
+def _find_long_string_end(line: str, pos: int, delimiter: str) -> int:
+    """
+    Find the end of a long (triple quoted) string, returns -1 when it continues on the next line.
+    """
+    while True:
+        i = line.find(delimiter, pos)
+        if i < 0:
+            return -1
+        backslashes = len(line[:i]) - len(line[:i].rstrip('\\'))
+        if backslashes % 2 == 0:
+            end = i + 3
+            # A quote right before the delimiter is part of the string
+            while line[end:end + 1] == delimiter[0]:
+                end += 1
+            return end
+        pos = i + 1
+
+
+def _is_statement_end(line: str, pos: int) -> bool:
+    """
+    Check if the dot at pos terminates a statement (and isn't part of a name or number).
+    """
+    after = line[pos + 1:pos + 2]
+    return after == '' or after.isspace() or after == '#' or line[pos - 1:pos] in '>"\')]'
+
+
+class TurtleStatementSplitter:
+    """
+    Splits Turtle into its top level statements, without parsing the triples themselves.
+    """
+
+    def __init__(self):
+        self.buffer: list[str] = []
+        self.long_string: Optional[str] = None
+        self.depth = 0
+
+
+    def _scan_token(self, line: str, pos: int) -> tuple[int, bool]:
+        """
+        Skip the token at pos, returns the new position and whether it ended a statement.
+        """
+        char = line[pos]
+        if char == '<':
+            end = line.find('>', pos)
+            pos = len(line) if end < 0 else end + 1
+            return pos, False
+        if char in '"\'':
+            if line.startswith(char * 3, pos):
+                self.long_string = char * 3
+                return pos + 3, False
+            string = TURTLE_STRING.match(line, pos)
+            return (len(line) if string is None else string.end()), False
+        if char in '[(':
+            self.depth += 1
+        elif char in '])':
+            self.depth -= 1
+        elif self.depth == 0 and _is_statement_end(line, pos):
+            return pos + 1, True
+        return pos + 1, False
+
+
+    def feed(self, line: str) -> Iterator[tuple[bool, str]]:
+        """
+        Process a line of Turtle.
+        :param line:
+        :return: Tuples of (is_directive, statement text) for the statements ending on this line.
+        """
+        start = 0
+        pos = 0
+        while pos < len(line):
+            if self.long_string is not None:
+                pos = _find_long_string_end(line, pos, self.long_string)
+                if pos < 0:
+                    break
+                self.long_string = None
+                continue
+            match = TURTLE_TOKEN.search(line, pos)
+            if match is None or match.group() == '#':
+                break
+            is_iri = match.group() == '<'
+            pos, statement_end = self._scan_token(line, match.start())
+            text = ''.join(self.buffer) + line[start:pos]
+            if statement_end:
+                yield bool(TURTLE_AT_DIRECTIVE.match(text)), text
+            elif is_iri and self.depth == 0 and TURTLE_SPARQL_DIRECTIVE.match(text):
+                # SPARQL style PREFIX and BASE directives don't end with a dot
+                yield True, text
+            else:
+                continue
+            self.buffer = []
+            start = pos
+        self.buffer.append(line[start:])
+
+
+    def close(self) -> Iterator[tuple[bool, str]]:
+        """
+        Process the end of the file.
+        :return: The remaining (unterminated) statement, if any.
+        """
+        rest = ''.join(self.buffer)
+        self.buffer = []
+        if re.sub(r'#[^\n]*', '', rest).strip():
+            yield False, rest
+
+
+def iter_turtle_statements(fp: IO) -> Iterator[tuple[bool, str]]:
+    """
+    Split a Turtle file into its top level statements.
+    :param fp:
+    :return: Tuples of (is_directive, statement text).
+    """
+    splitter = TurtleStatementSplitter()
+    for line in decode_lines(fp):
+        yield from splitter.feed(line)
+    yield from splitter.close()
+
+
+def iter_turtle_batches(fp: IO, batch_size: int) -> Iterator[str]:
+    """
+    Split a Turtle file into batches of batch_size statements. Every batch starts with the
+    prefix and base declarations seen so far, so it can be parsed on its own.
+    :param fp:
+    :param batch_size:
+    :return:
+    """
+    directives: list[str] = []
+    batch: list[str] = []
+    count = 0
+    for is_directive, text in iter_turtle_statements(fp):
+        batch.append(text)
+        if is_directive:
+            directives.append(text.strip())
+            continue
+        count += 1
+        if count >= batch_size:
+            batch.append('\n')
+            yield ''.join(batch)
+            batch = ['\n'.join(directives) + '\n']
+            count = 0
+    if count:
+        batch.append('\n')
+        yield ''.join(batch)
+
+
+def iter_batches(fp: IO, extension: str, batch_size: int) -> Iterator[str]:
+    """
+    Split a vocabulary into batches which can be loaded separately.
+    :param fp:
+    :param extension:
+    :param batch_size:
+    :return:
+    """
+    if extension in TURTLE_FORMATS:
+        return iter_turtle_batches(fp, batch_size)
+    return iter_line_batches(fp, batch_size)
+
+
+def source_identity(fp: IO) -> Optional[str]:
+    """
+    Describe the version of an opened source, used to check if an interrupted load can be
+    resumed. Returns None when the version can't be determined.
+    :param fp:
+    :return:
+    """
+    # Spooled sources have the digest of their data, they are new files on every run (and asking
+    # an in-memory spool for its file descriptor moves it to disk)
+    content_digest = getattr(fp, 'content_digest', None)
+    if content_digest is not None:
+        return content_digest
+    headers = getattr(fp, 'headers', None)
+    if headers is not None:
+        validators = [headers.get(name) for name in ['ETag', 'Last-Modified', 'Content-Length']]
+        if not any(validators[:2]):
+            return None
+        return '|'.join(str(value) for value in validators)
+    try:
+        stat = os.fstat(fp.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return f"{stat.st_size}|{stat.st_mtime_ns}"
+
+
+class BatchProgress:
+    """
+    Keeps track of the batches of a graph which are loaded, so an interrupted load can resume.
+    """
+
+    path: Optional[str]
+    identity: Optional[str]
+
+    def __init__(self, progress_dir: Optional[str], graph_name: str,
+                 identity: Optional[str] = None):
+        """
+        Create a new BatchProgress, continuing the stored progress when the identity matches.
+        :param progress_dir:    The directory to store the progress in, None to disable.
+        :param graph_name:      The graph being loaded.
+        :param identity:        The version of the source (see source_identity).
+        """
+        self.path = None
+        if progress_dir is not None:
+            os.makedirs(progress_dir, exist_ok=True)
+            key = hashlib.sha256(graph_name.encode('utf-8')).hexdigest()
+            self.path = os.path.join(progress_dir, f"{key}.json")
+        self.identity = identity
+        self.done: dict[int, str] = {}
+        self._lock = threading.Lock()
+        stored = self._load()
+        if identity is not None and stored.get('identity') == identity:
+            self.done = {int(index): digest for index, digest in stored['done'].items()}
+
+
+    def _load(self) -> dict:
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+
+    def interrupted(self) -> bool:
+        """
+        Check if a load of the graph was interrupted after some of its batches were loaded, the
+        graph is incomplete until the load is resumed.
+        :return:
+        """
+        return bool(self._load().get('done'))
+
+
+    def is_done(self, index: int, digest: str) -> bool:
+        """
+        Check if a batch was already loaded by an interrupted run.
+        :param index:
+        :param digest:  The digest of the batch contents.
+        :return:
+        """
+        if index not in self.done:
+            return False
+        if self.done[index] != digest:
+            self.clear()
+            raise VocabularyLoadingException(
+                f"Batch {index} differs from the interrupted load, the source changed"
+            )
+        return True
+
+
+    def mark_done(self, index: int, digest: str) -> None:
+        """
+        Record a loaded batch.
+        :param index:
+        :param digest:
+        :return:
+        """
+        with self._lock:
+            self.done[index] = digest
+            if self.path is None or self.identity is None:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as fp:
+                json.dump({'identity': self.identity, 'done': self.done}, fp)
+            os.replace(tmp_path, self.path)
+
+
+    def clear(self) -> None:
+        """
+        Forget the progress, the next load starts over.
+        :return:
+        """
+        with self._lock:
+            self.done = {}
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def wait_for_slot(pending: set, limit: int) -> set:
+    """
+    Wait until less than limit futures are pending, raising the errors of the finished ones.
+    :param pending: The pending futures.
+    :param limit:
+    :return: The futures which are still pending.
+    """
+    while len(pending) >= limit:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+    return pending
+
+
+class BatchLoader:
+    """
+    Loads vocabularies into the database in batches.
+    """
+
+    database: DatabaseConnector
+    settings: BatchSettings
+
+    def __init__(self, database: DatabaseConnector, settings: BatchSettings):
+        """
+        Create a new BatchLoader.
+        :param database:    The database connector.
+        :param settings:    The batch settings.
+        """
+        self.database = database
+        self.settings = settings
+
+
+    def send_batch(self, batch: bytes, graph_name: str, extension: str, append: bool) -> None:
+        """
+        Send a single batch, retrying with an exponential backoff when it fails.
+        :param batch:
+        :param graph_name:
+        :param extension:
+        :param append:
+        :return:
+        """
+        for attempt in range(self.settings.retries + 1):
+            try:
+                self.database.add_vocabulary_batch(batch, graph_name, extension, append)
+                return
+            except (VocabularyLoadingException, requests.RequestException) as e:
+                if attempt == self.settings.retries:
+                    raise VocabularyLoadingException(str(e)) from e
+                print(f"Batch failed ({e}), retrying")
+                time.sleep(2 ** attempt)
+
+
+    def send_rest(self, batches: Iterable[str], graph_name: str, extension: str,
+                  append: bool) -> None:
+        """
+        Send the remaining batches in a single request, it can't be retried.
+        :param batches:
+        :param graph_name:
+        :param extension:
+        :param append:
+        :return:
+        """
+        check_status(self.database.add_vocabulary(
+            (text.encode('utf-8') for text in batches), graph_name, extension, append), graph_name)
+
+
+    def load(self, fp: IO, graph_name: str, extension: str, append: bool = False) -> None:
+        """
+        Load a vocabulary in batches. The first batch replaces the graph (unless appending),
+        the others are appended, possibly in parallel. Blank node labels don't match across
+        requests, so from the first batch with a blank node label on, the rest of the vocabulary
+        is sent in one request.
+        :param fp:          The opened vocabulary.
+        :param graph_name:  The graph to load the vocabulary into.
+        :param extension:   The format of the vocabulary.
+        :param append:      Append to the graph instead of replacing it.
+        :return:
+        """
+        progress = BatchProgress(self.settings.progress_dir, graph_name, source_identity(fp))
+        concurrency = max(1, self.settings.concurrency)
+        print(f"Loading {graph_name} in batches of {self.settings.batch_size}")
+
+        def load_batch(index: int, batch: bytes, digest: str) -> None:
+            self.send_batch(batch, graph_name, extension, append or index > 0)
+            progress.mark_done(index, digest)
+
+        index = -1
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending: set = set()
+            batches = iter_batches(fp, extension, self.settings.batch_size)
+            for index, text in enumerate(batches):
+                if BLANK_NODE_LABEL in text:
+                    print(f"Batch {index} of {graph_name} has blank node labels, "
+                          f"sending the rest in one request")
+                    wait_for_slot(pending, 1)
+                    self.send_rest(itertools.chain([text], batches), graph_name, extension,
+                                   append or index > 0)
+                    break
+                batch = text.encode('utf-8')
+                digest = hashlib.sha256(batch).hexdigest()
+                if progress.is_done(index, digest):
+                    continue
+                if index == 0:
+                    # The other batches are appended to this one, so it has to be loaded first
+                    load_batch(index, batch, digest)
+                    continue
+                # Limit the number of batches kept in memory
+                pending = wait_for_slot(pending, concurrency)
+                pending.add(executor.submit(load_batch, index, batch, digest))
+            wait_for_slot(pending, 1)
+        progress.clear()
+        print(f"Loaded {index + 1} batches into {graph_name}")
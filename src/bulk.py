@@ -0,0 +1,91 @@
+"""
+This file contains the bulk loading of several graphs, with their metadata, as a single N-Quads
+stream. An empty store is filled with one request, instead of a few requests per vocabulary.
+"""
+from typing import IO, Iterable, Iterator, Optional
+
+from src.batches import TURTLE_FORMATS
+from src.convert import NTRIPLES_FORMATS, XSD, TurtleConverter, ntriples_string
+from src.database import DIGEST_PREDICATE, TIMESTAMP_PREDICATE, sparql_iri
+from src.sparql_source import iter_blocks, relabel_blank_nodes
+from src.vocabularies import decode_lines
+
+# The formats which can be added to a bulk load
+BULK_FORMATS = NTRIPLES_FORMATS + TURTLE_FORMATS
+
+# Number of quads sent as one block of the request
+BULK_BLOCK_LINES = 10000
+
+
+def can_bulk_load(extension: str) -> bool:
+    """
+    Check if files of this format can be added to a bulk load.
+    :param extension:
+    :return:
+    """
+    return extension in BULK_FORMATS
+
+
+def triple_lines(fp: IO, extension: str, prefix: str) -> Iterator[str]:
+    """
+    Read the triples of an N-Triples or Turtle file as N-Triples.
+    :param fp:
+    :param extension:
+    :param prefix:  Added to the blank node labels, so they stay apart from those of other files.
+    :return:
+    """
+    if extension in TURTLE_FORMATS:
+        yield from TurtleConverter(prefix).convert_file(fp)
+        return
+    for line in decode_lines(fp):
+        if line.strip() and not line.lstrip().startswith('#'):
+            yield relabel_blank_nodes(line, prefix)
+
+
+def quad_lines(lines: Iterable[str], graph_name: str) -> Iterator[str]:
+    """
+    Turn lines of N-Triples into N-Quads in the given graph.
+    :param lines:
+    :param graph_name:
+    :return:
+    """
+    graph = sparql_iri(graph_name)
+    for line in lines:
+        yield f"{line.rstrip().rstrip('.').rstrip()} {graph} .\n"
+
+
+def metadata_lines(graph_name: str, timestamp: int, digest: Optional[str] = None) -> list[str]:
+    """
+    Get the metadata of a graph as N-Triples, which are added to the default graph.
+    :param graph_name:
+    :param timestamp:
+    :param digest:
+    :return:
+    """
+    lines = [f"{sparql_iri(graph_name)} <{TIMESTAMP_PREDICATE}> "
+             f"\"{int(timestamp)}\"^^<{XSD}integer> .\n"]
+    if digest is not None:
+        lines.append(f"{sparql_iri(graph_name)} <{DIGEST_PREDICATE}> {ntriples_string(digest)} .\n")
+    return lines
+
+
+def merged_lines(parts: list[tuple[IO, str]]) -> Iterator[str]:
+    """
+    Read several N-Triples or Turtle files as a single N-Triples stream, keeping the blank nodes
+    of the files apart.
+    :param parts:   The opened files with their extensions.
+    :return:
+    """
+    for index, (fp, extension) in enumerate(parts):
+        for line in triple_lines(fp, extension, f"m{index}"):
+            yield line if line.endswith('\n') else line + '\n'
+
+
+def encode_blocks(lines: Iterable[str]) -> Iterator[bytes]:
+    """
+    Join lines into utf-8 encoded blocks, for streaming them in a request.
+    :param lines:
+    :return:
+    """
+    for block in iter_blocks(lines, BULK_BLOCK_LINES):
+        yield block.encode('utf-8')
@@ -0,0 +1,75 @@
+"""
+This file contains the settings and the state shared by the vocabulary loads of a run.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+from src.archive import ArchiveSettings
+from src.batches import BatchSettings
+from src.database import DatabaseConnector, MetadataWriter
+from src.delta import DeltaSettings
+from src.hierarchy import HierarchySettings
+from src.http_cache import HttpCache
+from src.metrics import RunMetrics
+from src.prefetch import PrefetchSettings
+from src.warmup import WarmupSettings
+
+
+@dataclass
+class LoadOptions:  # pylint: disable=too-many-instance-attributes
+    """
+    Switches and settings changing how vocabularies are loaded.
+    """
+    # Load vocabularies into a staging graph and move it into place when complete
+    staging: bool = False
+    # Send only the changed triples of N-Triples vocabularies
+    delta: DeltaSettings = field(default_factory=lambda: DeltaSettings(""))
+    batches: BatchSettings = field(default_factory=BatchSettings)
+    # Convert sources to the format the database parses fastest while uploading them
+    convert: bool = False
+    # Download the sources of the next vocabularies while uploading the current one
+    prefetch: PrefetchSettings = field(default_factory=PrefetchSettings)
+    # Keep the last loaded sources, for cold starts and as implicit fallback
+    archive: ArchiveSettings = field(default_factory=lambda: ArchiveSettings(""))
+    # Add the inverse, transitive and top concept links of the SKOS hierarchy while loading
+    hierarchy: HierarchySettings = field(default_factory=HierarchySettings)
+    # Run the queries Skosmos always runs on a graph after loading it
+    warmup: WarmupSettings = field(default_factory=WarmupSettings)
+
+
+@dataclass
+class PreparedVocabulary:
+    """
+    A vocabulary of which the yaml and config are read.
+    """
+    configuration: dict
+    # The Skosmos config of the vocabulary
+    config: str
+    graph: str
+    reload: bool
+
+
+@dataclass
+class LoadContext:
+    """
+    The state shared by all vocabulary loads of a run.
+    """
+    database: DatabaseConnector
+    data_dir: str
+    metadata: MetadataWriter
+    cache: Optional[HttpCache] = None
+    metrics: RunMetrics = field(default_factory=RunMetrics)
+    # The content digests of the loaded graphs, None when digests are disabled
+    digests: Optional[dict[str, str]] = None
+    options: LoadOptions = field(default_factory=LoadOptions)
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    """
+    Read a boolean environment variable.
+    :param name:    The name of the environment variable.
+    :param default: The value used when the variable is not set.
+    :return:
+    """
+    return os.environ.get(name, str(default)).lower() in ["true", "yes", "1"]
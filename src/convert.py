@@ -0,0 +1,382 @@
+"""
+This file contains the streaming conversion of Turtle sources to N-Triples. The triple stores
+parse N-Triples faster than Turtle, and the loader can split it into batches and deltas line by
+line.
+"""
+import re
+from typing import IO, Iterator, Optional
+from urllib.parse import urljoin
+
+from src.batches import TURTLE_FORMATS, iter_turtle_statements
+from src.exceptions import VocabularyLoadingException
+
+NTRIPLES_FORMATS = ["nt", "ntriples"]
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+# The tokens of a Turtle statement, whitespace and comments are skipped
+TURTLE_TOKENS = re.compile(r'''
+    (?P<skip>(?:\s|\#[^\n]*)+)
+  | (?P<iri><(?:[^<>"{}|^`\\\x00-\x20]|\\u[0-9A-Fa-f]{4}|\\U[0-9A-Fa-f]{8})*>)
+  | (?P<long_string>"""(?:(?:"|"")?(?:[^"\\]|\\.))*"""|\'\'\'(?:(?:'|'')?(?:[^'\\]|\\.))*\'\'\')
+  | (?P<string>"(?:[^"\\\n\r]|\\.)*"|'(?:[^'\\\n\r]|\\.)*')
+  | (?P<blank_node>_:\w(?:[\w.\-\u00B7]*[\w\-\u00B7])?)
+  | (?P<pname>(?:[^\W\d_](?:[\w.\-\u00B7]*[\w\-\u00B7])?)?:
+        (?:[\w:\-\u00B7]|%[0-9A-Fa-f]{2}|\\[_~.\-!$&'()*+,;=/?\#@%]
+           |\.(?=[\w:\-\u00B7%\\]))*)
+  | (?P<number>[+-]?(?:\d+\.\d*[eE][+-]?\d+|\.\d+[eE][+-]?\d+|\d+[eE][+-]?\d+|\d*\.\d+|\d+))
+  | (?P<at>@[a-zA-Z]+(?:-[a-zA-Z0-9]+)*)
+  | (?P<word>[A-Za-z]+)
+  | (?P<punctuation>\^\^|[\[\]();,.])
+  | (?P<invalid>.)
+''', re.VERBOSE | re.DOTALL)
+
+STRING_ESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))', re.DOTALL)
+STRING_ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'",
+                  '\\': '\\'}
+LOCAL_ESCAPE = re.compile(r'\\(.)')
+SCHEME = re.compile(r'[A-Za-z][A-Za-z0-9+.\-]*:')
+
+
+def can_convert(source_format: str, target_format: str) -> bool:
+    """
+    Check if sources of a format can be converted to the target format.
+    :param source_format:
+    :param target_format:
+    :return:
+    """
+    return source_format in TURTLE_FORMATS and target_format in NTRIPLES_FORMATS
+
+
+def _unescape(match: re.Match) -> str:
+    code = match.group(1) or match.group(2)
+    if code is not None:
+        return chr(int(code, 16))
+    if match.group(3) not in STRING_ESCAPES:
+        raise VocabularyLoadingException(f"Invalid escape sequence '{match.group()}'")
+    return STRING_ESCAPES[match.group(3)]
+
+
+def ntriples_string(value: str) -> str:
+    """
+    Serialize a string as an N-Triples literal (without language or datatype).
+    :param value:
+    :return:
+    """
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n').replace('\r', '\\r'))
+    return f'"{escaped}"'
+
+
+def shorthand_literal(text: str) -> str:
+    """
+    Serialize a number or boolean, written without quotes in Turtle, as an N-Triples literal.
+    :param text:
+    :return:
+    """
+    if text in ["true", "false"]:
+        datatype = "boolean"
+    elif 'e' in text or 'E' in text:
+        datatype = "double"
+    else:
+        datatype = "decimal" if '.' in text else "integer"
+    return f'"{text}"^^<{XSD}{datatype}>'
+
+
+class TurtleConverter:
+    """
+    Converts Turtle statements to N-Triples, keeping track of the prefixes and base of the
+    document. The blank node labels are unique within the document.
+    """
+
+    def __init__(self, blank_node_prefix: str = ""):
+        """
+        Create a new TurtleConverter.
+        :param blank_node_prefix:   Added to the blank node labels, to keep the blank nodes of
+                                    several documents apart.
+        """
+        self.blank_node_prefix = blank_node_prefix
+        self.prefixes: dict[str, str] = {}
+        self.base = ""
+        self._blank_nodes = 0
+        self._tokens: list[tuple[str, str]] = []
+        self._pos = 0
+        self._triples: list[str] = []
+
+
+    def convert(self, statement: str) -> list[str]:
+        """
+        Convert a single Turtle statement (or directive).
+        :param statement:
+        :return: The N-Triples lines of the statement.
+        """
+        self._tokens = [(match.lastgroup, match.group())
+                        for match in TURTLE_TOKENS.finditer(statement)
+                        if match.lastgroup != 'skip']
+        for kind, text in self._tokens:
+            if kind == 'invalid':
+                raise VocabularyLoadingException(
+                    f"Invalid character '{text}' in Turtle statement '{statement[:80]}'")
+        # Parsing stops at the end token
+        self._tokens.append(("end", ""))
+        self._pos = 0
+        self._triples = []
+        if len(self._tokens) > 1:
+            self._statement()
+        return self._triples
+
+
+    def convert_file(self, fp: IO) -> Iterator[str]:
+        """
+        Convert a Turtle file, one statement at a time.
+        :param fp:
+        :return: The N-Triples lines.
+        """
+        for _, statement in iter_turtle_statements(fp):
+            yield from self.convert(statement)
+
+
+    def _peek(self) -> tuple[str, str]:
+        return self._tokens[self._pos]
+
+
+    def _next(self) -> tuple[str, str]:
+        token = self._peek()
+        if token[0] == "end":
+            raise VocabularyLoadingException("Unexpected end of a Turtle statement")
+        self._pos += 1
+        return token
+
+
+    def _expect(self, kind: str, value: Optional[str] = None) -> str:
+        token_kind, text = self._next()
+        if token_kind != kind or (value is not None and text != value):
+            raise VocabularyLoadingException(f"Unexpected '{text}' in a Turtle statement")
+        return text
+
+
+    def _statement(self) -> None:
+        kind, text = self._peek()
+        if kind == "at" and text in ["@prefix", "@base"]:
+            self._next()
+            self._directive(text[1:])
+            self._expect("punctuation", ".")
+        elif kind == "word" and text.lower() in ["prefix", "base"]:
+            self._next()
+            self._directive(text.lower())
+        else:
+            if kind == "punctuation" and text == "[":
+                self._next()
+                subject = self._blank_node_property_list()
+                if self._peek() != ("punctuation", "."):
+                    self._predicate_object_list(subject)
+            else:
+                self._predicate_object_list(self._subject())
+            self._expect("punctuation", ".")
+        if self._peek()[0] != "end":
+            raise VocabularyLoadingException(f"Unexpected '{self._peek()[1]}' after a statement")
+
+
+    def _directive(self, name: str) -> None:
+        if name == "prefix":
+            prefix = self._expect("pname")
+            if not prefix.endswith(":"):
+                raise VocabularyLoadingException(f"Invalid prefix '{prefix}'")
+            self.prefixes[prefix[:-1]] = self._iri(self._expect("iri"))[1:-1]
+        else:
+            self.base = self._iri(self._expect("iri"))[1:-1]
+
+
+    def _subject(self) -> str:
+        kind, text = self._next()
+        if kind == "punctuation" and text == "(":
+            return self._collection()
+        if kind not in ["iri", "pname", "blank_node"]:
+            raise VocabularyLoadingException(f"Invalid subject '{text}'")
+        return self._resource(kind, text)
+
+
+    def _predicate_object_list(self, subject: str) -> None:
+        while True:
+            kind, text = self._next()
+            if kind == "word" and text == "a":
+                predicate = f"<{RDF}type>"
+            elif kind in ["iri", "pname"]:
+                predicate = self._resource(kind, text)
+            else:
+                raise VocabularyLoadingException(f"Invalid predicate '{text}'")
+            self._triples.append(f"{subject} {predicate} {self._object()} .\n")
+            while self._peek() == ("punctuation", ","):
+                self._next()
+                self._triples.append(f"{subject} {predicate} {self._object()} .\n")
+            # Repeated semicolons are allowed, as is one before the end of the list
+            if self._peek() != ("punctuation", ";"):
+                return
+            while self._peek() == ("punctuation", ";"):
+                self._next()
+            if self._peek() in [("punctuation", "."), ("punctuation", "]"), ("end", "")]:
+                return
+
+
+    def _object(self) -> str:
+        kind, text = self._next()
+        if kind in ["iri", "pname", "blank_node"]:
+            return self._resource(kind, text)
+        if kind in ["string", "long_string"]:
+            return self._literal(kind, text)
+        if kind == "number" or (kind == "word" and text in ["true", "false"]):
+            return shorthand_literal(text)
+        if kind == "punctuation" and text == "[":
+            return self._blank_node_property_list()
+        if kind == "punctuation" and text == "(":
+            return self._collection()
+        raise VocabularyLoadingException(f"Invalid object '{text}'")
+
+
+    def _blank_node_property_list(self) -> str:
+        node = self._new_blank_node()
+        if self._peek() != ("punctuation", "]"):
+            self._predicate_object_list(node)
+        self._expect("punctuation", "]")
+        return node
+
+
+    def _collection(self) -> str:
+        items = []
+        while self._peek() != ("punctuation", ")"):
+            items.append(self._object())
+        self._next()
+        head = f"<{RDF}nil>"
+        for item in reversed(items):
+            node = self._new_blank_node()
+            self._triples.append(f"{node} <{RDF}first> {item} .\n")
+            self._triples.append(f"{node} <{RDF}rest> {head} .\n")
+            head = node
+        return head
+
+
+    def _literal(self, kind: str, text: str) -> str:
+        quotes = 3 if kind == "long_string" else 1
+        value = text[quotes:-quotes]
+        if '\\' in value:
+            value = STRING_ESCAPE.sub(_unescape, value)
+        literal = ntriples_string(value)
+        next_kind, next_text = self._peek()
+        if next_kind == "at":
+            self._next()
+            return f"{literal}{next_text}"
+        if (next_kind, next_text) == ("punctuation", "^^"):
+            self._next()
+            kind, text = self._next()
+            if kind not in ["iri", "pname"]:
+                raise VocabularyLoadingException(f"Invalid datatype '{text}'")
+            return f"{literal}^^{self._resource(kind, text)}"
+        return literal
+
+
+    def _resource(self, kind: str, text: str) -> str:
+        if kind == "iri":
+            return self._iri(text)
+        if kind == "blank_node":
+            # Prefixed, so the labels never clash with the generated ones
+            return f"_:{self.blank_node_prefix}b{text[2:]}"
+        prefix, _, local = text.partition(":")
+        if prefix not in self.prefixes:
+            raise VocabularyLoadingException(f"Undefined prefix '{prefix}:'")
+        if '\\' in local:
+            local = LOCAL_ESCAPE.sub(r'\1', local)
+        return f"<{self.prefixes[prefix]}{local}>"
+
+
+    def _iri(self, text: str) -> str:
+        if self.base and not SCHEME.match(text, 1):
+            return f"<{urljoin(self.base, text[1:-1])}>"
+        return text
+
+
+    def _new_blank_node(self) -> str:
+        self._blank_nodes += 1
+        return f"_:{self.blank_node_prefix}g{self._blank_nodes}"
+
+
+class ConvertedSource:
+    """
+    A read-only file with the N-Triples of an opened Turtle source, which is converted while it is
+    read. Other attributes (like the headers of a response) are those of the source.
+    """
+
+    def __init__(self, fp: IO):
+        """
+        Create a new ConvertedSource.
+        :param fp:  The opened Turtle file or http response.
+        """
+        self._fp = fp
+        self._lines = TurtleConverter().convert_file(fp)
+        self._buffer = b''
+
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read (up to size bytes of) the converted source.
+        :param size:
+        :return:
+        """
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        if size < 0 or length < size:
+            for line in self._lines:
+                chunk = line.encode('utf-8')
+                chunks.append(chunk)
+                length += len(chunk)
+                if 0 <= size <= length:
+                    break
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+    def __iter__(self):
+        if self._buffer:
+            # Only the rest of a partially read line is kept
+            buffer, self._buffer = self._buffer, b''
+            yield buffer
+        for line in self._lines:
+            yield line.encode('utf-8')
+
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+    def close(self) -> None:
+        """
+        Close the source.
+        :return:
+        """
+        self._fp.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert_source(fp: IO, source_format: str, target_format: str) -> IO:
+    """
+    Convert an opened source to another format while it is read.
+    :param fp:
+    :param source_format:
+    :param target_format:   Only N-Triples, for Turtle sources.
+    :return:
+    """
+    if not can_convert(source_format, target_format):
+        raise VocabularyLoadingException(
+            f"Can't convert '{source_format}' sources to '{target_format}'")
+    return ConvertedSource(fp)
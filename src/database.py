@@ -1,15 +1,140 @@
 """
 Database connector for interacting with triple stores.
 """
+import hashlib
+import re
+import zlib
+import threading
+import time
 from abc import abstractmethod, ABC
 from dataclasses import dataclass
-from typing import TextIO
+from typing import IO, Any, Iterable, Iterator, Optional, TextIO
 
 import requests
-from SPARQLWrapper import SPARQLWrapper, JSON, POST, BASIC
+from requests.adapters import HTTPAdapter
 
+from src.exceptions import (
+    DatabaseUnavailableException,
+    InvalidConfigurationException,
+    VocabularyLoadingException
+)
+from src.metrics import RunMetrics
 from src.vocabularies import get_type
 
+# Default number of connections kept alive to the triple store
+DEFAULT_POOL_SIZE = 10
+
+# Default number of seconds to wait for the triple store to start
+DEFAULT_READY_TIMEOUT = 300
+
+# Default number of seconds to wait for the response to a request with several graphs, which the
+# triple store only answers after parsing all of them
+DEFAULT_DATASET_TIMEOUT = 3600
+
+# Predicate used for storing when a graph was last loaded
+TIMESTAMP_PREDICATE = "http://purl.org/dc/terms/modified"
+
+# Predicate used for storing the content digest of a loaded graph
+DIGEST_PREDICATE = "http://spdx.org/rdf/terms#checksumValue"
+
+# Vocabularies are loaded into a graph with this prefix first, when staging is enabled
+STAGING_PREFIX = "urn:x-sd-skosmos:staging:"
+
+# Characters which are not allowed in a SPARQL IRIREF
+INVALID_IRI_CHARACTERS = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+# Size of the blocks read from a vocabulary file while uploading it
+CHUNK_SIZE = 1024 * 1024
+
+# Compression of uploads, when enabled. The wbits select the gzip container instead of zlib.
+GZIP_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def sparql_iri(value: str) -> str:
+    """
+    Serialize an IRI for use in a SPARQL query.
+    :param value:
+    :return:
+    """
+    if not value or INVALID_IRI_CHARACTERS.search(value):
+        raise InvalidConfigurationException(f"Invalid IRI '{value}'")
+    return f"<{value}>"
+
+
+def sparql_literal(value: str) -> str:
+    """
+    Serialize a string literal for use in a SPARQL query.
+    :param value:
+    :return:
+    """
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n').replace('\r', '\\r'))
+    return f'"{escaped}"'
+
+
+def staging_graph(graph_name: str) -> str:
+    """
+    Get the name of the staging graph for a graph.
+    :param graph_name:
+    :return:
+    """
+    return STAGING_PREFIX + hashlib.sha256(graph_name.encode('utf-8')).hexdigest()
+
+
+def failed_status(result: Any) -> bool:
+    """
+    Check if the result of a write is a failed HTTP status.
+    :param result:
+    :return:
+    """
+    return isinstance(result, int) and result >= 400
+
+
+def check_status(status: Optional[int], graph_name: str) -> Optional[int]:
+    """
+    Raise when the database rejected an upload, so nothing (timestamp, digest, validators) is
+    recorded for a graph which wasn't loaded.
+    :param status:      The HTTP status of the upload, None for batch loads (which raise).
+    :param graph_name:
+    :return: The status.
+    """
+    if failed_status(status):
+        raise VocabularyLoadingException(f"Loading {graph_name} failed with status {status}")
+    return status
+
+
+def iter_gzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Compress a stream of blocks using gzip, while it is sent.
+    :param chunks:
+    :return:
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_chunks(fp: IO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Read a (text or binary) file in blocks, yielding utf-8 encoded bytes.
+    Passing this generator to requests results in a chunked transfer, so the file is never
+    fully kept in memory.
+    :param fp:          The file pointer or http response to read from.
+    :param chunk_size:  The size of the blocks to read.
+    :return:
+    """
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            return
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
 
 @dataclass
 class Credentials:
@@ -28,6 +153,8 @@ class SparqlEndpoints:
     read: str
     write: str
     http: str
+    # Accepts quads for any graph of the dataset, the SPARQL-HTTP endpoint when not set
+    dataset: Optional[str] = None
 
 
 class DatabaseConnector(ABC):
@@ -37,18 +164,30 @@ class DatabaseConnector(ABC):
 
     sparql_endpoints: SparqlEndpoints
     credentials: Credentials
+    session: requests.Session
+    # Send vocabularies with Content-Encoding: gzip, only when the store supports it
+    compress_uploads: bool = False
+    # The format the store parses fastest, sources are converted to it when enabled
+    ingest_format: str = "nt"
 
 
     def __init__(self,
                  sparql_endpoints: SparqlEndpoints,
-                 credentials: Credentials):
+                 credentials: Credentials,
+                 pool_size: int = DEFAULT_POOL_SIZE):
         """
         Create a new DatabaseConnector.
         :param sparql_endpoints: The endpoints required for interacting with SPARQL
         :param credentials: Credentials for write access on the SPARQL endpoints.
+        :param pool_size: The number of keep-alive connections to the triple store.
         """
         self.sparql_endpoints = sparql_endpoints
         self.credentials = credentials
+        self.session = requests.Session()
+        self.session.auth = (credentials.username, credentials.password)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
 
     @abstractmethod
@@ -61,26 +200,94 @@ class DatabaseConnector(ABC):
 
     @abstractmethod
     def add_vocabulary(self, graph: TextIO, graph_name: str, extension: str,
-                       append: bool = False) -> None:
+                       append: bool = False) -> Optional[int]:
         """
         Add a vocabulary to the database
         :param graph:       File
         :param graph_name:  String representing the name of the graph
         :param extension:   String representing the extension
         :param append:      Append data instead of replacing
-        :return:
+        :return: The HTTP status of the response of the database.
         """
 
 
+    def probe_repository(self) -> Optional[bool]:
+        """
+        Check the state of the triple store and the repository, using the size endpoint.
+        :return: True when the repository exists, False when the store is up but the repository
+                 doesn't exist, None when the store isn't ready yet.
+        """
+        try:
+            resp = self.session.get(f"{self.sparql_endpoints.http}/size", timeout=10)
+        except requests.RequestException:
+            return None
+        if resp.status_code == 200:
+            return True
+        if resp.status_code >= 500:
+            # Still starting (or temporarily unavailable)
+            return None
+        return False
+
+
+    def wait_until_ready(self, timeout: float = DEFAULT_READY_TIMEOUT) -> bool:
+        """
+        Wait for the triple store to accept requests, retrying with an exponential backoff.
+        :param timeout: The maximum number of seconds to wait.
+        :return: Whether the repository exists.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        while True:
+            state = self.probe_repository()
+            if state is not None:
+                return state
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DatabaseUnavailableException(
+                    f"{self.sparql_endpoints.http} not available after {timeout} seconds"
+                )
+            print(f"Triple store not ready, retrying in {delay:.1f}s")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 30)
+
+
     def check_repository_exists(self) -> bool:
         """
-        Check if the used repository exists.
+        Check if the used repository exists, waiting for the triple store to be ready.
         :return:
         """
-        resp = requests.get(f"{self.sparql_endpoints.http}/size", timeout=60)
-        if resp.status_code != 200:
-            return False
-        return True
+        return self.wait_until_ready()
+
+
+    def sparql_query(self, query: str, timeout: float = 60) -> dict:
+        """
+        Run a SPARQL SELECT query on the read endpoint.
+        :param query:
+        :param timeout: The number of seconds to wait for the results.
+        :return: The decoded SPARQL JSON results.
+        """
+        resp = self.session.post(
+            self.sparql_endpoints.read,
+            data={'query': query},
+            headers={'Accept': 'application/sparql-results+json'},
+            timeout=timeout,
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+
+    def sparql_update(self, update: str) -> None:
+        """
+        Run a SPARQL UPDATE on the write endpoint.
+        :param update:
+        :return:
+        """
+        resp = self.session.post(
+            self.sparql_endpoints.write,
+            data={'update': update},
+            timeout=60,
+        )
+        resp.raise_for_status()
 
 
     def get_loaded_vocabs(self) -> dict[str, int]:
@@ -88,22 +295,17 @@ class DatabaseConnector(ABC):
         Get all loaded vocabularies from the triple store
         :return:
         """
-        sparql = SPARQLWrapper(self.sparql_endpoints.read)
-        sparql.setHTTPAuth(BASIC)
-        sparql.setCredentials(self.credentials.username, self.credentials.password)
-        sparql.setReturnFormat(JSON)
-        q = """
+        q = f"""
             SELECT ?graph ?timestamp
-            WHERE {
-                ?graph <http://purl.org/dc/terms/modified> ?timestamp .
-                FILTER NOT EXISTS {
-                    GRAPH ?g {?graph <http://purl.org/dc/terms/modified> ?timestamp .}
-                }
-            }
+            WHERE {{
+                ?graph <{TIMESTAMP_PREDICATE}> ?timestamp .
+                FILTER NOT EXISTS {{
+                    GRAPH ?g {{?graph <{TIMESTAMP_PREDICATE}> ?timestamp .}}
+                }}
+            }}
             ORDER BY ?timestamp
         """
-        sparql.setQuery(q)
-        result = sparql.queryAndConvert()
+        result = self.sparql_query(q)
         result = result['results']['bindings']
         tmp = {}
         for line in result:
@@ -118,17 +320,7 @@ class DatabaseConnector(ABC):
         :param timestamp:
         :return:
         """
-        sparql = SPARQLWrapper(f"{self.sparql_endpoints.write}")
-        sparql.setHTTPAuth(BASIC)
-        sparql.setCredentials(self.credentials.username, self.credentials.password)
-        sparql.setMethod(POST)
-        q = """INSERT DATA {{
-            <{graph}> <http://purl.org/dc/terms/modified> {timestamp} .
-        }}"""
-        q_formatted = q.format(graph=graph_name, timestamp=timestamp)
-        print(q_formatted)
-        sparql.setQuery(q_formatted)
-        sparql.query()
+        self.write_metadata({graph_name: timestamp}, {})
 
 
     def update_timestamp(self, graph_name: str, timestamp: int) -> None:
@@ -138,23 +330,178 @@ class DatabaseConnector(ABC):
         :param timestamp:
         :return:
         """
-        sparql = SPARQLWrapper(f"{self.sparql_endpoints.write}")
-        sparql.setHTTPAuth(BASIC)
-        sparql.setCredentials(self.credentials.username, self.credentials.password)
-        sparql.setMethod(POST)
-        q = """
-        DELETE {{
-            <{graph}> <http://purl.org/dc/terms/modified> ?timestamp .
-        }}
-        INSERT {{
-            <{graph}> <http://purl.org/dc/terms/modified> {timestamp} .
-        }}
-        WHERE {{
-            <{graph}> <http://purl.org/dc/terms/modified> ?timestamp .
-        }}
+        self.write_metadata({graph_name: timestamp}, {})
+
+
+    def get_loaded_digests(self) -> dict[str, str]:
+        """
+        Get the content digests of the loaded vocabularies from the triple store
+        :return:
+        """
+        q = f"""
+            SELECT ?graph ?digest
+            WHERE {{
+                ?graph <{DIGEST_PREDICATE}> ?digest .
+                FILTER NOT EXISTS {{
+                    GRAPH ?g {{?graph <{DIGEST_PREDICATE}> ?digest .}}
+                }}
+            }}
+        """
+        result = self.sparql_query(q)
+        result = result['results']['bindings']
+        tmp = {}
+        for line in result:
+            tmp[line['graph']['value']] = line['digest']['value']
+        return tmp
+
+
+    def write_metadata(self, timestamps: dict[str, int], digests: dict[str, str]) -> None:
+        """
+        Replace the timestamps and digests of several graphs in a single SPARQL update.
+        :param timestamps:  The new timestamps, by graph name.
+        :param digests:     The new content digests, by graph name.
+        :return:
+        """
+        operations = []
+        for predicate, values in [
+            (TIMESTAMP_PREDICATE, {graph: str(int(timestamp))
+                                   for graph, timestamp in timestamps.items()}),
+            (DIGEST_PREDICATE, {graph: sparql_literal(digest)
+                                for graph, digest in digests.items()}),
+        ]:
+            if not values:
+                continue
+            rows = "\n                    ".join(
+                f"({sparql_iri(graph)} {value})" for graph, value in sorted(values.items())
+            )
+            operations.append(f"""
+            DELETE {{ ?graph {sparql_iri(predicate)} ?old . }}
+            INSERT {{ ?graph {sparql_iri(predicate)} ?new . }}
+            WHERE {{
+                VALUES (?graph ?new) {{
+                    {rows}
+                }}
+                OPTIONAL {{ ?graph {sparql_iri(predicate)} ?old . }}
+            }}""")
+        if operations:
+            self.sparql_update(" ;\n".join(operations))
+
+
+    def refresh_search_index(self, graph_names: list[str]) -> None:
+        """
+        Bring the full-text index of the store up to date with graphs which were just loaded.
+        Stores which update their index on every write don't need to do anything.
+        :param graph_names:
+        :return:
+        """
+
+
+    def move_graph(self, source: str, target: str) -> None:
+        """
+        Replace the target graph with the source graph in a single SPARQL update, so readers
+        either see the old or the new data.
+        :param source:  The graph to move, it no longer exists afterwards.
+        :param target:  The graph to replace.
+        :return:
+        """
+        self.sparql_update(f"MOVE {sparql_iri(source)} TO {sparql_iri(target)}")
+
+
+    def graph_params(self, graph_name: str) -> dict:
+        """
+        Get the query parameters selecting a graph on the SPARQL-HTTP endpoint.
+        :param graph_name:
+        :return:
+        """
+        return {'graph': graph_name}
+
+
+    def add_vocabulary_batch(self, content: bytes, graph_name: str, extension: str,
+                             append: bool = False) -> None:
+        """
+        Send one batch of a vocabulary to the SPARQL-HTTP endpoint.
+        :param content:     The serialized batch.
+        :param graph_name:  String representing the name of the graph
+        :param extension:   String representing the extension
+        :param append:      Append data instead of replacing
+        :return:
+        """
+        response = self.sparql_http_update(content, extension, self.graph_params(graph_name),
+                                           append)
+        if response.status_code >= 400:
+            raise VocabularyLoadingException(
+                f"Batch for {graph_name} failed with {response.status_code}: "
+                f"{response.text[:200]}"
+            )
+
+
+    def add_vocabulary_parts(self, parts: list[tuple[Any, str]], graph_name: str) -> Optional[int]:
+        """
+        Replace a graph with several files, e.g. a source and its tweaks. This sends a request per
+        file, databases with transactions override it to add the files in a single transaction.
+        :param parts:       The files with their extensions, in the order they are added.
+        :param graph_name:  String representing the name of the graph
+        :return: The HTTP status of the last request, or of the first which failed.
+        """
+        status = None
+        for index, (content, extension) in enumerate(parts):
+            status = self.add_vocabulary(content, graph_name, extension, index > 0)
+            if status is not None and status >= 400:
+                break
+        return status
+
+
+    def _request_body(self, content, extension: str) -> tuple[Any, dict]:
+        """
+        Prepare the data of an upload, compressing it when enabled.
+        :param content:     The data to send. File pointers are streamed using chunked transfer.
+        :param extension:   String representing the extension
+        :return: The data and the headers of the request.
+        """
+        headers = {
+            'Content-Type': get_type(extension)
+        }
+
+        if hasattr(content, 'read'):
+            content = iter_chunks(content)
+        if self.compress_uploads:
+            headers['Content-Encoding'] = 'gzip'
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            content = iter_gzip([content] if isinstance(content, bytes) else content)
+        return content, headers
+
+
+    def graph_contents(self, graph_name: str) -> Iterator[bytes]:
+        """
+        Read a graph from the SPARQL-HTTP endpoint as N-Triples, while it is downloaded.
+        :param graph_name:
+        :return:
         """
-        sparql.setQuery(q.format(graph=graph_name, timestamp=timestamp))
-        sparql.query()
+        with self.session.get(self.sparql_endpoints.http, params=self.graph_params(graph_name),
+                              headers={'Accept': get_type("nt")}, stream=True,
+                              timeout=60) as response:
+            response.raise_for_status()
+            yield from response.iter_content(CHUNK_SIZE)
+
+
+    def add_dataset(self, content: Iterable[bytes], extension: str = "nq",
+                    timeout: float = DEFAULT_DATASET_TIMEOUT) -> int:
+        """
+        Add quads to several graphs in a single request. The graphs are not cleared first, so
+        this is meant for filling an empty store.
+        :param content:     The serialized quads, streamed using chunked transfer.
+        :param extension:   String representing the extension
+        :param timeout:     The number of seconds to wait for the response.
+        :return: The HTTP status of the response of the database.
+        """
+        content, headers = self._request_body(content, extension)
+        endpoint = self.sparql_endpoints.dataset or self.sparql_endpoints.http
+        response = self.session.post(endpoint, data=content, headers=headers, timeout=timeout)
+        print(f"RESPONSE: {response.status_code}")
+        if response.status_code >= 400:
+            print(response.content[:200])
+        return response.status_code
 
 
     def sparql_http_update(self, content, extension, params, append: bool = False):
@@ -162,21 +509,93 @@ class DatabaseConnector(ABC):
         Perform an update to the SPARQL-HTTP endpoint for adding a vocabulary
         :param append:
         :param extension:
-        :param content:
+        :param content: The data to send. File pointers are streamed using chunked transfer.
         :param params:
         :return:
         """
-        headers = {
-            'Content-Type': get_type(extension)
-        }
-
-        method = requests.post if append else requests.put
+        content, headers = self._request_body(content, extension)
+        method = self.session.post if append else self.session.put
 
         return method(
             f"{self.sparql_endpoints.http}",
             data=content,
             headers=headers,
-            auth=(self.credentials.username, self.credentials.password),
             params=params,
             timeout=60,
         )
+
+
+class MetadataWriter:
+    """
+    Collects the timestamp and digest changes of a run, writing them in as few updates as possible.
+    """
+
+    database: DatabaseConnector
+    flush_size: int
+
+    def __init__(self, database: DatabaseConnector, flush_size: int = 0,
+                 metrics: Optional[RunMetrics] = None, touch_unchanged: bool = False):
+        """
+        Create a new MetadataWriter.
+        :param database:    The database to write the metadata to.
+        :param flush_size:  Write the changes once this many graphs changed. 0 only writes them
+                            when flush is called.
+        :param metrics:     Records the time spent writing the metadata.
+        :param touch_unchanged: Update the timestamp of vocabularies which didn't change.
+        """
+        self.database = database
+        self.flush_size = flush_size
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.touch_unchanged = touch_unchanged
+        self._timestamps: dict[str, int] = {}
+        self._digests: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+
+    def set_timestamp(self, graph_name: str, timestamp: int,
+                      digest: Optional[str] = None) -> None:
+        """
+        Queue a new timestamp (and optionally content digest) for a graph.
+        :param graph_name:
+        :param timestamp:
+        :param digest:
+        :return:
+        """
+        with self._lock:
+            self._timestamps[graph_name] = timestamp
+            if digest is not None:
+                self._digests[graph_name] = digest
+        self._flush_if_full()
+
+
+    def touch(self, graph_name: str, timestamp: int) -> None:
+        """
+        Queue a new timestamp for a graph which didn't change, when enabled.
+        :param graph_name:
+        :param timestamp:
+        :return:
+        """
+        if self.touch_unchanged:
+            self.set_timestamp(graph_name, timestamp)
+
+
+    def _flush_if_full(self) -> None:
+        with self._lock:
+            pending = len(set(self._timestamps) | set(self._digests))
+        if 0 < self.flush_size <= pending:
+            self.flush()
+
+
+    def flush(self) -> None:
+        """
+        Write all queued changes to the database.
+        :return:
+        """
+        with self._lock:
+            timestamps, self._timestamps = self._timestamps, {}
+            digests, self._digests = self._digests, {}
+        if timestamps or digests:
+            graphs = len(set(timestamps) | set(digests))
+            print(f"Writing metadata for {graphs} graph(s)")
+            with self.metrics.phase("timestamps", vocabulary="", graphs=graphs):
+                self.database.write_metadata(timestamps, digests)
@@ -2,26 +2,50 @@
 This file contains functions for interacting with Fuseki
 """
 import os
-from typing import TextIO
+import uuid
+from typing import Any, Iterator, Optional, TextIO
 
-import requests
+from src.database import (
+    DatabaseConnector, SparqlEndpoints, Credentials, DEFAULT_POOL_SIZE, iter_chunks
+)
+from src.vocabularies import get_type
 
-from src.database import DatabaseConnector, SparqlEndpoints, Credentials
 
-
-def create_connector() -> DatabaseConnector:
+def create_connector(endpoint: Optional[str] = None) -> DatabaseConnector:
     """
     Create instance
+    :param endpoint: The base of the dataset, STORE_BASE (or SPARQL_ENDPOINT) when not given.
     :return:
     """
     sparql_endpoint = os.environ.get("SPARQL_ENDPOINT", "")
-    store_base = os.environ.get("STORE_BASE", sparql_endpoint)
+    store_base = endpoint or os.environ.get("STORE_BASE", sparql_endpoint)
     return Fuseki(
         store_base,
         os.environ.get("ADMIN_USERNAME", "admin"), # Fuseki default username
-        os.environ.get("ADMIN_PASSWORD", "")
+        os.environ.get("ADMIN_PASSWORD", ""),
+        int(os.environ.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE))
     )
 
+def multipart_blocks(parts: list[tuple[Any, str]], boundary: str) -> Iterator[bytes]:
+    """
+    Stream several files as a multipart/form-data body, with a part per file.
+    :param parts:       The files (or their blocks) with their extensions.
+    :param boundary:
+    :return:
+    """
+    for index, (content, extension) in enumerate(parts):
+        # Fuseki reads the format from the content type, or else from the file name
+        yield (f"--{boundary}\r\n"
+               f"Content-Disposition: form-data; name=\"file\"; "
+               f"filename=\"part{index}.{extension}\"\r\n"
+               f"Content-Type: {get_type(extension)}\r\n\r\n").encode('utf-8')
+        if hasattr(content, 'read'):
+            content = iter_chunks(content)
+        yield from [content] if isinstance(content, bytes) else content
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+
 class Fuseki(DatabaseConnector):
     """
     Fuseki database connector
@@ -29,24 +53,27 @@ class Fuseki(DatabaseConnector):
 
     fuseki_base: str
 
-    def __init__(self, fuseki_base, username, password):
+    def __init__(self, fuseki_base, username, password, pool_size=DEFAULT_POOL_SIZE):
         """
         Create a new Fuseki DatabaseConnector
         :param fuseki_base:
         :param username:
         :param password:
+        :param pool_size:
         """
         self.fuseki_base = fuseki_base
         sparql_endpoints = SparqlEndpoints(
             read=f"{fuseki_base}/sparql",
             write=f"{fuseki_base}/update",
             http=f"{fuseki_base}/data",
+            # Fuseki accepts quads on the dataset itself
+            dataset=fuseki_base,
         )
         credentials = Credentials(
             username=username,
             password=password
         )
-        super().__init__(sparql_endpoints, credentials)
+        super().__init__(sparql_endpoints, credentials, pool_size)
 
 
     def setup(self) -> None:
@@ -58,9 +85,8 @@ class Fuseki(DatabaseConnector):
         if not self.check_repository_exists():
             # Fuseki repository not created yet -- create it
             base_endpoint = '/'.join(self.fuseki_base.split('/')[:-1])
-            requests.post(
+            self.session.post(
                 f"{base_endpoint}/$/datasets",
-                auth=(self.credentials.username, self.credentials.password),
                 params={'dbName': 'skosmos', 'dbType': 'tdb'},
                 timeout=60
             )
@@ -70,25 +96,42 @@ class Fuseki(DatabaseConnector):
 
 
     def add_vocabulary(self, graph: TextIO, graph_name: str, extension: str,
-                       append: bool = False) -> None:
+                       append: bool = False) -> int:
         """
         Add a vocabulary to Fuseki
         :param graph:       File
         :param graph_name:  String representing the name of the graph
         :param extension:   String representing the extension
         :param append:      Append data instead of replacing
-        :return:
+        :return: The HTTP status of the response.
         """
         print(f"[Fuseki] Adding vocabulary {graph_name}")
-        try:
-            content = graph.read().encode('utf-8')
-        except (UnicodeDecodeError, AttributeError):
-            content = graph.read()
-
-        response = self.sparql_http_update(content, extension,{'graph': f"{graph_name}"},
+        response = self.sparql_http_update(graph, extension, self.graph_params(graph_name),
                                            append)
 
         print(f"RESPONSE: {response.status_code}")
         if response.status_code >= 400:
             print()
             print(response.content)
+        return response.status_code
+
+
+    def add_vocabulary_parts(self, parts: list[tuple[Any, str]], graph_name: str) -> int:
+        """
+        Replace a graph with several files in a single multipart request. Fuseki parses every
+        part in the same write transaction, so readers never see the graph partially loaded.
+        :param parts:       The files with their extensions, in the order they are added.
+        :param graph_name:  String representing the name of the graph
+        :return: The HTTP status of the response.
+        """
+        print(f"[Fuseki] Adding vocabulary {graph_name} in a single request")
+        boundary = uuid.uuid4().hex
+        content, headers = self._request_body(multipart_blocks(parts, boundary), "nt")
+        headers['Content-Type'] = f"multipart/form-data; boundary={boundary}"
+        response = self.session.put(self.sparql_endpoints.http, data=content, headers=headers,
+                                    params=self.graph_params(graph_name), timeout=60)
+        print(f"RESPONSE: {response.status_code}")
+        if response.status_code >= 400:
+            print()
+            print(response.content)
+        return response.status_code
@@ -2,36 +2,55 @@
 This file contains functions for interacting with GraphDB
 """
 import os
-from typing import TextIO
+from pathlib import Path
+from typing import Any, Optional, TextIO
+from urllib.parse import urljoin
 
 import requests
 
-from src.database import DatabaseConnector, SparqlEndpoints, Credentials
+from src.database import (
+    DatabaseConnector, SparqlEndpoints, Credentials, DEFAULT_POOL_SIZE, sparql_iri
+)
 
+# The repository config, next to the src directory (/app in the container)
+REPOSITORY_CONFIG = Path(__file__).resolve().parents[2] / "skosmos-repository.ttl"
 
-def create_connector() -> DatabaseConnector:
+# Namespace of the GraphDB full-text search (Lucene) plugin
+LUCENE_NAMESPACE = "http://www.ontotext.com/owlim/lucene#"
+
+
+def create_connector(endpoint: Optional[str] = None) -> DatabaseConnector:
     """
     Create instance
+    :param endpoint: The SPARQL endpoint of the repository, SPARQL_ENDPOINT when not given.
     :return:
     """
-    sparql_endpoint = os.environ.get("SPARQL_ENDPOINT", "")
-    return GraphDB(
+    sparql_endpoint = endpoint or os.environ.get("SPARQL_ENDPOINT", "")
+    connector = GraphDB(
         sparql_endpoint,
         os.environ.get("ADMIN_USERNAME", ""), # GraphDB has no default username/password
-        os.environ.get("ADMIN_PASSWORD", "")
+        os.environ.get("ADMIN_PASSWORD", ""),
+        int(os.environ.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE))
     )
+    connector.lucene_index = os.environ.get("GRAPHDB_LUCENE_INDEX") or None
+    return connector
 
 
 class GraphDB(DatabaseConnector):
     """
     GraphDB database connector
     """
-    def __init__(self, endpoint, username, password):
+
+    # The name of the Lucene full-text index, which is refreshed after loading
+    lucene_index: Optional[str] = None
+
+    def __init__(self, endpoint, username, password, pool_size=DEFAULT_POOL_SIZE):
         """
         Construct GraphDB DatabaseConnector
         :param endpoint:
         :param username:
         :param password:
+        :param pool_size:
         """
         sparql_endpoints = SparqlEndpoints(
             read=endpoint,
@@ -39,7 +58,8 @@ class GraphDB(DatabaseConnector):
             http=f"{endpoint}/statements"
         )
         super().__init__(sparql_endpoints,
-                         Credentials(username=username, password=password))
+                         Credentials(username=username, password=password),
+                         pool_size)
 
 
     def setup(self) -> None:
@@ -52,12 +72,11 @@ class GraphDB(DatabaseConnector):
             headers = {
                 'Content-Type': 'text/turtle',
             }
-            with open("/app/skosmos-repository.ttl", "rb") as fp:
-                requests.put(
+            with open(REPOSITORY_CONFIG, "rb") as fp:
+                self.session.put(
                     f"{self.sparql_endpoints.read}",
                     headers=headers,
                     data=fp,
-                    auth=(self.credentials.username, self.credentials.password),
                     timeout=60
                 )
             print(f"CREATED GRAPHDB[{self.sparql_endpoints.http}] DB[skosmos.tdb]")
@@ -65,26 +84,104 @@ class GraphDB(DatabaseConnector):
             print(f"EXISTS GRAPHDB [{self.sparql_endpoints.http}]]")
 
 
+    def graph_params(self, graph_name: str) -> dict:
+        """
+        GraphDB selects the graph using the 'context' parameter.
+        :param graph_name:
+        :return:
+        """
+        return {'context': f"<{graph_name}>"}
+
+
     def add_vocabulary(self, graph: TextIO, graph_name: str, extension: str,
-                       append: bool = False) -> None:
+                       append: bool = False) -> int:
         """
         Add a vocabulary to GraphDB
         :param graph:       File
         :param graph_name:  String representing the name of the graph
         :param extension:   String representing the extension
         :param append:      Append data instead of replacing
-        :return:
+        :return: The HTTP status of the response.
         """
         print(f"[GraphDB] Adding vocabulary {graph_name}")
-        content = graph.read()
-        try:
-            content = content.encode('utf-8')
-        except (UnicodeDecodeError, AttributeError):
-            pass
-
-        response = self.sparql_http_update(content, extension,{'context': f"<{graph_name}>"},
+        response = self.sparql_http_update(graph, extension, self.graph_params(graph_name),
                                            append)
 
         print(f"RESPONSE: {response.status_code}")
         if response.status_code != 200:
             print(response.content)
+        return response.status_code
+
+
+    def refresh_search_index(self, graph_names: list[str]) -> None:
+        """
+        Add the resources of the loaded graphs to the Lucene full-text index, when one is
+        configured. The resources of other graphs aren't indexed again.
+        :param graph_names:
+        :return:
+        """
+        if self.lucene_index is None:
+            return
+        index = sparql_iri(f"{LUCENE_NAMESPACE}{self.lucene_index}")
+        for graph_name in graph_names:
+            print(f"[GraphDB] Refreshing the {self.lucene_index} index for {graph_name}")
+            self.sparql_update(f"""
+                INSERT {{ {index} <{LUCENE_NAMESPACE}addToIndex> ?resource . }}
+                WHERE {{
+                    GRAPH {sparql_iri(graph_name)} {{ ?resource ?p ?o . }}
+                    FILTER(isIRI(?resource))
+                }}""")
+
+
+    def _transaction_action(self, transaction: str, action: str, content=None,
+                            headers: Optional[dict] = None,
+                            params: Optional[dict] = None) -> requests.Response:
+        """
+        Perform an action in a transaction of the RDF4J REST API.
+        :param transaction: The location of the transaction.
+        :param action:      E.g. ADD, UPDATE or COMMIT.
+        :param content:     The body of the request, if any.
+        :param headers:
+        :param params:      Additional query parameters.
+        :return:
+        """
+        return self.session.put(transaction, params={'action': action, **(params or {})},
+                                data=content, headers=headers, timeout=60)
+
+
+    def add_vocabulary_parts(self, parts: list[tuple[Any, str]], graph_name: str) -> int:
+        """
+        Replace a graph with several files in a single transaction, so GraphDB commits and
+        indexes the graph once, and readers never see it partially loaded.
+        :param parts:       The files with their extensions, in the order they are added.
+        :param graph_name:  String representing the name of the graph
+        :return: The HTTP status of the first request which failed, or of the commit.
+        """
+        print(f"[GraphDB] Adding vocabulary {graph_name} in a transaction")
+        response = self.session.post(f"{self.sparql_endpoints.read}/transactions", timeout=60)
+        if response.status_code >= 400:
+            print(response.content)
+            return response.status_code
+        transaction = urljoin(f"{self.sparql_endpoints.read}/", response.headers['Location'])
+        committed = False
+        try:
+            response = self._transaction_action(
+                transaction, "UPDATE", f"CLEAR SILENT GRAPH {sparql_iri(graph_name)}",
+                {'Content-Type': 'application/sparql-update'})
+            for content, extension in parts:
+                if response.status_code >= 400:
+                    break
+                content, headers = self._request_body(content, extension)
+                response = self._transaction_action(transaction, "ADD", content, headers,
+                                                    self.graph_params(graph_name))
+            if response.status_code < 400:
+                response = self._transaction_action(transaction, "COMMIT")
+                committed = response.status_code < 400
+        finally:
+            if not committed:
+                self.session.delete(transaction, timeout=60)
+
+        print(f"RESPONSE: {response.status_code}")
+        if not committed:
+            print(response.content)
+        return response.status_code
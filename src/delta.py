@@ -0,0 +1,255 @@
+"""
+This file contains functions for loading vocabularies as a delta against the previously loaded data.
+"""
+import gzip
+import hashlib
+import heapq
+import os
+import tempfile
+import threading
+from contextlib import ExitStack
+from dataclasses import dataclass
+from itertools import islice
+from typing import IO, Callable, Iterable, Iterator, Optional
+
+from src.database import DatabaseConnector, sparql_iri
+from src.vocabularies import decode_lines
+
+DELTA_FORMATS = ["nt", "ntriples"]
+
+# Number of lines sorted in memory at once when sorting a vocabulary
+SORT_CHUNK_LINES = 500000
+
+
+@dataclass
+class DeltaSettings:
+    """
+    Settings for loading vocabularies as deltas.
+    """
+    snapshot_dir: str
+    enabled: bool = False
+    # Replace the whole graph when more than this fraction of the triples changed
+    max_fraction: float = 0.1
+    # Number of triples per SPARQL update
+    batch_size: int = 10000
+
+
+def canonical_lines(fp: IO) -> Iterator[str]:
+    """
+    Read the triples of an N-Triples file, one per line in a canonical form.
+    :param fp:
+    :return:
+    """
+    for line in decode_lines(fp):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield line.rstrip('.').rstrip() + ' .\n'
+
+
+def sort_unique(lines: Iterable[str], work_dir: str) -> Iterator[str]:
+    """
+    Sort lines and remove duplicates, using temporary files for large inputs.
+    :param lines:
+    :param work_dir: Directory for the temporary files.
+    :return:
+    """
+    lines = iter(lines)
+    runs = []
+    while True:
+        chunk = sorted(islice(lines, SORT_CHUNK_LINES))
+        if not chunk:
+            break
+        path = os.path.join(work_dir, f"run-{len(runs)}")
+        with open(path, 'w', encoding='utf-8') as run:
+            run.writelines(chunk)
+        runs.append(path)
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(path, encoding='utf-8')) for path in runs]
+        previous = None
+        for line in heapq.merge(*files):
+            if line != previous:
+                yield line
+                previous = line
+
+
+def diff_sorted(old: Iterable[str], new: Iterable[str]) -> Iterator[tuple[bool, str]]:
+    """
+    Compare two sorted sequences of lines.
+    :param old:
+    :param new:
+    :return: Tuples of (added, line), added is False for removed lines.
+    """
+    old_iter = iter(old)
+    new_iter = iter(new)
+    old_line = next(old_iter, None)
+    new_line = next(new_iter, None)
+    while old_line is not None or new_line is not None:
+        if new_line is None or (old_line is not None and old_line < new_line):
+            yield False, old_line
+            old_line = next(old_iter, None)
+        elif old_line is None or new_line < old_line:
+            yield True, new_line
+            new_line = next(new_iter, None)
+        else:
+            old_line = next(old_iter, None)
+            new_line = next(new_iter, None)
+
+
+def has_blank_nodes(line: str) -> bool:
+    """
+    Check if an N-Triples line (possibly) contains blank nodes, which can't be used in a delta.
+    :param line:
+    :return:
+    """
+    return line.startswith('_:') or ' _:' in line
+
+
+def snapshot_path(settings: DeltaSettings, graph_name: str) -> str:
+    """
+    Get the location of the snapshot of a graph.
+    :param settings:
+    :param graph_name:
+    :return:
+    """
+    key = hashlib.sha256(graph_name.encode('utf-8')).hexdigest()
+    return os.path.join(settings.snapshot_dir, f"{key}.nt.gz")
+
+
+def forget_snapshot(settings: DeltaSettings, graph_name: str) -> None:
+    """
+    Remove the snapshot of a graph, because the graph was replaced without a delta.
+    :param settings:
+    :param graph_name:
+    :return:
+    """
+    path = snapshot_path(settings, graph_name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class DeltaLoader:
+    """
+    Loads an N-Triples vocabulary as a delta against a local snapshot of the loaded triples.
+    """
+
+    database: DatabaseConnector
+    settings: DeltaSettings
+    graph_name: str
+
+    def __init__(self, database: DatabaseConnector, settings: DeltaSettings, graph_name: str):
+        """
+        Create a new DeltaLoader.
+        :param database:    The database connector.
+        :param settings:    The delta settings.
+        :param graph_name:  The graph to load the vocabulary into.
+        """
+        self.database = database
+        self.settings = settings
+        self.graph_name = graph_name
+        os.makedirs(settings.snapshot_dir, exist_ok=True)
+        self._new_snapshot = f"{snapshot_path(settings, graph_name)}.{threading.get_ident()}.tmp"
+
+
+    def load(self, fp: IO, full_load: Callable[[IO], None]) -> bool:
+        """
+        Load the vocabulary, sending only the changed triples when possible.
+        Call commit once the graph is complete, to keep the snapshot for the next delta.
+        :param fp:          The opened N-Triples vocabulary.
+        :param full_load:   Called with the (sorted) vocabulary when the graph has to be replaced.
+        :return: Whether the delta was applied to the graph. Otherwise full_load was called.
+        """
+        total = 0
+        blank_nodes = False
+        with tempfile.TemporaryDirectory() as work_dir:
+            with gzip.open(self._new_snapshot, 'wt', encoding='utf-8', compresslevel=1) as new:
+                for line in sort_unique(canonical_lines(fp), work_dir):
+                    new.write(line)
+                    total += 1
+                    blank_nodes = blank_nodes or has_blank_nodes(line)
+
+        changes = self._count_changes()
+        if blank_nodes or changes is None or changes > self.settings.max_fraction * total:
+            if blank_nodes:
+                reason = "blank nodes"
+            elif changes is None:
+                reason = "no snapshot"
+            else:
+                reason = f"{changes} changes of {total} triples"
+            print(f"Replacing {self.graph_name} instead of sending a delta ({reason})")
+            forget_snapshot(self.settings, self.graph_name)
+            with gzip.open(self._new_snapshot, 'rb') as new:
+                full_load(new)
+            if blank_nodes:
+                # A later delta can't remove the triples with blank nodes from the graph
+                self.discard()
+            return False
+
+        print(f"Sending delta of {changes} triples to {self.graph_name}")
+        self._send_delta()
+        return True
+
+
+    def _count_changes(self) -> Optional[int]:
+        """
+        Count the changed triples, None when there is no snapshot to compare to.
+        """
+        if not os.path.exists(snapshot_path(self.settings, self.graph_name)):
+            return None
+        with gzip.open(snapshot_path(self.settings, self.graph_name), 'rt',
+                       encoding='utf-8') as old, \
+                gzip.open(self._new_snapshot, 'rt', encoding='utf-8') as new:
+            return sum(1 for _ in diff_sorted(old, new))
+
+
+    def _send_delta(self) -> None:
+        """
+        Send the changes as batches of DELETE DATA / INSERT DATA updates.
+        """
+        graph = sparql_iri(self.graph_name)
+        removed: list[str] = []
+        added: list[str] = []
+
+        def flush() -> None:
+            operations = []
+            if removed:
+                operations.append(f"DELETE DATA {{ GRAPH {graph} {{\n{''.join(removed)}}} }}")
+            if added:
+                operations.append(f"INSERT DATA {{ GRAPH {graph} {{\n{''.join(added)}}} }}")
+            if operations:
+                # Both in a single request, so a small delta is applied atomically
+                self.database.sparql_update(" ;\n".join(operations))
+            removed.clear()
+            added.clear()
+
+        # The graph no longer matches the old snapshot when this fails halfway
+        old_snapshot = f"{self._new_snapshot}.old"
+        os.replace(snapshot_path(self.settings, self.graph_name), old_snapshot)
+        try:
+            with gzip.open(old_snapshot, 'rt', encoding='utf-8') as old, \
+                    gzip.open(self._new_snapshot, 'rt', encoding='utf-8') as new:
+                for is_added, line in diff_sorted(old, new):
+                    (added if is_added else removed).append(line)
+                    if len(added) + len(removed) >= self.settings.batch_size:
+                        flush()
+            flush()
+        finally:
+            os.remove(old_snapshot)
+
+
+    def commit(self) -> None:
+        """
+        Keep the snapshot of this load for the next delta, once the graph is completely loaded.
+        :return:
+        """
+        if os.path.exists(self._new_snapshot):
+            os.replace(self._new_snapshot, snapshot_path(self.settings, self.graph_name))
+
+
+    def discard(self) -> None:
+        """
+        Remove the snapshot of this load when it wasn't committed, because loading the graph failed.
+        :return:
+        """
+        if os.path.exists(self._new_snapshot):
+            os.remove(self._new_snapshot)
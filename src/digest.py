@@ -0,0 +1,61 @@
+"""
+This file contains functions for computing the content digest of a vocabulary.
+"""
+import tempfile
+from contextlib import ExitStack
+from typing import IO, Optional
+
+from src.database import iter_chunks
+
+# Spooled files stay in memory up to this size, larger ones are moved to a temporary file
+SPOOL_MEMORY = 8 * 1024 * 1024
+
+
+class DigestSpool(tempfile.SpooledTemporaryFile):
+    """
+    A spooled part of a vocabulary, identified by the digest of the data up to its end.
+    """
+
+    # Identifies the version of the data, e.g. for resuming a batch load (see source_identity)
+    content_digest: Optional[str] = None
+
+
+def create_spool() -> DigestSpool:
+    """
+    Create a temporary file for buffering a vocabulary.
+    :return:
+    """
+    return DigestSpool(max_size=SPOOL_MEMORY)
+
+
+def copy_with_digest(source: IO, dest: IO, digest, label: str) -> None:
+    """
+    Copy a file to a spool file, updating the digest with its contents.
+    :param source:  The file pointer or http response to read from.
+    :param dest:    The (binary) file to copy the contents to. It is rewound afterwards.
+    :param digest:  A hashlib hash object.
+    :param label:   Separates this part from the others in the digest (e.g. 'source:ttl').
+    :return:
+    """
+    digest.update(f"\0{label}\0".encode('utf-8'))
+    for chunk in iter_chunks(source):
+        digest.update(chunk)
+        dest.write(chunk)
+    dest.seek(0)
+
+
+def spool_with_digest(stack: ExitStack, source: IO, digest, label: str) -> IO:
+    """
+    Copy a file to a new spool file, updating the digest with its contents. Both files are closed
+    with the stack.
+    :param stack:
+    :param source:  The file pointer or http response to read from.
+    :param digest:  A hashlib hash object.
+    :param label:   Separates this part from the others in the digest (e.g. 'source:ttl').
+    :return: The rewound spool file.
+    """
+    stack.enter_context(source)
+    spool = stack.enter_context(create_spool())
+    copy_with_digest(source, spool, digest, label)
+    spool.content_digest = digest.copy().hexdigest()
+    return spool
@@ -14,6 +14,18 @@ class VocabularyLoadingException(Exception):
     """
 
 
+class VocabularyNotModifiedException(Exception):
+    """
+    Exception raised when a remote source reports that the vocabulary didn't change.
+    """
+
+
+class DatabaseUnavailableException(Exception):
+    """
+    Exception raised when the triple store doesn't become available in time.
+    """
+
+
 class UnknownAuthenticationTypeException(InvalidConfigurationException):
     """
     Exception raised when the authentication type specified is not known.
@@ -0,0 +1,161 @@
+"""
+This file contains the hedging of slow sources: when a source is slow to respond, its fallback is
+downloaded at the same time, and the first complete download is loaded.
+"""
+import queue
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from typing import IO, Callable, Optional
+
+from src.database import iter_chunks
+from src.exceptions import VocabularyLoadingException, VocabularyNotModifiedException
+from src.prefetch import SpooledSource
+
+# Size of the blocks read while downloading, small enough to measure the progress of slow sources
+HEDGE_CHUNK_SIZE = 8 * 1024
+
+
+class HedgedDownload:
+    """
+    Downloads a source into a spool file in a background thread, keeping track of its progress.
+    """
+
+    def __init__(self, name: str, open_source: Callable[[], tuple[dict, IO]],
+                 spool_dir: Optional[str] = None):
+        """
+        Create a new HedgedDownload.
+        :param name:        The name of the source in the log, e.g. 'source' or 'fallback'.
+        :param open_source: Opens the source, returning its configuration and the opened file.
+        :param spool_dir:   Directory of the spool file, None uses the default temporary directory.
+        """
+        self.name = name
+        self.bytes_read = 0
+        self.cancelled = False
+        self._open_source = open_source
+        self._spool_dir = spool_dir
+        # The completed download, until it is taken from the queue
+        self._result: Optional[tuple[dict, IO]] = None
+        self._lock = threading.Lock()
+
+
+    def start(self, results: queue.Queue) -> None:
+        """
+        Start downloading in a daemon thread, which doesn't keep the run from exiting when it is
+        stuck on a stalled source. The download is put in the queue with its result or whatever
+        it raised, so the caller never waits for a thread which died.
+        :param results:
+        :return:
+        """
+        def run() -> None:
+            try:
+                result = self.download()
+            except Exception as e:  # pylint: disable=broad-except
+                results.put((self, None, e))
+                return
+            with self._lock:
+                if self.cancelled:
+                    result[1].close()
+                    return
+                self._result = result
+            results.put((self, result, None))
+
+        threading.Thread(target=run, name=f"hedge-{self.name}", daemon=True).start()
+
+
+    def download(self) -> tuple[dict, IO]:
+        """
+        Open the source and copy it to a spool file. The spool file is removed and the source is
+        closed when the download fails or is cancelled, a stalled source fails after the
+        SOURCE_TIMEOUT of its request.
+        :return: The source configuration which was used and the spooled source.
+        """
+        source_data, fp = self._open_source()
+        with ExitStack() as stack:
+            stack.enter_context(fp)
+            if self.cancelled:
+                raise VocabularyLoadingException(f"Download of the {self.name} was cancelled")
+            spool = stack.enter_context(tempfile.TemporaryFile(dir=self._spool_dir))
+            for chunk in iter_chunks(fp, HEDGE_CHUNK_SIZE):
+                if self.cancelled:
+                    raise VocabularyLoadingException(f"Download of the {self.name} was cancelled")
+                spool.write(chunk)
+                self.bytes_read += len(chunk)
+            spool.seek(0)
+            # Only the spool file is kept open, closing the source finishes its fetch metrics
+            stack.pop_all()
+        fp.close()
+        return source_data, SpooledSource(spool, fp, True)
+
+
+    def cancel(self) -> None:
+        """
+        Stop the download at the next block it receives, or remove it when it is complete. The
+        source isn't closed here, since that waits for a read in the download thread to return.
+        :return:
+        """
+        with self._lock:
+            self.cancelled = True
+            if self._result is not None:
+                self._result[1].close()
+
+
+def is_slow(download: HedgedDownload, deadline: float, min_throughput: int) -> bool:
+    """
+    Check if a download is too slow to wait for, at the hedging deadline.
+    :param download:
+    :param deadline:        The number of seconds since the download started.
+    :param min_throughput:  The minimum bytes per second, 0 only requires the first bytes.
+    :return:
+    """
+    return download.bytes_read == 0 or download.bytes_read < min_throughput * deadline
+
+
+def hedged_source(primary: HedgedDownload, fallback: HedgedDownload, deadline: float,
+                  min_throughput: int = 0) -> tuple[HedgedDownload, tuple[dict, IO]]:
+    """
+    Download a source, and its fallback at the same time when the source is slow by the deadline
+    or fails. The first complete download wins, the other one is cancelled.
+    :param primary:         The download of the source.
+    :param fallback:        The download of the fallback, it is only started when needed.
+    :param deadline:        The number of seconds the source gets before hedging.
+    :param min_throughput:  The bytes per second the source must reach by the deadline.
+    :return: The download which won, and its source configuration and spooled source.
+    """
+    results: queue.Queue = queue.Queue()
+    started: list[HedgedDownload] = []
+    running: list[HedgedDownload] = []
+
+    def start(download: HedgedDownload) -> None:
+        download.start(results)
+        started.append(download)
+        running.append(download)
+
+    start(primary)
+    hedge_at: Optional[float] = time.monotonic() + deadline
+    while True:
+        try:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            download, result, error = results.get(timeout=timeout)
+        except queue.Empty:
+            hedge_at = None
+            if is_slow(primary, deadline, min_throughput):
+                print(f"Source is slow ({primary.bytes_read} bytes after {deadline}s), "
+                      f"downloading the fallback as well")
+                start(fallback)
+            continue
+        running.remove(download)
+        if error is None or isinstance(error, VocabularyNotModifiedException):
+            for other in running:
+                other.cancel()
+            if error is not None:
+                raise error
+            return download, result
+        print(f"Download of the {download.name} failed: {error.__cause__ or error}")
+        if fallback not in started:
+            # A failing source falls back without waiting for the deadline
+            hedge_at = None
+            start(fallback)
+        if not running:
+            raise error
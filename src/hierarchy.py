@@ -0,0 +1,258 @@
+"""
+This file contains the materialization of the SKOS hierarchy of a vocabulary while it is loaded:
+the inverse broader/narrower links, the transitive closure of skos:broader and the top concept
+links are added to the store, so Skosmos doesn't have to evaluate property paths on every page.
+"""
+import re
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Optional, Union
+
+from src.bulk import encode_blocks
+from src.convert import NTRIPLES_FORMATS
+from src.database import DatabaseConnector, sparql_iri
+from src.exceptions import InvalidConfigurationException
+from src.metrics import CountingReader
+
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+BROADER = f"<{SKOS}broader>"
+NARROWER = f"<{SKOS}narrower>"
+BROADER_TRANSITIVE = f"<{SKOS}broaderTransitive>"
+TOP_CONCEPT_OF = f"<{SKOS}topConceptOf>"
+HAS_TOP_CONCEPT = f"<{SKOS}hasTopConcept>"
+
+# An N-Triples statement linking two IRIs
+IRI_TRIPLE = re.compile(r'^\s*(<[^>]*>)\s+(<[^>]*>)\s+(<[^>]*>)\s*\.\s*$')
+
+# Seconds to wait for the links of a graph, when they're read back from the store
+HIERARCHY_QUERY_TIMEOUT = 300
+
+
+@dataclass
+class HierarchySettings:
+    """
+    Settings for materializing the SKOS hierarchy of vocabularies.
+    """
+    enabled: bool = False
+    # Added to the graph name for a companion graph with the derived triples, which are added to
+    # the graph itself when empty
+    graph_suffix: str = ""
+
+
+    def graph(self, graph_name: str, target: str) -> str:
+        """
+        Get the graph the derived triples are added to.
+        :param graph_name:  The graph Skosmos reads the vocabulary from.
+        :param target:      The graph the vocabulary was uploaded to, e.g. a staging graph.
+        :return:
+        """
+        return f"{graph_name}{self.graph_suffix}" if self.graph_suffix else target
+
+
+class HierarchyCollector:
+    """
+    Collects the hierarchy links of a vocabulary from its N-Triples, while they are uploaded.
+    Only links between IRIs are collected, blank nodes don't match across requests.
+    """
+
+    def __init__(self):
+        """
+        Create a new HierarchyCollector.
+        """
+        # The broader concepts of each concept
+        self.broader: dict[str, set[str]] = {}
+        # The top concepts, with their concept scheme
+        self.top_concepts: set[tuple[str, str]] = set()
+        # Whether all files of the graph were seen, otherwise the links are read from the store
+        self.complete = True
+        self._partial = b''
+
+
+    def add(self, subject: str, predicate: str, obj: str) -> None:
+        """
+        Add a triple, which is ignored when it isn't a hierarchy link.
+        :param subject:
+        :param predicate:
+        :param obj:
+        :return:
+        """
+        if predicate == BROADER:
+            self.broader.setdefault(subject, set()).add(obj)
+        elif predicate == NARROWER:
+            self.broader.setdefault(obj, set()).add(subject)
+        elif predicate == TOP_CONCEPT_OF:
+            self.top_concepts.add((subject, obj))
+        elif predicate == HAS_TOP_CONCEPT:
+            self.top_concepts.add((obj, subject))
+
+
+    def observe(self, line: str) -> None:
+        """
+        Collect the hierarchy link of a line of N-Triples.
+        :param line:
+        :return:
+        """
+        if SKOS in line:
+            match = IRI_TRIPLE.match(line)
+            if match is not None:
+                self.add(*match.groups())
+
+
+    def feed(self, data: Union[bytes, str]) -> None:
+        """
+        Collect the hierarchy links of a block of N-Triples, which doesn't have to end with a
+        complete line.
+        :param data:
+        :return:
+        """
+        lines = (self._partial + (data.encode('utf-8') if isinstance(data, str) else data)
+                 ).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.observe(line.decode('utf-8', errors='replace'))
+
+
+    def lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        Collect the hierarchy links of lines of N-Triples while they are read.
+        :param lines:
+        :return:
+        """
+        for line in lines:
+            self.observe(line)
+            yield line
+
+
+    def collecting(self, fp: IO, extension: str) -> IO:
+        """
+        Collect the hierarchy links of an opened file while it is read, when it is N-Triples.
+        :param fp:
+        :param extension:
+        :return: The file to read instead.
+        """
+        if extension not in NTRIPLES_FORMATS:
+            self.complete = False
+            return fp
+        return CollectingReader(fp, self)
+
+
+    def read_graph(self, database: DatabaseConnector, graph_name: str) -> None:
+        """
+        Replace the collected links with those in a graph of the store, with a single query
+        for the direct links.
+        :param database:
+        :param graph_name:
+        :return:
+        """
+        results = database.sparql_query(f"""
+            SELECT ?s ?p ?o WHERE {{
+                VALUES ?p {{ {BROADER} {NARROWER} {TOP_CONCEPT_OF} {HAS_TOP_CONCEPT} }}
+                GRAPH {sparql_iri(graph_name)} {{ ?s ?p ?o . }}
+                FILTER(isIRI(?s) && isIRI(?o))
+            }}""", HIERARCHY_QUERY_TIMEOUT)
+        self.broader.clear()
+        self.top_concepts.clear()
+        for binding in results['results']['bindings']:
+            try:
+                self.add(*[sparql_iri(binding[name]['value']) for name in ["s", "p", "o"]])
+            except InvalidConfigurationException:
+                continue
+        self.complete = True
+
+
+    def ancestors(self, concept: str) -> set[str]:
+        """
+        Get the transitive broader concepts of a concept, cycles are ignored.
+        :param concept:
+        :return:
+        """
+        found: set[str] = set()
+        pending = list(self.broader.get(concept, ()))
+        while pending:
+            parent = pending.pop()
+            if parent not in found and parent != concept:
+                found.add(parent)
+                pending.extend(self.broader.get(parent, ()))
+        return found
+
+
+    def derived_lines(self) -> Iterator[str]:
+        """
+        Get the derived triples of the collected links as N-Triples.
+        :return:
+        """
+        if self._partial:
+            self.feed(b'\n')
+        for concept, parents in self.broader.items():
+            for parent in parents:
+                yield f"{concept} {BROADER} {parent} .\n"
+                yield f"{parent} {NARROWER} {concept} .\n"
+            for ancestor in self.ancestors(concept):
+                yield f"{concept} {BROADER_TRANSITIVE} {ancestor} .\n"
+        for concept, scheme in self.top_concepts:
+            yield f"{concept} {TOP_CONCEPT_OF} {scheme} .\n"
+            yield f"{scheme} {HAS_TOP_CONCEPT} {concept} .\n"
+
+
+class CollectingReader(CountingReader):
+    """
+    Wraps an opened N-Triples source, collecting its hierarchy links while it is read.
+    """
+
+    def __init__(self, fp: IO, collector: HierarchyCollector):
+        """
+        Create a new CollectingReader.
+        :param fp:          The opened file or http response.
+        :param collector:
+        """
+        super().__init__(fp)
+        self.collector = collector
+
+
+    def _count(self, data):
+        self.collector.feed(data)
+        return super()._count(data)
+
+
+def collecting(collector: Optional[HierarchyCollector], fp: IO, extension: str) -> IO:
+    """
+    Collect the hierarchy links of an opened file while it is read, when materializing.
+    :param collector:   None when the hierarchy isn't materialized.
+    :param fp:
+    :param extension:
+    :return: The file to read instead.
+    """
+    return fp if collector is None else collector.collecting(fp, extension)
+
+
+def materialize_hierarchy(database: DatabaseConnector, collector: HierarchyCollector,
+                          settings: HierarchySettings, graph_name: str,
+                          target: str) -> tuple[int, Optional[int]]:
+    """
+    Add the derived triples of the hierarchy of a vocabulary, which was uploaded to the target
+    graph. The links are read from the store when not all files were N-Triples. A companion
+    graph is replaced, the triples are appended to the graph itself.
+    :param database:
+    :param collector:
+    :param settings:
+    :param graph_name:  The graph Skosmos reads the vocabulary from.
+    :param target:      The graph the vocabulary was uploaded to.
+    :return: The number of derived triples, and the HTTP status of the database (None when
+             nothing was sent).
+    """
+    if not collector.complete:
+        collector.read_graph(database, target)
+    graph = settings.graph(graph_name, target)
+    if graph == target and not collector.broader and not collector.top_concepts:
+        return 0, None
+    count = 0
+
+    def counted(lines: Iterable[str]) -> Iterator[str]:
+        nonlocal count
+        for line in lines:
+            count += 1
+            yield line
+
+    print(f"Materializing the hierarchy of {graph_name} into {graph}")
+    status = database.add_vocabulary(encode_blocks(counted(collector.derived_lines())), graph,
+                                     "nt", graph == target)
+    return count, status
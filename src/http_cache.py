@@ -0,0 +1,145 @@
+"""
+This file contains the cache of HTTP validators (ETag/Last-Modified) used for conditional requests.
+"""
+import hashlib
+import json
+import os
+import urllib.request
+from email.message import Message
+from typing import Optional
+
+
+def cache_key(config_data: dict, data_dir: str) -> str:
+    """
+    Create a key identifying the request described by the source configuration.
+    :param config_data: The configuration, a dict with information about the file.
+    :param data_dir:    The data directory of the application
+    :return:
+    """
+    key_data = dict(config_data)
+    if 'query_location' in config_data:
+        with open(f"{data_dir}/{config_data['query_location']}", encoding='utf-8') as file:
+            key_data['query'] = file.read()
+    serialized = json.dumps(key_data, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def vocabulary_key(configuration: dict, data_dir: str) -> Optional[str]:
+    """
+    Create a key identifying what is loaded together with a source: the yaml of the vocabulary
+    and the contents of its tweaks. An unchanged source doesn't mean the graph is unchanged
+    when these changed.
+    :param configuration: The configuration from the yaml.
+    :param data_dir:      The data directory of the application
+    :return: None when the tweaks aren't a local file, they can't be compared without
+             downloading them.
+    """
+    digest = hashlib.sha256(json.dumps(configuration, sort_keys=True, default=str).encode('utf-8'))
+    tweaks = configuration.get('tweaks')
+    if tweaks is not None:
+        if tweaks.get('type') != 'file':
+            return None
+        try:
+            with open(f"{data_dir}/{tweaks['location']}", 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 16), b''):
+                    digest.update(block)
+        except OSError:
+            return None
+    return digest.hexdigest()
+
+
+class HttpCache:
+    """
+    On-disk store of the validators returned for each remote source.
+    """
+
+    cache_dir: str
+
+    def __init__(self, cache_dir: str):
+        """
+        Create a new HttpCache.
+        :param cache_dir: The directory to store the validators in.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+
+    def load(self, key: str) -> dict:
+        """
+        Get the stored validators for a source.
+        :param key: The cache key of the source.
+        :return:
+        """
+        try:
+            with open(self._path(key), encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+
+    def matches(self, key: str, vocabulary: Optional[str]) -> bool:
+        """
+        Check if the validators of a source were stored together with the same yaml and tweaks,
+        otherwise the source has to be loaded even when it is unchanged.
+        :param key:         The cache key of the source.
+        :param vocabulary:  The vocabulary key, see vocabulary_key().
+        :return:
+        """
+        return vocabulary is not None and self.load(key).get('vocabulary') == vocabulary
+
+
+    def apply(self, key: str, req: urllib.request.Request) -> None:
+        """
+        Add the conditional request headers for the source to the request.
+        :param key: The cache key of the source.
+        :param req: The request to add the headers to.
+        :return:
+        """
+        validators = self.load(key)
+        if 'etag' in validators:
+            req.add_header('If-None-Match', validators['etag'])
+        if 'last_modified' in validators:
+            req.add_header('If-Modified-Since', validators['last_modified'])
+
+
+    def store(self, key: str, headers: Optional[Message],
+              vocabulary: Optional[str] = None) -> None:
+        """
+        Store the validators from the response headers. Call this after the source is loaded.
+        :param key:         The cache key of the source.
+        :param headers:     The response headers.
+        :param vocabulary:  The vocabulary key of the yaml and tweaks which were loaded with it.
+        :return:
+        """
+        if headers is None or vocabulary is None:
+            self.clear(key)
+            return
+        validators = {}
+        if headers.get('ETag'):
+            validators['etag'] = headers.get('ETag')
+        if headers.get('Last-Modified'):
+            validators['last_modified'] = headers.get('Last-Modified')
+        if not validators:
+            self.clear(key)
+            return
+        validators['vocabulary'] = vocabulary
+        tmp_path = f"{self._path(key)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(validators, fp)
+        os.replace(tmp_path, self._path(key))
+
+
+    def clear(self, key: str) -> None:
+        """
+        Remove the validators of a source, so the next request is unconditional.
+        :param key: The cache key of the source.
+        :return:
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,283 @@
+"""
+This file contains the timing and size metrics of the loader, exported as a JSON run report or a
+Prometheus textfile.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, Callable, Iterator, Optional
+
+from src.exceptions import VocabularyNotModifiedException
+
+METRICS_FORMATS = ["json", "prometheus"]
+
+# The numeric fields of the phase records, exported as Prometheus metrics
+PROMETHEUS_FIELDS = {
+    'seconds': "Time spent in the phase",
+    'bytes': "Bytes read from the source",
+    'graphs_behind': "Graphs a replica was behind on the primary",
+    'lag_seconds': "Seconds the most outdated graph of a replica was behind on the primary",
+}
+
+
+class CountingReader:
+    """
+    Wraps an opened source, counting the bytes read from it. Calls on_close once when closed.
+    """
+
+    def __init__(self, fp: IO, on_close: Optional[Callable[["CountingReader"], None]] = None):
+        """
+        Create a new CountingReader.
+        :param fp:          The opened file or http response.
+        :param on_close:    Called with the reader when it is closed.
+        """
+        self._fp = fp
+        self._on_close = on_close
+        self.bytes_read = 0
+
+
+    def _count(self, data):
+        self.bytes_read += len(data.encode('utf-8') if isinstance(data, str) else data)
+        return data
+
+
+    def read(self, *args):
+        """
+        Read from the source.
+        """
+        return self._count(self._fp.read(*args))
+
+
+    def readline(self, *args):
+        """
+        Read a line from the source.
+        """
+        return self._count(self._fp.readline(*args))
+
+
+    def __iter__(self):
+        for line in self._fp:
+            yield self._count(line)
+
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+    def close(self) -> None:
+        """
+        Close the source.
+        :return:
+        """
+        self._fp.close()
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close(self)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def prometheus_labels(labels: dict) -> str:
+    """
+    Format Prometheus labels, escaping the values.
+    :param labels:
+    :return:
+    """
+    values = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append(f'{name}="{value}"')
+    return "{" + ",".join(values) + "}"
+
+
+class RunMetrics:
+    """
+    Collects the duration and size of every phase of loading the vocabularies (config, fetch,
+    fallback, upload, tweaks and timestamps).
+    """
+
+    log_json: bool
+
+    def __init__(self, log_json: bool = False):
+        """
+        Create a new RunMetrics.
+        :param log_json:    Print every completed phase as a JSON line.
+        """
+        self.log_json = log_json
+        self.started = time.time()
+        self._records: list[dict] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def vocabulary(self, name: str) -> Iterator[None]:
+        """
+        Attribute the phases in the with block (on this thread) to a vocabulary.
+        :param name:
+        :return:
+        """
+        self._local.vocabulary = name
+        try:
+            yield
+        finally:
+            self._local.vocabulary = ""
+
+
+    def start(self, phase: str, **fields) -> dict:
+        """
+        Start measuring a phase, finish it with finish().
+        :param phase:
+        :param fields:  Extra fields of the record, like the HTTP status.
+        :return: The record of the phase.
+        """
+        record = {'vocabulary': getattr(self._local, 'vocabulary', ""), 'phase': phase, **fields}
+        record['started'] = time.monotonic()
+        return record
+
+
+    def finish(self, record: dict, outcome: str = "ok", **fields) -> None:
+        """
+        Finish measuring a phase.
+        :param record:  The record returned by start().
+        :param outcome: ok, error, not_modified or fallback.
+        :param fields:  Extra fields of the record.
+        :return:
+        """
+        record.update(fields)
+        record['seconds'] = round(time.monotonic() - record.pop('started'), 6)
+        record['outcome'] = outcome
+        with self._lock:
+            self._records.append(record)
+        if self.log_json:
+            print(json.dumps(record, sort_keys=True))
+
+
+    def event(self, phase: str, outcome: str = "ok", **fields) -> None:
+        """
+        Record something which happened, without a duration.
+        :param phase:
+        :param outcome:
+        :param fields:
+        :return:
+        """
+        self.finish(self.start(phase, **fields), outcome)
+
+
+    @contextmanager
+    def phase(self, phase: str, **fields) -> Iterator[dict]:
+        """
+        Measure the phase in the with block. The yielded record can be extended with fields.
+        :param phase:
+        :param fields:
+        :return:
+        """
+        record = self.start(phase, **fields)
+        outcome = "error"
+        try:
+            yield record
+            outcome = "ok"
+        except VocabularyNotModifiedException:
+            outcome = "not_modified"
+            raise
+        finally:
+            self.finish(record, outcome)
+
+
+    def records(self) -> list[dict]:
+        """
+        Get the records of all finished phases.
+        :return:
+        """
+        with self._lock:
+            return list(self._records)
+
+
+    def clear(self) -> None:
+        """
+        Start a new run.
+        :return:
+        """
+        with self._lock:
+            self._records.clear()
+        self.started = time.time()
+
+
+    def report(self) -> dict:
+        """
+        Get the JSON run report.
+        :return:
+        """
+        return {
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 6),
+            'phases': self.records(),
+        }
+
+
+    def prometheus(self) -> str:
+        """
+        Get the metrics in the Prometheus text format, summed per vocabulary and phase.
+        :return:
+        """
+        totals: dict[tuple[str, str], dict] = {}
+        for record in self.records():
+            total = totals.setdefault((record['vocabulary'], record['phase']),
+                                      {'count': 0, 'errors': 0})
+            total['count'] += 1
+            total['errors'] += record['outcome'] == "error"
+            for name in PROMETHEUS_FIELDS:
+                if isinstance(record.get(name), (int, float)):
+                    total[name] = total.get(name, 0) + record[name]
+            if record.get('status') is not None:
+                total['status'] = record['status']
+
+        metrics = {
+            'count': ("gauge", "Number of times the phase ran"),
+            'errors': ("gauge", "Number of times the phase failed"),
+            'status': ("gauge", "The last HTTP status of the phase"),
+            **{name: ("gauge", description) for name, description in PROMETHEUS_FIELDS.items()},
+        }
+        lines = []
+        for name, (metric_type, description) in metrics.items():
+            metric = f"skosmos_loader_phase_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for (vocabulary, phase), total in sorted(totals.items()):
+                if name in total:
+                    labels = prometheus_labels({'vocabulary': vocabulary, 'phase': phase})
+                    lines.append(f"{metric}{labels} {total[name]}")
+        lines.append("# HELP skosmos_loader_last_run_timestamp_seconds Start of the last run")
+        lines.append("# TYPE skosmos_loader_last_run_timestamp_seconds gauge")
+        lines.append(f"skosmos_loader_last_run_timestamp_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+
+    def export(self, metrics_dir: str, formats: list[str]) -> None:
+        """
+        Write the metrics of the run, replacing the files of the previous run.
+        :param metrics_dir: The directory to write to.
+        :param formats:     json (run-report.json) and/or prometheus (skosmos_loader.prom).
+        :return:
+        """
+        if not formats:
+            return
+        os.makedirs(metrics_dir, exist_ok=True)
+        for metrics_format in formats:
+            if metrics_format == "json":
+                path, content = "run-report.json", json.dumps(self.report(), indent=2)
+            else:
+                path, content = "skosmos_loader.prom", self.prometheus()
+            path = os.path.join(metrics_dir, path)
+            # Written to a temporary file first, so collectors never read a partial file
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as fp:
+                fp.write(content)
+            os.replace(f"{path}.tmp", path)
@@ -0,0 +1,307 @@
+"""
+This file contains the prefetching of vocabulary sources into a bounded spool on disk, so the next
+sources are downloaded while the current one is uploaded.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import IO, Any, Callable, Optional
+
+from src.database import iter_chunks
+
+
+@dataclass
+class PrefetchSettings:
+    """
+    Settings for downloading sources ahead of their upload: prefetching the sources of the next
+    vocabularies, and hedging slow sources with their fallback.
+    """
+    # Number of sources downloaded ahead of the upload, 0 disables prefetching
+    depth: int = 0
+    # Bytes of prefetched data kept on disk, 0 is unlimited
+    disk_budget: int = 0
+    # Directory of the spool files, None uses the default temporary directory
+    spool_dir: Optional[str] = None
+    # Seconds a source gets before its fallback is downloaded as well, 0 disables hedging
+    hedge_deadline: float = 0
+    # Bytes per second a source must reach by the deadline, 0 only requires its first bytes
+    hedge_min_throughput: int = 0
+
+
+@dataclass
+class Prefetched:
+    """
+    A prepared vocabulary, with its opened source (or the error opening it). The source is None
+    when it isn't prefetched, e.g. because the vocabulary doesn't need to be loaded.
+    """
+    value: Any
+    source: Optional[tuple[dict, IO]] = None
+    error: Optional[Exception] = None
+
+
+    def open_source(self) -> tuple[dict, IO]:
+        """
+        Get the prefetched source, raising the error when it failed to open.
+        :return: The source configuration which was used and the opened file.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.source
+
+
+class SpoolLimits:
+    """
+    Keeps track of the sources and bytes in the spool, waiting for room when it is full.
+    """
+
+    def __init__(self, depth: int = 1, disk_budget: int = 0):
+        """
+        Create a new SpoolLimits.
+        :param depth:       The maximum number of sources waiting to be taken.
+        :param disk_budget: The maximum number of bytes, 0 is unlimited.
+        """
+        self.depth = depth
+        self.disk_budget = disk_budget
+        self.waiting = 0
+        self.used = 0
+        self._condition = threading.Condition()
+
+
+    def add(self, size: int) -> bool:
+        """
+        Account for data written to a spool file.
+        :param size:
+        :return: False when the disk budget is exceeded.
+        """
+        with self._condition:
+            self.used += size
+            return self.disk_budget <= 0 or self.used <= self.disk_budget
+
+
+    def release(self, size: int) -> None:
+        """
+        Account for a spool file which is removed.
+        :param size:
+        :return:
+        """
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+    def taken(self) -> None:
+        """
+        Account for a source which is taken from the spool.
+        :return:
+        """
+        with self._condition:
+            self.waiting -= 1
+            self._condition.notify_all()
+
+
+    def wait_for_room(self, stopped: threading.Event) -> None:
+        """
+        Wait until there is room for another source (or prefetching is stopped).
+        :param stopped:
+        :return:
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: stopped.is_set() or (
+                self.waiting < self.depth
+                and (self.disk_budget <= 0 or self.used < self.disk_budget)))
+            self.waiting += 1
+
+
+    def wake(self) -> None:
+        """
+        Wake up the waiting threads, e.g. because prefetching is stopped.
+        :return:
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+
+class SpooledSource:
+    """
+    A prefetched source, read from its spool file. When the source didn't fit in the budget, the
+    rest of it is read from the original response. Other attributes (like the headers) are those of
+    the original response.
+    """
+
+    def __init__(self, spool: IO, source: IO, complete: bool,
+                 on_close: Optional[Callable[[], None]] = None):
+        """
+        Create a new SpooledSource.
+        :param spool:       The (binary) spool file, ending at the end of a line.
+        :param source:      The original source.
+        :param complete:    Whether the spool contains the whole source, otherwise the rest is read
+                            from source.
+        :param on_close:    Called once when the source is closed.
+        """
+        self._spool = spool
+        self._source = source
+        self._remainder = None if complete else source
+        self._on_close = on_close
+
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read from the source.
+        :param size:
+        :return:
+        """
+        data = self._spool.read(size)
+        if self._remainder is None or (data and size >= 0):
+            return data
+        rest = self._remainder.read(size)
+        return data + (rest.encode('utf-8') if isinstance(rest, str) else rest)
+
+
+    def __iter__(self):
+        yield from self._spool
+        if self._remainder is not None:
+            for line in self._remainder:
+                yield line.encode('utf-8') if isinstance(line, str) else line
+
+
+    def __getattr__(self, name):
+        return getattr(self._source, name)
+
+
+    def close(self) -> None:
+        """
+        Close the source and remove the spool file.
+        :return:
+        """
+        self._spool.close()
+        self._source.close()
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            on_close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SourcePrefetcher:
+    """
+    Prepares vocabularies and downloads their sources in a background thread, in the order they
+    are loaded, keeping at most depth sources ahead of the uploads.
+    """
+
+    def __init__(self, settings: PrefetchSettings, fetch: Callable[[str], Prefetched]):
+        """
+        Create a new SourcePrefetcher.
+        :param settings:
+        :param fetch:       Prepares a vocabulary and opens its source, called on the background
+                            thread.
+        """
+        self.settings = settings
+        self.limits = SpoolLimits(max(1, settings.depth), settings.disk_budget)
+        self._fetch = fetch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._futures: dict[str, Future] = {}
+        self._stopped = threading.Event()
+        if settings.spool_dir is not None:
+            os.makedirs(settings.spool_dir, exist_ok=True)
+
+
+    def start(self, keys: list[str]) -> None:
+        """
+        Start prefetching, in the given order.
+        :param keys:
+        :return:
+        """
+        for key in keys:
+            self._futures[key] = self._executor.submit(self._prefetch, key)
+
+
+    def take(self, key: str) -> Prefetched:
+        """
+        Get a prefetched vocabulary, waiting until its source is downloaded. The source must be
+        closed after using it, to remove its spool file.
+        :param key:
+        :return:
+        """
+        future = self._futures.pop(key)
+        try:
+            return future.result()
+        finally:
+            self.limits.taken()
+
+
+    def _prefetch(self, key: str) -> Prefetched:
+        self.limits.wait_for_room(self._stopped)
+        if self._stopped.is_set():
+            return Prefetched(None)
+        prefetched = self._fetch(key)
+        if prefetched.source is not None:
+            source_data, fp = prefetched.source
+            prefetched.source = source_data, self._spool(fp)
+        return prefetched
+
+
+    def _spool(self, fp: IO) -> SpooledSource:
+        """
+        Copy a source to a spool file, until it is complete or the budget is exceeded.
+        """
+        size = 0
+        complete = True
+        with ExitStack() as stack:
+            # Removes the spool file when copying fails
+            spool = stack.enter_context(tempfile.TemporaryFile(dir=self.settings.spool_dir))
+            stack.callback(fp.close)
+            stack.callback(lambda: self.limits.release(size))
+            for chunk in iter_chunks(fp):
+                spool.write(chunk)
+                size += len(chunk)
+                if not self.limits.add(len(chunk)) or self._stopped.is_set():
+                    # The spool ends with a complete line, the rest is read from the source
+                    line = fp.readline()
+                    line = line.encode('utf-8') if isinstance(line, str) else line
+                    spool.write(line)
+                    size += len(line)
+                    self.limits.add(len(line))
+                    complete = False
+                    break
+            spool.seek(0)
+            stack.pop_all()
+        if complete:
+            # Also finishes the fetch metrics
+            fp.close()
+        return SpooledSource(spool, fp, complete, lambda: self.limits.release(size))
+
+
+    def close(self) -> None:
+        """
+        Stop prefetching, and remove the spool files which weren't taken.
+        :return:
+        """
+        self._stopped.set()
+        self.limits.wake()
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        for future in self._futures.values():
+            if future.cancelled() or future.exception() is not None:
+                continue
+            prefetched = future.result()
+            if prefetched.source is not None:
+                prefetched.source[1].close()
+        self._futures.clear()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,328 @@
+"""
+This file contains the fan-out of all writes to several triple stores: a primary store, which is
+read from, and its read replicas. A source is read once and streamed to all stores at the same time.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import IO, Any, Callable, Iterable, Iterator, Optional, TextIO, Union
+
+import requests
+
+from src.database import (
+    DEFAULT_DATASET_TIMEOUT, DEFAULT_READY_TIMEOUT, DatabaseConnector, failed_status, iter_chunks
+)
+from src.exceptions import VocabularyLoadingException
+from src.metrics import RunMetrics
+
+# Number of blocks buffered for each store, a slow store slows down the others
+FANOUT_QUEUE = 8
+
+# Handed to the stores instead of the next block, when reading the source failed
+SOURCE_FAILED = object()
+
+
+class StreamFanOut:
+    """
+    Reads a source once, handing every block to several consumers.
+    """
+
+    def __init__(self, count: int):
+        """
+        Create a new StreamFanOut.
+        :param count:   The number of consumers.
+        """
+        self._queues = [queue.Queue(maxsize=FANOUT_QUEUE) for _ in range(count)]
+        self._finished = [threading.Event() for _ in range(count)]
+
+
+    def consumer(self, index: int) -> Iterator[bytes]:
+        """
+        Get the blocks of the source, for one consumer.
+        :param index:
+        :return:
+        """
+        while True:
+            block = self._queues[index].get()
+            if block is None:
+                return
+            if block is SOURCE_FAILED:
+                raise VocabularyLoadingException("Reading the source failed while sending it")
+            yield block
+
+
+    def finished(self, index: int) -> None:
+        """
+        Tell the fan-out a consumer stopped reading, e.g. because its store failed.
+        :param index:
+        :return:
+        """
+        self._finished[index].set()
+
+
+    def _put(self, index: int, block) -> None:
+        while not self._finished[index].is_set():
+            try:
+                self._queues[index].put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    def pump(self, source: Union[IO, Iterable[bytes]]) -> None:
+        """
+        Read the source, handing its blocks to the consumers.
+        :param source:  A file pointer, or an iterable of blocks.
+        :return:
+        """
+        complete = False
+        try:
+            for block in iter_chunks(source) if hasattr(source, 'read') else source:
+                for index in range(len(self._queues)):
+                    self._put(index, block)
+            complete = True
+        finally:
+            for index in range(len(self._queues)):
+                self._put(index, None if complete else SOURCE_FAILED)
+
+
+def read_stores(database: DatabaseConnector) -> list[DatabaseConnector]:
+    """
+    Get the stores which are read from: the primary and its active replicas, or the store itself.
+    :param database:
+    :return:
+    """
+    if isinstance(database, ReplicatedDatabase):
+        return [database.primary] + database.active
+    return [database]
+
+
+class ReplicatedDatabase(DatabaseConnector):
+    """
+    Sends every write to the primary store and its replicas, and reads from the primary. A
+    replica which fails a write is left out for the rest of the run, sync() makes it catch up
+    by copying the graphs it is behind on from the primary.
+    """
+
+    def __init__(self, primary: DatabaseConnector, replicas: list[DatabaseConnector]):
+        """
+        Create a new ReplicatedDatabase.
+        :param primary:     The store which is read from, it has the reference metadata.
+        :param replicas:    The read replicas.
+        """
+        super().__init__(primary.sparql_endpoints, primary.credentials, 1)
+        self.primary = primary
+        self.replicas = replicas
+        # The replicas which receive the writes of this run
+        self.active = list(replicas)
+        self.compress_uploads = primary.compress_uploads
+        self.ingest_format = primary.ingest_format
+
+
+    def _deactivate(self, replica: DatabaseConnector, reason: str) -> None:
+        if replica in self.active:
+            print(f"Replica {replica.sparql_endpoints.http} failed ({reason}), "
+                  f"it catches up on the next run")
+            self.active.remove(replica)
+
+
+    def _fan_out(self, write: Callable[..., Any], *sources: Union[IO, Iterable[bytes]]) -> Any:
+        """
+        Run a write on the primary and the active replicas at the same time.
+        :param write:   Called with the store, and the blocks of each source to send.
+        :param sources: Read once and streamed to all stores, one after the other.
+        :return: The result of the primary, its errors are raised.
+        """
+        stores = [self.primary] + self.active
+        fan_outs = [StreamFanOut(len(stores)) for _ in sources]
+
+        def run(index: int, store: DatabaseConnector) -> Any:
+            try:
+                return write(store, *[fan_out.consumer(index) for fan_out in fan_outs])
+            finally:
+                for fan_out in fan_outs:
+                    fan_out.finished(index)
+
+        with ThreadPoolExecutor(max_workers=len(stores), thread_name_prefix="replica") as executor:
+            futures: list[Future] = [executor.submit(run, index, store)
+                                     for index, store in enumerate(stores)]
+            for fan_out, source in zip(fan_outs, sources):
+                fan_out.pump(source)
+        for replica, future in zip(stores[1:], futures[1:]):
+            try:
+                result = future.result()
+            except (VocabularyLoadingException, requests.RequestException, OSError) as e:
+                self._deactivate(replica, str(e))
+                continue
+            if failed_status(result):
+                self._deactivate(replica, f"status {result}")
+        return futures[0].result()
+
+
+    def setup(self) -> None:
+        """
+        Set up the primary and the active replicas.
+        :return:
+        """
+        self.primary.setup()
+        for replica in list(self.active):
+            try:
+                replica.setup()
+            except requests.RequestException as e:
+                self._deactivate(replica, str(e))
+
+
+    def wait_until_ready(self, timeout: float = DEFAULT_READY_TIMEOUT) -> bool:
+        """
+        Wait for the primary, replicas which aren't ready are left out of this run.
+        :param timeout:
+        :return: Whether the repository of the primary exists.
+        """
+        exists = self.primary.wait_until_ready(timeout)
+        for replica in list(self.active):
+            if replica.probe_repository() is None:
+                self._deactivate(replica, "not available")
+        return exists
+
+
+    def probe_repository(self) -> Optional[bool]:
+        """
+        Check the state of the primary.
+        :return:
+        """
+        return self.primary.probe_repository()
+
+
+    def sparql_query(self, query: str, timeout: float = 60) -> dict:
+        """
+        Run a query on the primary.
+        :param query:
+        :param timeout:
+        :return:
+        """
+        return self.primary.sparql_query(query, timeout)
+
+
+    def sparql_update(self, update: str) -> None:
+        """
+        Run an update on all stores.
+        :param update:
+        :return:
+        """
+        self._fan_out(lambda store: store.sparql_update(update))
+
+
+    def refresh_search_index(self, graph_names: list[str]) -> None:
+        """
+        Refresh the full-text index of all stores.
+        :param graph_names:
+        :return:
+        """
+        self._fan_out(lambda store: store.refresh_search_index(graph_names))
+
+
+    def add_vocabulary(self, graph: TextIO, graph_name: str, extension: str,
+                       append: bool = False) -> Optional[int]:
+        """
+        Stream a vocabulary to all stores.
+        :param graph:       File
+        :param graph_name:  String representing the name of the graph
+        :param extension:   String representing the extension
+        :param append:      Append data instead of replacing
+        :return: The HTTP status of the primary.
+        """
+        return self._fan_out(lambda store, blocks: store.add_vocabulary(
+            blocks, graph_name, extension, append), graph)
+
+
+    def add_vocabulary_batch(self, content: bytes, graph_name: str, extension: str,
+                             append: bool = False) -> None:
+        """
+        Send one batch of a vocabulary to all stores.
+        :param content:     The serialized batch.
+        :param graph_name:  String representing the name of the graph
+        :param extension:   String representing the extension
+        :param append:      Append data instead of replacing
+        :return:
+        """
+        self._fan_out(lambda store: store.add_vocabulary_batch(content, graph_name, extension,
+                                                               append))
+
+
+    def add_vocabulary_parts(self, parts: list[tuple[Any, str]], graph_name: str) -> Optional[int]:
+        """
+        Stream several files to all stores, each store adds them as it does on its own.
+        :param parts:       The files with their extensions, in the order they are added.
+        :param graph_name:  String representing the name of the graph
+        :return: The HTTP status of the primary.
+        """
+        extensions = [extension for _, extension in parts]
+        return self._fan_out(lambda store, *blocks: store.add_vocabulary_parts(
+            list(zip(blocks, extensions)), graph_name), *[content for content, _ in parts])
+
+
+    def add_dataset(self, content: Iterable[bytes], extension: str = "nq",
+                    timeout: float = DEFAULT_DATASET_TIMEOUT) -> int:
+        """
+        Stream quads to all stores.
+        :param content:     The serialized quads.
+        :param extension:   String representing the extension
+        :param timeout:     The number of seconds to wait for the response of each store.
+        :return: The HTTP status of the primary.
+        """
+        return self._fan_out(lambda store, blocks: store.add_dataset(blocks, extension, timeout),
+                             content)
+
+
+    def sync(self, metrics: RunMetrics) -> None:
+        """
+        Report how far each replica is behind the primary, and copy the graphs it is behind on
+        from the primary. Replicas which aren't available are left out of this run.
+        :param metrics:
+        :return:
+        """
+        timestamps = self.primary.get_loaded_vocabs()
+        digests = self.primary.get_loaded_digests()
+        self.active = []
+        for replica in self.replicas:
+            endpoint = replica.sparql_endpoints.http
+            if replica.probe_repository() is None:
+                print(f"Replica {endpoint} is not available, it catches up on the next run")
+                metrics.event("replica", "error", vocabulary=endpoint)
+                continue
+            try:
+                replica.setup()
+                loaded = replica.get_loaded_vocabs()
+                behind = {graph: timestamp for graph, timestamp in timestamps.items()
+                          if loaded.get(graph, 0) < timestamp}
+                lag = max([timestamp - loaded.get(graph, 0)
+                           for graph, timestamp in behind.items() if graph in loaded] or [0])
+                print(f"Replica {endpoint} is {len(behind)} graph(s) behind ({lag}s)")
+                with metrics.phase("replica", vocabulary=endpoint, graphs_behind=len(behind),
+                                   lag_seconds=lag):
+                    self.copy_graphs(replica, behind, digests)
+            except (VocabularyLoadingException, requests.RequestException) as e:
+                print(f"Replica {endpoint} failed to catch up: {e}")
+                continue
+            self.active.append(replica)
+
+
+    def copy_graphs(self, replica: DatabaseConnector, timestamps: dict[str, int],
+                    digests: dict[str, str]) -> None:
+        """
+        Copy graphs from the primary to a replica, with their metadata.
+        :param replica:
+        :param timestamps:  The graphs to copy, with their timestamps on the primary.
+        :param digests:     The digests of the graphs on the primary.
+        :return:
+        """
+        started = time.monotonic()
+        for graph in sorted(timestamps):
+            status = replica.add_vocabulary(self.primary.graph_contents(graph), graph, "nt")
+            if failed_status(status):
+                raise VocabularyLoadingException(f"Copying {graph} failed with {status}")
+        replica.write_metadata(timestamps, {graph: digest for graph, digest in digests.items()
+                                            if graph in timestamps})
+        if timestamps:
+            print(f"Copied {len(timestamps)} graph(s) in {time.monotonic() - started:.1f}s")
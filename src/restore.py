@@ -0,0 +1,83 @@
+"""
+This file contains the bulk restore of an empty store from the archive: the archived files of
+several vocabularies are sent as a single N-Quads stream, with their metadata.
+"""
+from typing import Iterator
+
+import requests
+
+from src.batches import BatchProgress
+from src.bulk import can_bulk_load, encode_blocks, metadata_lines, quad_lines, triple_lines
+from src.context import LoadContext
+from src.delta import forget_snapshot
+from src.exceptions import VocabularyLoadingException
+from src.hierarchy import HierarchyCollector
+from src.vocabularies import get_file_from_config, get_vocab_format
+
+
+def bulk_lines(context: LoadContext,
+               restorable: list[tuple[str, dict, str, dict]]) -> Iterator[str]:
+    """
+    Read the archived files of several vocabularies as N-Quads, followed by their metadata.
+    :param context:
+    :param restorable: The vocabularies, as found by archived_vocabularies.
+    :return:
+    """
+    hierarchy = context.options.hierarchy
+    for index, (_, restored, graph, version) in enumerate(restorable):
+        collector = HierarchyCollector() if hierarchy.enabled else None
+        for part in ["source", "tweaks"]:
+            if part in restored:
+                with get_file_from_config(restored[part], context.data_dir) as fp:
+                    lines = triple_lines(fp, get_vocab_format(restored[part]),
+                                         f"r{index}{part[0]}")
+                    yield from quad_lines(lines if collector is None else collector.lines(lines),
+                                          graph)
+        if collector is not None:
+            companion = hierarchy.graph(graph, graph)
+            yield from quad_lines(collector.derived_lines(), companion)
+            if companion != graph:
+                yield from metadata_lines(companion, version['loaded'])
+        yield from metadata_lines(graph, version['loaded'], version.get('digest'))
+
+
+def bulk_restore(context: LoadContext, restorable: list[tuple[str, dict, str, dict]],
+                 loaded_vocabs: dict[str, int]) -> list[tuple[str, dict, str, dict]]:
+    """
+    Restore vocabularies into an empty store using as few N-Quads requests as possible, which
+    also contain their metadata.
+    :param context:
+    :param restorable: The vocabularies, as found by archived_vocabularies.
+    :param loaded_vocabs: The loaded graphs and their timestamps, the restored graphs are added.
+    :return: The vocabularies which still have to be restored one by one.
+    """
+    bulk = [item for item in restorable
+            if all(can_bulk_load(part['format']) for part in item[3]['parts'].values())]
+    remaining = [item for item in restorable if item not in bulk]
+    size = max(1, context.options.archive.bulk_graphs or len(bulk))
+    for start in range(0, len(bulk), size):
+        group = bulk[start:start + size]
+        print(f"Restoring {len(group)} graph(s) from the archive in a single request")
+        status = None
+        try:
+            with context.metrics.phase("restore", bulk=True, graphs=len(group)) as record:
+                status = context.database.add_dataset(encode_blocks(bulk_lines(context, group)),
+                                                      timeout=context.options.archive.bulk_timeout)
+                record['status'] = status
+        except requests.ReadTimeout as e:
+            # The store may still commit the request, so the graphs aren't restored one by one
+            # while it does: they are loaded from their sources later in the run
+            print(f"Bulk restore didn't respond in time, its graphs aren't restored: {e}")
+            continue
+        except (VocabularyLoadingException, requests.RequestException, OSError) as e:
+            print(f"Bulk restore failed: {e}")
+        if status is None or status >= 400:
+            remaining.extend(group)
+            continue
+        for _, _, graph, version in group:
+            loaded_vocabs[graph] = version['loaded']
+            if context.digests is not None and version.get('digest') is not None:
+                context.digests[graph] = version['digest']
+            forget_snapshot(context.options.delta, graph)
+            BatchProgress(context.options.batches.progress_dir, graph).clear()
+    return remaining
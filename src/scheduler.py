@@ -0,0 +1,103 @@
+"""
+This file contains the scheduler deciding when vocabularies are refreshed in daemon mode.
+"""
+import math
+import os
+import random
+import time
+from typing import Optional
+
+
+class RefreshScheduler:
+    """
+    Keeps track of when each vocabulary (yaml file) is due for a refresh.
+    """
+
+    jitter: float
+    min_interval: float
+    rescan_interval: float
+
+    def __init__(self, jitter: float = 0.1, min_interval: float = 3600,
+                 rescan_interval: float = 300):
+        """
+        Create a new RefreshScheduler.
+        :param jitter:          Random delay added to each refresh, as a fraction of its interval.
+        :param min_interval:    Minimum number of seconds between two refreshes of a vocabulary,
+                                also used for retrying vocabularies which failed to load.
+        :param rescan_interval: Maximum number of seconds between checks for new yaml files.
+        """
+        self.jitter = jitter
+        self.min_interval = min_interval
+        self.rescan_interval = rescan_interval
+        self._due: dict[str, float] = {}
+        self._mtimes: dict[str, Optional[float]] = {}
+
+
+    @staticmethod
+    def _mtime(vocab: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(vocab)
+        except OSError:
+            return None
+
+
+    def due(self, vocabs: list[str], now: Optional[float] = None) -> list[str]:
+        """
+        Get the vocabularies which need to be processed. New and modified yaml files are due
+        immediately.
+        :param vocabs:  All yaml files.
+        :param now:     The current time.
+        :return:
+        """
+        now = time.time() if now is None else now
+        for vocab in list(self._due):
+            if vocab not in vocabs:
+                del self._due[vocab]
+                del self._mtimes[vocab]
+        return [
+            vocab for vocab in vocabs
+            if vocab not in self._due
+            or self._mtimes[vocab] != self._mtime(vocab)
+            or self._due[vocab] <= now
+        ]
+
+
+    def schedule(self, vocab: str, last_loaded: float, interval: Optional[float]) -> None:
+        """
+        Schedule the next refresh of a vocabulary.
+        :param vocab:       The yaml file.
+        :param last_loaded: The time the vocabulary was last loaded (or checked).
+        :param interval:    The refresh interval in seconds, None when it isn't refreshed.
+        :return:
+        """
+        self._mtimes[vocab] = self._mtime(vocab)
+        if interval is None:
+            self._due[vocab] = math.inf
+            return
+        interval = max(interval, self.min_interval)
+        # Spread refreshes with the same interval, so they don't all start at the same time
+        delay = random.uniform(0, self.jitter * interval)
+        self._due[vocab] = last_loaded + interval + delay + 1
+
+
+    def retry(self, vocab: str, now: Optional[float] = None) -> None:
+        """
+        Schedule a vocabulary which failed to load.
+        :param vocab:
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        self._mtimes[vocab] = self._mtime(vocab)
+        self._due[vocab] = now + self.min_interval
+
+
+    def seconds_until_next(self, now: Optional[float] = None) -> float:
+        """
+        Get the time to sleep until the next vocabulary is due, or the yaml files are checked.
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        next_due = min(self._due.values(), default=math.inf)
+        return max(0.0, min(self.rescan_interval, next_due - now))
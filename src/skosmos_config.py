@@ -0,0 +1,68 @@
+"""
+This file contains the writing of the Skosmos config, from the general config and the configs of
+the vocabularies.
+"""
+import os
+import re
+import shutil
+from typing import Iterable
+
+from src.vocabularies import decode_lines
+
+# The directory the Skosmos config is written to
+CONFIG_DIR = os.environ.get("CONFIG_DIR", "/config")
+
+# Environment variables in the Skosmos config
+ENV_VARIABLE = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+def append_file(source: Iterable, dest: str):
+    """
+    Append source to dest file.
+    :param source:  A file pointer to a source file, or an iterable of lines.
+    :param dest:    The path of the destination file.
+    :return:
+    """
+    with open(dest, "a+", encoding='utf-8') as df:
+        for line in decode_lines(source):
+            df.write(line)
+
+
+def write_base_config(data_dir: str) -> None:
+    """
+    Start the Skosmos config with the general config and the config-ext.ttl.
+    :param data_dir:
+    :return:
+    """
+    if os.path.isfile(f'{data_dir}/config.ttl'):
+        shutil.copy(f'{data_dir}/config.ttl', f'{CONFIG_DIR}/config-docker-compose.ttl')
+    else:
+        shutil.copy('/app/config-docker-compose.ttl', f'{CONFIG_DIR}/config-docker-compose.ttl')
+
+    if os.path.isfile(f'{data_dir}/config-ext.ttl'):
+        with open(f'{data_dir}/config-ext.ttl', 'r', encoding='utf-8') as f:
+            append_file(f, f'{CONFIG_DIR}/config-docker-compose.ttl')
+
+
+def substitute_env(text: str) -> str:
+    """
+    Replace $VAR and ${VAR} with the value of the environment variable, like envsubst does.
+    :param text:
+    :return:
+    """
+    return ENV_VARIABLE.sub(lambda m: os.environ.get(m.group(1) or m.group(2), ''), text)
+
+
+def write_skosmos_config(data_dir: str, configs: list[str]) -> None:
+    """
+    Write the complete Skosmos config, both the template and the env substituted config.ttl.
+    :param data_dir:
+    :param configs: The configs of the vocabularies.
+    :return:
+    """
+    write_base_config(data_dir)
+    append_file(configs, f'{CONFIG_DIR}/config-docker-compose.ttl')
+    with open(f'{CONFIG_DIR}/config-docker-compose.ttl', 'r', encoding='utf-8') as f:
+        config_text = substitute_env(f.read())
+    with open(f'{CONFIG_DIR}/config.ttl', 'w', encoding='utf-8') as f:
+        f.write(config_text)
@@ -0,0 +1,174 @@
+"""
+This file contains the opening of the sources of vocabularies: conditional requests, fallbacks,
+hedged downloads and archived sources.
+"""
+import os
+import time
+from typing import IO, Optional
+
+from src.archive import SourceArchive
+from src.context import LoadContext
+from src.exceptions import VocabularyLoadingException, VocabularyNotModifiedException
+from src.hedge import HedgedDownload, hedged_source
+from src.http_cache import HttpCache, cache_key, vocabulary_key
+from src.metrics import CountingReader
+from src.prefetch import Prefetched
+from src.sparql_source import open_paged_query
+from src.vocabularies import get_file_from_config, is_paged_query
+
+
+def store_validators(context: LoadContext, configuration: dict, source_data: dict,
+                     vocab_file: IO) -> None:
+    """
+    Remember the HTTP validators of a source which is now in the database, with the yaml and
+    tweaks it was loaded with.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param source_data:
+    :param vocab_file: The opened vocabulary, validators are read from its response headers.
+    :return:
+    """
+    if context.cache is not None:
+        context.cache.store(cache_key(source_data, context.data_dir),
+                            getattr(vocab_file, 'headers', None),
+                            vocabulary_key(configuration, context.data_dir))
+
+
+def fetch_source(context: LoadContext, source_data: dict,
+                 cache: Optional[HttpCache] = None) -> IO:
+    """
+    Open a source, measuring the time until it responds and the bytes read until it is closed.
+    :param context:
+    :param source_data: The source configuration from the yaml.
+    :param cache: When given, the source is requested conditionally.
+    :return:
+    """
+    record = context.metrics.start("fetch", type=source_data.get('type'))
+    outcome = "error"
+    status = None
+    try:
+        if is_paged_query(source_data):
+            fp = open_paged_query(source_data, context.data_dir)
+        else:
+            fp = get_file_from_config(source_data, context.data_dir, cache)
+        outcome = "ok"
+    except VocabularyNotModifiedException:
+        outcome = "not_modified"
+        status = 304
+        raise
+    except VocabularyLoadingException as e:
+        status = getattr(e.__cause__, 'code', None)
+        raise
+    finally:
+        if outcome != "ok":
+            context.metrics.finish(record, outcome, status=status)
+    record['status'] = getattr(fp, 'status', None)
+    record['response_seconds'] = round(time.monotonic() - record['started'], 6)
+    return CountingReader(fp, lambda reader: context.metrics.finish(record,
+                                                                    bytes=reader.bytes_read))
+
+
+def archived_source(context: LoadContext, graph_name: str) -> Optional[dict]:
+    """
+    Get the last archived source of a graph, when archiving is enabled.
+    :param context:
+    :param graph_name:
+    :return: The configuration for opening the archived source, None when there is none.
+    """
+    if not context.options.archive.enabled:
+        return None
+    archive = SourceArchive(context.options.archive)
+    versions = archive.versions(graph_name)
+    if not versions:
+        return None
+    return archive.part_data(versions[0], "source", context.data_dir)
+
+
+def hedged_fetch(context: LoadContext, configuration: dict,
+                 cache: Optional[HttpCache] = None) -> tuple[dict, IO]:
+    """
+    Download the source of a vocabulary, and its fallback at the same time when the source is
+    slow or fails. The first complete download is used.
+    :param context:
+    :param configuration: The configuration from the yaml, with a fallback.
+    :param cache: When given, the source is requested conditionally.
+    :return: The source configuration which was used and the downloaded file.
+    """
+    settings = context.options.prefetch
+    if settings.spool_dir is not None:
+        os.makedirs(settings.spool_dir, exist_ok=True)
+    primary = HedgedDownload("source", lambda: (
+        configuration["source"], fetch_source(context, configuration["source"], cache)),
+                             settings.spool_dir)
+    fallback = HedgedDownload("fallback", lambda: (
+        configuration["fallback"], fetch_source(context, configuration["fallback"])),
+                              settings.spool_dir)
+    winner, result = hedged_source(primary, fallback, settings.hedge_deadline,
+                                   settings.hedge_min_throughput)
+    if winner is fallback:
+        # The source was still downloading when it was cancelled, or it failed
+        outcome = "hedged" if primary.cancelled else "fallback"
+        print(f"Using the fallback ({outcome})")
+        context.metrics.event("fallback", outcome, source_bytes=primary.bytes_read)
+        if context.cache is not None:
+            # The graph no longer contains what the cached validators describe
+            context.cache.clear(cache_key(configuration["source"], context.data_dir))
+    return result
+
+
+def open_source(context: LoadContext, configuration: dict, graph_name: str,
+                conditional: bool = False) -> tuple[dict, IO]:
+    """
+    Open the source of a vocabulary, using the fallback when the source fails to load. Without a
+    fallback, the last archived source of the graph is used (when there is one).
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param graph_name: The graph the source is loaded into.
+    :param conditional: Boolean, when true the source is requested conditionally. An unchanged
+                        source raises a VocabularyNotModifiedException.
+    :return: The source configuration which was used and the opened file.
+    """
+    cache = context.cache if conditional else None
+    if cache is not None and not cache.matches(cache_key(configuration["source"], context.data_dir),
+                                               vocabulary_key(configuration, context.data_dir)):
+        # The yaml or the tweaks changed, so the graph changes even when the source didn't
+        cache = None
+    if "fallback" in configuration and context.options.prefetch.hedge_deadline > 0:
+        return hedged_fetch(context, configuration, cache)
+    try:
+        source_data = configuration["source"]
+        return source_data, fetch_source(context, source_data, cache)
+    except VocabularyLoadingException as e:
+        if "fallback" in configuration:
+            print("Primary source failed to load. Using fallback")
+            context.metrics.event("fallback", "fallback", error=str(e.__cause__ or e))
+            if context.cache is not None:
+                # The graph no longer contains what the cached validators describe
+                context.cache.clear(cache_key(configuration["source"], context.data_dir))
+            source_data = configuration["fallback"]
+            return source_data, fetch_source(context, source_data)
+        source_data = archived_source(context, graph_name)
+        if source_data is not None:
+            print("Primary source failed to load. Using the archived source")
+            context.metrics.event("fallback", "archive", error=str(e.__cause__ or e))
+            if context.cache is not None:
+                context.cache.clear(cache_key(configuration["source"], context.data_dir))
+            return source_data, fetch_source(context, source_data)
+        raise e
+
+
+def take_source(context: LoadContext, configuration: dict, graph_name: str,
+                conditional: bool = False,
+                prefetched: Optional[Prefetched] = None) -> tuple[dict, IO]:
+    """
+    Get the prefetched source of a vocabulary, or open it when it wasn't prefetched.
+    :param context:
+    :param configuration: The configuration from the yaml.
+    :param graph_name: The graph the source is loaded into.
+    :param conditional: Request the source conditionally, when it is opened here.
+    :param prefetched: The prefetched vocabulary.
+    :return: The source configuration which was used and the opened file.
+    """
+    if prefetched is not None and (prefetched.source is not None or prefetched.error is not None):
+        return prefetched.open_source()
+    return open_source(context, configuration, graph_name, conditional)
@@ -0,0 +1,372 @@
+"""
+This file contains the paged and partitioned queries of 'sparql' sources. The pages of all
+partitions are merged into a single N-Triples stream, while the queries run in the background.
+"""
+import json
+import queue
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import IO, Iterator, Optional
+from urllib.error import URLError
+
+from src.batches import TURTLE_FORMATS
+from src.convert import NTRIPLES_FORMATS, TurtleConverter
+from src.exceptions import InvalidConfigurationException, VocabularyLoadingException
+from src.vocabularies import decode_lines, open_url, read_sparql_query, sparql_request
+
+# The formats the pages can be requested in, they are converted to N-Triples
+PAGE_FORMATS = {
+    **{extension: "application/n-triples" for extension in NTRIPLES_FORMATS},
+    **{extension: "text/turtle" for extension in TURTLE_FORMATS},
+}
+
+# Number of partitions queried at the same time, when not set in the source
+DEFAULT_CONCURRENCY = 4
+
+# The queries hand over blocks of this many lines, at most QUEUE_SIZE blocks are buffered
+BLOCK_LINES = 10000
+QUEUE_SIZE = 16
+
+WHERE_CLAUSE = re.compile(r'\bWHERE\s*\{', re.IGNORECASE)
+SOLUTION_MODIFIER = re.compile(r'\b(?:LIMIT|OFFSET)\s+\d+\s*$', re.IGNORECASE)
+# Blank node labels, and the IRIs and literals which may contain something looking like one
+NTRIPLES_BLANK_NODE = re.compile(r'<[^>]*>|"(?:[^"\\]|\\.)*"|_:')
+VARIABLE_NAME = re.compile(r'^[?$]?([A-Za-z0-9_]+)$')
+
+
+def page_query(query: str, page_size: int, page: int) -> str:
+    """
+    Get the query for a single page of the results.
+    :param query:
+    :param page_size:   The number of solutions per page.
+    :param page:        The number of the page, starting at 0.
+    :return:
+    """
+    return f"{query.rstrip()}\nLIMIT {page_size}\nOFFSET {page * page_size}\n"
+
+
+def partition_query(query: str, variable: str, value: str) -> str:
+    """
+    Restrict a query to a single partition, by binding the variable at the start of the WHERE
+    clause.
+    :param query:
+    :param variable:    The name of the variable (without ?).
+    :param value:       The value of the variable in SPARQL syntax, e.g. <http://...>
+    :return:
+    """
+    match = WHERE_CLAUSE.search(query)
+    if match is None:
+        raise InvalidConfigurationException("A partitioned query needs a WHERE clause")
+    return f"{query[:match.end()]}\n  VALUES ?{variable} {{ {value} }}\n{query[match.end():]}"
+
+
+def sparql_term(binding: dict) -> Optional[str]:
+    """
+    Serialize a value of SPARQL JSON results in SPARQL syntax.
+    :param binding:
+    :return: None for blank nodes, which can't be used in another query.
+    """
+    if binding['type'] == 'uri':
+        return f"<{binding['value']}>"
+    if binding['type'] in ['literal', 'typed-literal']:
+        literal = json.dumps(binding['value'], ensure_ascii=False)
+        if 'xml:lang' in binding:
+            return f"{literal}@{binding['xml:lang']}"
+        if 'datatype' in binding:
+            return f"{literal}^^<{binding['datatype']}>"
+        return literal
+    return None
+
+
+def relabel_blank_nodes(line: str, prefix: str) -> str:
+    """
+    Add a prefix to the blank node labels in a line of N-Triples.
+    :param line:
+    :param prefix:
+    :return:
+    """
+    if '_:' not in line:
+        return line
+    return NTRIPLES_BLANK_NODE.sub(
+        lambda match: f"_:{prefix}" if match.group() == '_:' else match.group(), line)
+
+
+def iter_blocks(lines: Iterator[str], size: int) -> Iterator[str]:
+    """
+    Join lines into blocks of (at most) size lines.
+    :param lines:
+    :param size:
+    :return:
+    """
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= size:
+            yield ''.join(block)
+            block = []
+    if block:
+        yield ''.join(block)
+
+
+class PagedQuery:
+    """
+    Runs the query of a sparql source in pages and/or partitions, as configured in the source.
+    """
+
+    def __init__(self, config_data: dict, data_dir: str):
+        """
+        Create a new PagedQuery.
+        :param config_data: The configuration of the source, with page_size and/or partitions.
+        :param data_dir:    The data directory of the application
+        """
+        self.config_data = config_data
+        self.data_dir = data_dir
+        self.page_size = int(config_data.get('page_size', 0))
+        self.page_format = config_data.get('format', 'ttl')
+        if self.page_format not in PAGE_FORMATS:
+            raise InvalidConfigurationException(
+                f"Paged queries can't be requested as '{self.page_format}'")
+
+
+    def queries(self) -> list[str]:
+        """
+        Get the query of every partition, or only the query when it isn't partitioned.
+        :return:
+        """
+        query = read_sparql_query(self.config_data, self.data_dir)
+        if self.page_size > 0:
+            if SOLUTION_MODIFIER.search(query):
+                raise InvalidConfigurationException(
+                    "A paged query can't have its own LIMIT or OFFSET")
+            if 'ORDER BY' not in query.upper():
+                print("Warning: paged query without ORDER BY, the pages may not be stable")
+        partitions = self.config_data.get('partitions')
+        if partitions is None:
+            return [query]
+        match = VARIABLE_NAME.match(str(partitions.get('variable', '')))
+        if match is None:
+            raise InvalidConfigurationException("The partitions need a variable")
+        return [partition_query(query, match.group(1), value)
+                for value in self.partition_values(match.group(1))]
+
+
+    def partition_values(self, variable: str) -> list[str]:
+        """
+        Get the values of the partitions, from the configuration or by running their query.
+        :param variable:
+        :return:
+        """
+        partitions = self.config_data['partitions']
+        if 'values' in partitions:
+            return [str(value) for value in partitions['values']]
+        if 'query_location' not in partitions:
+            raise InvalidConfigurationException("The partitions need values or a query_location")
+        query = read_sparql_query(partitions, self.data_dir)
+        with self.open(query, 'application/sparql-results+json') as fp:
+            results = json.loads(''.join(decode_lines(fp)))
+        values = []
+        for row in results['results']['bindings']:
+            value = sparql_term(row[variable]) if variable in row else None
+            if value is not None:
+                values.append(value)
+        print(f"Querying {len(values)} partitions")
+        return values
+
+
+    def open(self, query: str, accept: str) -> IO:
+        """
+        Run a query on the endpoint of the source.
+        :param query:
+        :param accept:
+        :return:
+        """
+        try:
+            return open_url(sparql_request(self.config_data, query, accept), self.config_data,
+                            self.data_dir)
+        except URLError as e:
+            print(f"Error '{e}'")
+            raise VocabularyLoadingException from e
+
+
+    def page_lines(self, fp: IO, prefix: str) -> Iterator[str]:
+        """
+        Read the triples of a page as N-Triples.
+        :param fp:      The response of the page query.
+        :param prefix:  Added to the blank node labels.
+        :return:
+        """
+        if self.page_format in TURTLE_FORMATS:
+            yield from TurtleConverter(prefix).convert_file(fp)
+            return
+        for line in decode_lines(fp):
+            if line.strip() and not line.lstrip().startswith('#'):
+                line = relabel_blank_nodes(line, prefix)
+                yield line if line.endswith('\n') else line + '\n'
+
+
+    def run(self, query: str, label: str, stopped: threading.Event) -> Iterator[str]:
+        """
+        Run the query of a partition page by page, until a page is empty.
+        :param query:
+        :param label:   Keeps the blank nodes of the pages apart.
+        :param stopped: Stops fetching pages when set.
+        :return: Blocks of N-Triples, a page ends a block.
+        """
+        page = 0
+        while not stopped.is_set():
+            paged = query if self.page_size <= 0 else page_query(query, self.page_size, page)
+            empty = True
+            with self.open(paged, PAGE_FORMATS[self.page_format]) as fp:
+                for block in iter_blocks(self.page_lines(fp, f"{label}p{page}"), BLOCK_LINES):
+                    empty = False
+                    yield block
+            if self.page_size <= 0 or empty:
+                return
+            page += 1
+
+
+class MergedSource:
+    """
+    A read-only file with the N-Triples of several queries, which run in background threads.
+    """
+
+    def __init__(self, paged_query: PagedQuery, queries: list[str], concurrency: int):
+        """
+        Start running the queries.
+        :param paged_query:
+        :param queries:
+        :param concurrency: The number of queries running at the same time.
+        """
+        self._queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._buffer = b''
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                            thread_name_prefix="sparql")
+        self._futures: list[Future] = [
+            self._executor.submit(self._run, paged_query, query, index)
+            for index, query in enumerate(queries)
+        ]
+        self._running = len(self._futures)
+
+
+    def _put(self, item) -> None:
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+    def _run(self, paged_query: PagedQuery, query: str, index: int) -> None:
+        try:
+            for block in paged_query.run(query, f"q{index}", self._stopped):
+                self._put(block.encode('utf-8'))
+        finally:
+            # Tells the reader this query is done, it raises the error of the query (if any)
+            self._put(index)
+
+
+    def _next_block(self) -> Optional[bytes]:
+        while self._running > 0:
+            item = self._queue.get()
+            if isinstance(item, int):
+                self._running -= 1
+                self._futures[item].result()
+                continue
+            return item
+        return None
+
+
+    def peek(self) -> None:
+        """
+        Wait for the first results (or the first error).
+        :return:
+        """
+        if not self._buffer:
+            self._buffer = self._next_block() or b''
+
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read (up to size bytes of) the results.
+        :param size:
+        :return:
+        """
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            block = self._next_block()
+            if block is None:
+                break
+            chunks.append(block)
+            length += len(block)
+        data = b''.join(chunks)
+        if size < 0:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+    def readline(self, size: int = -1) -> bytes:
+        """
+        Read (up to size bytes of) the next line of the results.
+        :param size:
+        :return:
+        """
+        while b'\n' not in self._buffer:
+            block = self._next_block()
+            if block is None:
+                break
+            self._buffer += block
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+
+    def __iter__(self):
+        block, self._buffer = self._buffer, b''
+        while block:
+            yield from block.splitlines(keepends=True)
+            block = self._next_block()
+
+
+    def close(self) -> None:
+        """
+        Stop the queries.
+        :return:
+        """
+        self._stopped.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._running = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_paged_query(config_data: dict, data_dir: str) -> IO:
+    """
+    Run the query of a sparql source in pages and/or partitions, as configured in the source.
+    :param config_data: The configuration of the source.
+    :param data_dir:    The data directory of the application
+    :return: The merged N-Triples of all pages.
+    """
+    paged_query = PagedQuery(config_data, data_dir)
+    source = MergedSource(paged_query, paged_query.queries(),
+                          int(config_data.get('concurrency', DEFAULT_CONCURRENCY)))
+    with ExitStack() as stack:
+        stack.callback(source.close)
+        # Errors of the first request are raised here, so the fallback can be used
+        source.peek()
+        stack.pop_all()
+    return source
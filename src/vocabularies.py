@@ -1,21 +1,52 @@
 """
 This file contains functions for dealing with vocabularies and their configuration.
 """
+import gzip
 import json
 import re
 import urllib.request
 import urllib.parse
 from pathlib import Path
-from typing import IO, TextIO
-from urllib.error import URLError
+from typing import IO, Iterable, Iterator, Optional, TextIO, Union
+from urllib.error import HTTPError, URLError
 
 import yaml
 
 from src.exceptions import (
     InvalidConfigurationException,
     UnknownAuthenticationTypeException,
-    VocabularyLoadingException
+    VocabularyLoadingException,
+    VocabularyNotModifiedException
 )
+from src.http_cache import HttpCache, cache_key
+
+# Content-Encodings which are decompressed while reading a response
+GZIP_ENCODINGS = ["gzip", "x-gzip"]
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Seconds a remote source may stall, while connecting or between blocks, before it fails
+SOURCE_TIMEOUT = 300
+
+# The mimetypes of the RDF formats, by extension (or format in the yaml)
+MIME_TYPES = {
+    'ttl': "text/turtle",
+    'turtle': "text/turtle",
+    'trig': "application/trig",
+    'nt': "application/n-triples",
+    'ntriples': "application/n-triples",
+    'nq': "application/n-quads",
+    'nquads': "application/n-quads",
+    'rdf': "application/rdf+xml",
+    'owl': "application/rdf+xml",
+    'xml': "application/rdf+xml",
+    'jsonld': "application/ld+json",
+    # RDF4J binary RDF, parsed fastest by GraphDB
+    'brf': "application/x-binary-rdf",
+}
+DEFAULT_MIME_TYPE = "text/turtle"
+
+# Matches the sparqlGraph of a vocabulary config (with any prefix or as full IRI)
+SPARQL_GRAPH = re.compile(r'(?:[\w.-]*:|<[^<>\s]*[#/])sparqlGraph>?\s+<([^>\s]*)>')
 
 
 def get_type(extension: str) -> str:
@@ -24,12 +55,9 @@ def get_type(extension: str) -> str:
     :param extension:
     :return:
     """
-    if extension in ["ttl", "turtle"]:
-        return "text/turtle"
-    if extension in ["trig"]:
-        return "application/trig"
-    # Default
-    return "text/turtle"
+    if extension not in MIME_TYPES:
+        print(f"Unknown format '{extension}', sending it as {DEFAULT_MIME_TYPE}")
+    return MIME_TYPES.get(extension, DEFAULT_MIME_TYPE)
 
 
 def set_auth_data(
@@ -65,15 +93,135 @@ def set_auth_data(
     return req
 
 
-def get_file_from_config(config_data: dict, data_dir: str) -> TextIO:
+class GzipResponse(gzip.GzipFile):
+    """
+    Decompresses a gzip compressed http response while it is read, keeping its headers.
+    """
+
+    def __init__(self, response):
+        """
+        Create a new GzipResponse.
+        :param response:    The http response to decompress.
+        """
+        super().__init__(fileobj=response, mode='rb')
+        self.response = response
+        self.headers = response.headers
+        self.status = response.status
+
+
+    def close(self) -> None:
+        """
+        Close the response as well.
+        :return:
+        """
+        try:
+            super().close()
+        finally:
+            self.response.close()
+
+
+def is_compressed(location: str) -> bool:
+    """
+    Check if a file is gzip compressed, based on its extension.
+    :param location: The path or url of the file.
+    :return:
+    """
+    return location.split('?')[0].endswith('.gz')
+
+
+def decompress_response(response, location: str) -> IO:
+    """
+    Decompress a response while it is read, when it is compressed.
+    :param response:    The http response.
+    :param location:    The url of the response.
+    :return:
+    """
+    if response.headers.get('Content-Encoding', '').lower() in GZIP_ENCODINGS:
+        response = GzipResponse(response)
+    if is_compressed(location) and response.peek(2).startswith(GZIP_MAGIC):
+        # A compressed file, which is still compressed after decoding the transfer
+        response = GzipResponse(response)
+    return response
+
+
+def open_file(path: str) -> TextIO:
+    """
+    Open a local file, decompressing it while it is read when it is gzip compressed.
+    :param path:
+    :return:
+    """
+    if is_compressed(path):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def open_url(req: urllib.request.Request, config_data: dict, data_dir: str,
+             cache: Optional[HttpCache] = None) -> IO:
+    """
+    Open the request, making it conditional when validators for the source are cached.
+    :param req:         The request to open.
+    :param config_data: The configuration the request was created from.
+    :param data_dir:    The data directory of the application
+    :param cache:       The validator cache, or None for an unconditional request.
+    :return:
+    """
+    if cache is not None:
+        cache.apply(cache_key(config_data, data_dir), req)
+    if not req.has_header('Accept-encoding'):
+        req.add_header('Accept-Encoding', 'gzip')
+    try:
+        return decompress_response(urllib.request.urlopen(req, timeout=SOURCE_TIMEOUT),
+                                   config_data['location'])
+    except HTTPError as e:
+        if e.code == 304:
+            raise VocabularyNotModifiedException(config_data['location']) from e
+        raise
+
+
+def read_sparql_query(config_data: dict, data_dir: str) -> str:
+    """
+    Read the query of a sparql source.
+    :param config_data: The configuration, with the query_location in the data dir.
+    :param data_dir:    The data directory of the application
+    :return:
+    """
+    with open(f"{data_dir}/{config_data['query_location']}", encoding='utf-8') as file:
+        return file.read()
+
+
+def sparql_request(config_data: dict, query: str,
+                   accept: str = 'text/turtle') -> urllib.request.Request:
+    """
+    Create the request running a query on the endpoint of a sparql source.
+    :param config_data: The configuration, with the endpoint as location.
+    :param query:
+    :param accept:      The requested format, the headers in the configuration can override it.
+    :return:
+    """
+    req = urllib.request.Request(
+        config_data['location'],
+        method='POST',
+        data=urllib.parse.urlencode({'query': query}).encode()
+    )
+    req.add_header('Accept', accept)
+    if 'headers' in config_data:
+        for header, val in config_data['headers'].items():
+            req.add_header(header, val)
+    return req
+
+
+def get_file_from_config(config_data: dict, data_dir: str,
+                         cache: Optional[HttpCache] = None) -> TextIO:
     """
     Get the config file from yaml data.
     :param config_data: The configuration, a dict with information about the file.
     :param data_dir:    The data directory of the application
+    :param cache:       When given, remote sources are requested conditionally. An unchanged
+                        source raises a VocabularyNotModifiedException.
     :return:
     """
     if config_data['type'] == 'file':
-        return open(f"{data_dir}/{config_data['location']}", encoding='utf-8')
+        return open_file(f"{data_dir}/{config_data['location']}")
     try:
         if config_data['type'] == 'fetch':
             req = urllib.request.Request(config_data['location'])
@@ -85,7 +233,7 @@ def get_file_from_config(config_data: dict, data_dir: str) -> TextIO:
                 auth_data = config_data['auth']
                 req = set_auth_data(auth_data, config_data, req)
 
-            return urllib.request.urlopen(req)
+            return open_url(req, config_data, data_dir, cache)
         if config_data['type'] == 'post':
             endpoint = config_data['location']
             body = config_data['body']
@@ -98,24 +246,11 @@ def get_file_from_config(config_data: dict, data_dir: str) -> TextIO:
             if 'headers' in config_data:
                 for header, val in config_data['headers'].items():
                     req.add_header(header, val)
-            return urllib.request.urlopen(req)
+            return open_url(req, config_data, data_dir, cache)
 
         if config_data['type'] == 'sparql':
-            with open(f"{data_dir}/{config_data['query_location']}", encoding='utf-8') as file:
-                sparql_query = file.read()
-            endpoint = config_data['location']
-            data_dict = {'query': sparql_query}
-            req = urllib.request.Request(
-                endpoint,
-                method='POST',
-                data=urllib.parse.urlencode(data_dict).encode()
-            )
-            req.add_header('Accept', 'text/turtle')
-            if 'headers' in config_data:
-                for header, val in config_data['headers'].items():
-                    req.add_header(header, val)
-
-            return urllib.request.urlopen(req)
+            req = sparql_request(config_data, read_sparql_query(config_data, data_dir))
+            return open_url(req, config_data, data_dir, cache)
 
     except URLError as e:
         print(f"Error '{e}'")
@@ -123,21 +258,47 @@ def get_file_from_config(config_data: dict, data_dir: str) -> TextIO:
     raise InvalidConfigurationException("Unknown type")
 
 
-def get_graph(fp: IO) -> str:
+def decode_lines(source: Iterable) -> Iterator[str]:
     """
-    Get the sparql graph from the given vocab
-    :param fp:  The vocabulary config, a file pointer
+    Iterate over the lines of a file, decoding them when they are bytes.
+    :param source:  A file pointer to a source file (text or binary).
     :return:
     """
-    for line in fp:
+    for line in source:
         try:
-            line = line.decode('utf-8')
+            line = line.decode()
         except (UnicodeDecodeError, AttributeError):
-            # Already decoded
             pass
-        if re.search("sparqlGraph", line):
-            return line.strip().split(" ")[1].strip("<>")
-    return ""
+        yield line
+
+
+def read_config(config_data: dict, data_dir: str) -> str:
+    """
+    Fetch a vocabulary config and return its contents.
+    :param config_data: The configuration, a dict with information about the file.
+    :param data_dir:    The data directory of the application
+    :return:
+    """
+    with get_file_from_config(config_data, data_dir) as fp:
+        return ''.join(decode_lines(fp))
+
+
+def get_graph(config: Union[str, IO]) -> str:
+    """
+    Get the sparql graph from the given vocab
+    :param config:  The vocabulary config, its contents or a file pointer
+    :return:
+    """
+    if not isinstance(config, str):
+        config = ''.join(decode_lines(config))
+    match = SPARQL_GRAPH.search(config)
+    if match is None:
+        if "sparqlGraph" in config:
+            raise InvalidConfigurationException(
+                "The sparqlGraph of the vocabulary config must be a full IRI, e.g. "
+                "skosmos:sparqlGraph <http://example.com/graph>")
+        return ""
+    return match.group(1)
 
 
 def load_vocab_yaml(file_location: Path) -> dict:
@@ -150,6 +311,16 @@ def load_vocab_yaml(file_location: Path) -> dict:
         return yaml.safe_load(fp)
 
 
+def is_paged_query(source_data: dict) -> bool:
+    """
+    Check if a sparql source is queried in pages or partitions, which are merged into N-Triples.
+    :param source_data:
+    :return:
+    """
+    return source_data.get('type') == 'sparql' and (
+        'page_size' in source_data or 'partitions' in source_data)
+
+
 def get_vocab_format(source_data: dict) -> str:
     """
     Return the vocab format of the given data source. It is either based on the file extension,
@@ -157,6 +328,11 @@ def get_vocab_format(source_data: dict) -> str:
     :param source_data:
     :return:
     """
+    if is_paged_query(source_data):
+        return "nt"
     if 'format' in source_data:
         return source_data['format']
-    return source_data['location'].split('?')[0].split('.')[-1]
+    location = source_data['location'].split('?')[0]
+    if is_compressed(location):
+        location = location[:-len('.gz')]
+    return location.split('.')[-1]
@@ -0,0 +1,144 @@
+"""
+This file contains the warm-up of a graph after it is loaded: the queries Skosmos runs for every
+vocabulary are run once, so the first users don't have to wait for the caches of the triple store.
+"""
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+from src.database import DatabaseConnector, sparql_iri
+from src.exceptions import InvalidConfigurationException
+from src.metrics import RunMetrics
+from src.replicas import read_stores
+from src.sparql_source import partition_query
+
+SKOS_PREFIX = "PREFIX skos: <http://www.w3.org/2004/02/skos/core#>\n"
+
+# The built-in warm-up queries, ?graph is bound to the loaded graph
+WARMUP_QUERIES = {
+    'top_concepts': SKOS_PREFIX + """SELECT ?top ?label WHERE {
+  GRAPH ?graph {
+    { ?scheme skos:hasTopConcept ?top . } UNION { ?top skos:topConceptOf ?scheme . }
+    OPTIONAL { ?top skos:prefLabel ?label . }
+  }
+}""",
+    'alphabetical_index': SKOS_PREFIX + """SELECT DISTINCT ?letter WHERE {
+  GRAPH ?graph {
+    ?concept a skos:Concept ; skos:prefLabel|skos:altLabel ?label .
+    BIND(UCASE(SUBSTR(STR(?label), 1, 1)) AS ?letter)
+  }
+}""",
+    'labels': SKOS_PREFIX + """SELECT ?concept ?label WHERE {
+  GRAPH ?graph { ?concept skos:prefLabel ?label . }
+}
+LIMIT 1000""",
+    'search': SKOS_PREFIX + """SELECT DISTINCT ?concept ?label WHERE {
+  GRAPH ?graph {
+    ?concept skos:prefLabel|skos:altLabel|skos:hiddenLabel ?label .
+    FILTER(STRSTARTS(LCASE(STR(?label)), "a"))
+  }
+}
+LIMIT 100""",
+    'statistics': """SELECT ?type (COUNT(?resource) AS ?count) WHERE {
+  GRAPH ?graph { ?resource a ?type . }
+}
+GROUP BY ?type""",
+}
+
+
+@dataclass
+class WarmupSettings:
+    """
+    Settings for warming up the caches of the triple store after loading a graph.
+    """
+    enabled: bool = False
+    # Directory (in the data dir) with .rq files replacing the built-in queries
+    queries_dir: Optional[str] = None
+    # Number of queries running at the same time
+    concurrency: int = 4
+    # Seconds the queries of a graph may take together
+    budget: float = 30
+
+
+def warmup_queries(settings: WarmupSettings, data_dir: str) -> dict[str, str]:
+    """
+    Get the warm-up queries, by name.
+    :param settings:
+    :param data_dir:    The data directory of the application
+    :return:
+    """
+    if not settings.queries_dir:
+        return dict(WARMUP_QUERIES)
+    queries = {}
+    for path in sorted(glob.glob(os.path.join(data_dir, settings.queries_dir, "*.rq"))):
+        with open(path, encoding='utf-8') as fp:
+            queries[Path(path).stem] = fp.read()
+    return queries
+
+
+def warm_up(database: DatabaseConnector, graph_name: str, queries: dict[str, str],
+            settings: WarmupSettings) -> int:
+    """
+    Run the warm-up queries on a graph, concurrently and within the time budget. Queries which
+    fail or don't complete in time are skipped.
+    :param database:
+    :param graph_name:
+    :param queries:     The queries by name, ?graph is bound to the graph.
+    :param settings:
+    :return: The number of queries which completed.
+    """
+    deadline = time.monotonic() + settings.budget
+    graph = sparql_iri(graph_name)
+
+    def run(query: str) -> None:
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            database.sparql_query(partition_query(query, "graph", graph), remaining)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, settings.concurrency),
+                                  thread_name_prefix="warmup")
+    futures = {executor.submit(run, query): name for name, query in queries.items()}
+    done, not_done = wait(futures, timeout=settings.budget)
+    # Queries which are still running end with their timeout
+    executor.shutdown(wait=False, cancel_futures=True)
+    completed = 0
+    for future in done:
+        try:
+            future.result()
+            completed += 1
+        except (requests.RequestException, InvalidConfigurationException) as e:
+            print(f"Warm-up query {futures[future]} failed: {e}")
+    if not_done:
+        print(f"{len(not_done)} warm-up queries didn't complete within {settings.budget}s")
+    return completed
+
+
+def warm_up_graph(database: DatabaseConnector, graph_name: str, settings: WarmupSettings,
+                  data_dir: str, metrics: RunMetrics) -> None:
+    """
+    Refresh the full-text index of a graph which was just loaded and, when enabled, run the
+    warm-up queries on every store it is read from. Failures are logged, they don't fail the load.
+    :param database:
+    :param graph_name:
+    :param settings:
+    :param data_dir:    The data directory of the application
+    :param metrics:
+    :return:
+    """
+    try:
+        database.refresh_search_index([graph_name])
+    except requests.RequestException as e:
+        print(f"Refreshing the full-text index of {graph_name} failed: {e}")
+    if not settings.enabled:
+        return
+    queries = warmup_queries(settings, data_dir)
+    stores = read_stores(database)
+    with metrics.phase("warmup", queries=len(queries) * len(stores)) as record:
+        completed = sum(warm_up(store, graph_name, queries, settings) for store in stores)
+        record['skipped'] = len(queries) * len(stores) - completed
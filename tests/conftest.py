@@ -0,0 +1,18 @@
+"""
+Fixtures shared by the tests.
+"""
+import pytest
+
+from benchmarks.store import StandInStore, StoreState
+
+
+@pytest.fixture(name="store")
+def fixture_store():
+    """
+    A running stand-in triple store.
+    :return:
+    """
+    store = StandInStore(StoreState())
+    store.start()
+    yield store
+    store.stop()
@@ -0,0 +1,170 @@
+"""
+Tests for loading vocabularies in batches, and resuming an interrupted load.
+"""
+import pytest
+
+from src.batches import BatchLoader, BatchProgress, BatchSettings
+from src.exceptions import VocabularyLoadingException
+
+GRAPH = "http://example.com/graph"
+
+
+def triples(count: int, subject: str = "<http://example.com/s>") -> str:
+    """
+    N-Triples with count triples.
+    :param count:
+    :param subject:
+    :return:
+    """
+    return ''.join(f"{subject} <http://example.com/p> \"{i}\" .\n" for i in range(count))
+
+
+class RecordingDatabase:
+    """
+    Keeps the batches it receives, failing for the batches containing one of the given texts.
+    """
+
+    def __init__(self, failing: tuple[str, ...] = ()):
+        self.failing = failing
+        self.batches: list[tuple[str, bool]] = []
+        self.rest: list[tuple[str, bool]] = []
+
+
+    def add_vocabulary_batch(self, batch: bytes, graph_name: str, extension: str,
+                             append: bool) -> None:
+        """
+        Record a batch, see DatabaseConnector.add_vocabulary_batch.
+        """
+        assert (graph_name, extension) == (GRAPH, "nt")
+        text = batch.decode('utf-8')
+        if any(failing in text for failing in self.failing):
+            raise VocabularyLoadingException("Rejected")
+        self.batches.append((text, append))
+
+
+    def add_vocabulary(self, graph, graph_name: str, extension: str, append: bool) -> int:
+        """
+        Record the rest of a vocabulary, see DatabaseConnector.add_vocabulary.
+        """
+        assert (graph_name, extension) == (GRAPH, "nt")
+        self.rest.append((b''.join(graph).decode('utf-8'), append))
+        return 200
+
+
+def load(database: RecordingDatabase, path, progress_dir) -> None:
+    """
+    Load a file in batches of 2 triples, one at a time and without retries.
+    :param database:
+    :param path:
+    :param progress_dir:
+    :return:
+    """
+    settings = BatchSettings(batch_size=2, retries=0, progress_dir=str(progress_dir))
+    with open(path, 'rb') as fp:
+        BatchLoader(database, settings).load(fp, GRAPH, "nt")
+
+
+def test_batches_replace_then_append(tmp_path):
+    """
+    The first batch replaces the graph and the others are appended to it.
+    :param tmp_path:
+    :return:
+    """
+    source = tmp_path / "source.nt"
+    source.write_text(triples(5))
+    database = RecordingDatabase()
+    load(database, source, tmp_path / "progress")
+
+    assert [append for _, append in database.batches] == [False, True, True]
+    assert ''.join(text for text, _ in database.batches) == triples(5)
+    assert not BatchProgress(str(tmp_path / "progress"), GRAPH).interrupted()
+
+
+def test_interrupted_load_resumes(tmp_path):
+    """
+    After a failed batch, the next load of the same source only sends the missing batches.
+    :param tmp_path:
+    :return:
+    """
+    source = tmp_path / "source.nt"
+    source.write_text(triples(8))
+    failed = RecordingDatabase(failing=('"4"',))
+    with pytest.raises(VocabularyLoadingException):
+        load(failed, source, tmp_path / "progress")
+    assert BatchProgress(str(tmp_path / "progress"), GRAPH).interrupted()
+
+    resumed = RecordingDatabase()
+    load(resumed, source, tmp_path / "progress")
+
+    lines = triples(8).splitlines(keepends=True)
+    batches = [''.join(lines[i:i + 2]) for i in range(0, 8, 2)]
+    assert failed.batches == [(batches[0], False), (batches[1], True)]
+    assert resumed.batches == [(batches[2], True), (batches[3], True)]
+    assert not BatchProgress(str(tmp_path / "progress"), GRAPH).interrupted()
+
+
+def test_changed_source_starts_over(tmp_path):
+    """
+    The progress of an interrupted load isn't used for a different version of the source.
+    :param tmp_path:
+    :return:
+    """
+    source = tmp_path / "source.nt"
+    source.write_text(triples(6))
+    with pytest.raises(VocabularyLoadingException):
+        load(RecordingDatabase(failing=('"4"',)), source, tmp_path / "progress")
+
+    source.write_text(triples(6, "<http://example.com/other>"))
+    database = RecordingDatabase()
+    load(database, source, tmp_path / "progress")
+
+    assert [append for _, append in database.batches] == [False, True, True]
+    assert ''.join(text for text, _ in database.batches) == triples(6, "<http://example.com/other>")
+
+
+def test_changed_batch_is_rejected(tmp_path):
+    """
+    A batch which differs from the one loaded before, with the same identity, drops the progress.
+    :param tmp_path:
+    :return:
+    """
+    progress = BatchProgress(str(tmp_path), GRAPH, "identity")
+    progress.mark_done(0, "digest")
+
+    resumed = BatchProgress(str(tmp_path), GRAPH, "identity")
+    assert resumed.is_done(0, "digest")
+    assert not resumed.is_done(1, "other")
+    with pytest.raises(VocabularyLoadingException):
+        resumed.is_done(0, "other")
+    assert not resumed.interrupted()
+    assert not BatchProgress(str(tmp_path), GRAPH, "identity").done
+
+
+def test_unknown_identity_isnt_resumed(tmp_path):
+    """
+    Without an identity for the source, progress is neither stored nor resumed.
+    :param tmp_path:
+    :return:
+    """
+    BatchProgress(str(tmp_path), GRAPH, "identity").mark_done(0, "digest")
+
+    progress = BatchProgress(str(tmp_path), GRAPH)
+    assert not progress.done
+    progress.mark_done(1, "digest")
+    assert BatchProgress(str(tmp_path), GRAPH, "identity").done == {0: "digest"}
+
+
+def test_blank_nodes_are_sent_together(tmp_path):
+    """
+    From the first batch with a blank node label on, the rest is sent in one request.
+    :param tmp_path:
+    :return:
+    """
+    source = tmp_path / "source.nt"
+    blank_nodes = triples(2, "_:b") + triples(3)
+    source.write_text(triples(2) + blank_nodes)
+    database = RecordingDatabase()
+    load(database, source, tmp_path / "progress")
+
+    assert database.batches == [(triples(2), False)]
+    assert database.rest == [(blank_nodes, True)]
@@ -0,0 +1,152 @@
+"""
+Tests for the streaming Turtle to N-Triples conversion and the Turtle statement splitter, comparing
+their output with the graphs rdflib parses from the same Turtle.
+"""
+import io
+
+import pytest
+
+from src.batches import iter_turtle_batches, iter_turtle_statements
+from src.convert import TurtleConverter, convert_source
+
+rdflib = pytest.importorskip("rdflib")
+compare = pytest.importorskip("rdflib.compare")
+
+DOCUMENTS = {
+    'prefixes': """
+@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix : <http://example.com/> .
+PREFIX ex: <http://example.com/ex/>
+@base <http://example.com/base/> .
+:a skos:broader ex:b .
+<relative> skos:related <../up#x> .
+BASE <http://example.org/other/>
+<c> skos:related :a .
+""",
+    'collections': """
+@prefix ex: <http://example.com/> .
+ex:a ex:list ( ex:b "two" 3 ( ex:nested ) ) .
+ex:b ex:empty () .
+( ex:c ex:d ) ex:subject true .
+""",
+    'nested_blank_nodes': """
+@prefix ex: <http://example.com/> .
+ex:a ex:p [ ex:q [ ex:r "deep" ; ex:s ex:b ] , [ ex:t 1.5 ] ] .
+[ ex:u "subject" ] ex:v [] .
+[ ex:only "property list" ] .
+_:label ex:w _:label .
+""",
+    'multi_line_literals': '''
+@prefix ex: <http://example.com/> .
+ex:a ex:note """First line
+second line with "quotes" and ""two quotes""
+third line""" ;
+    ex:other \'\'\'single
+quoted\'\'\'@en ;
+    ex:end """ends with a quote\\"""" .
+''',
+    'escapes': r"""
+@prefix ex: <http://example.com/> .
+ex:a ex:tab "a\tb" ;
+    ex:newline "a\nb" ;
+    ex:quote "say \"hi\"" ;
+    ex:backslash "back\\slash" ;
+    ex:unicode "café \U0001F600" ;
+    ex:iri <http://example.com/é> .
+ex:local\-name ex:p ex:with\.dot .
+""",
+    'a': """
+@prefix skos: <http://www.w3.org/2004/02/skos/core#> .
+@prefix ex: <http://example.com/> .
+ex:scheme a skos:ConceptScheme .
+ex:concept a skos:Concept , ex:Other ; skos:inScheme ex:scheme .
+""",
+    'literals': """
+@prefix ex: <http://example.com/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+ex:a ex:int -5 ; ex:decimal .5 ; ex:double 1e10 ; ex:bool false ;
+    ex:lang "kleur"@nl-BE ; ex:typed "2024-01-01"^^xsd:date ; ex:prefixed "x"^^ex:type .
+""",
+}
+
+
+def converted(document: str) -> rdflib.Graph:
+    """
+    Convert a Turtle document to N-Triples, and parse the N-Triples.
+    :param document:
+    :return:
+    """
+    source = convert_source(io.BytesIO(document.encode('utf-8')), "ttl", "nt")
+    return rdflib.Graph().parse(data=source.read().decode('utf-8'), format="nt")
+
+
+def parsed(document: str) -> rdflib.Graph:
+    """
+    Parse a Turtle document with rdflib.
+    :param document:
+    :return:
+    """
+    return rdflib.Graph().parse(data=document, format="turtle")
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_conversion_matches_rdflib(name):
+    """
+    The converted N-Triples are the same graph rdflib parses.
+    :param name:
+    :return:
+    """
+    expected = parsed(DOCUMENTS[name])
+    assert len(expected) > 0
+    assert compare.isomorphic(converted(DOCUMENTS[name]), expected)
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_conversion_reads_in_small_blocks(name):
+    """
+    Reading the converted source in blocks which split the lines doesn't change it.
+    :param name:
+    :return:
+    """
+    source = convert_source(io.BytesIO(DOCUMENTS[name].encode('utf-8')), "ttl", "nt")
+    data = b''.join(iter(lambda: source.read(7), b''))
+    graph = rdflib.Graph().parse(data=data.decode('utf-8'), format="nt")
+    assert compare.isomorphic(graph, parsed(DOCUMENTS[name]))
+
+
+def test_blank_node_prefix_keeps_documents_apart():
+    """
+    Blank nodes of documents converted with another prefix get other labels.
+    :return:
+    """
+    first = TurtleConverter("a").convert("[] <http://example.com/p> 1 .")
+    second = TurtleConverter("b").convert("[] <http://example.com/p> 1 .")
+    assert first != second
+
+
+@pytest.mark.parametrize("name", sorted(DOCUMENTS))
+def test_statements_parse_on_their_own(name):
+    """
+    Every batch of the splitter is parsed separately by the triple store, with the prefixes.
+    :param name:
+    :return:
+    """
+    graph = rdflib.Graph()
+    for batch in iter_turtle_batches(io.BytesIO(DOCUMENTS[name].encode('utf-8')), 1):
+        graph += parsed(batch)
+    assert compare.isomorphic(graph, parsed(DOCUMENTS[name]))
+
+
+def test_statement_splitter():
+    """
+    Directives are recognized, and statements end at the dot after a multi-line literal.
+    :return:
+    """
+    statements = list(iter_turtle_statements(io.BytesIO(DOCUMENTS['prefixes'].encode('utf-8'))))
+    assert [is_directive for is_directive, _ in statements] == [
+        True, True, True, True, False, False, True, False
+    ]
+    statements = list(iter_turtle_statements(
+        io.BytesIO(DOCUMENTS['multi_line_literals'].encode('utf-8'))))
+    assert len(statements) == 2
+    assert 'third line"""' in statements[1][1]
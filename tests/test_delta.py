@@ -0,0 +1,142 @@
+"""
+Tests for loading N-Triples vocabularies as a delta against the previously loaded triples.
+"""
+import io
+
+import pytest
+
+from src import delta
+from src.delta import DeltaLoader, DeltaSettings, diff_sorted, sort_unique
+
+GRAPH = "http://example.com/graph"
+
+
+def triples(*objects: str) -> bytes:
+    """
+    N-Triples with a triple per object.
+    :param objects:
+    :return:
+    """
+    lines = [f"<http://example.com/s> <http://example.com/p> {o} .\n" for o in objects]
+    return ''.join(lines).encode('utf-8')
+
+
+class RecordingDatabase:  # pylint: disable=too-few-public-methods
+    """
+    Keeps the SPARQL updates it receives.
+    """
+
+    def __init__(self):
+        self.updates: list[str] = []
+
+
+    def sparql_update(self, update: str) -> None:
+        """
+        Record an update, see DatabaseConnector.sparql_update.
+        """
+        self.updates.append(update)
+
+
+def load(tmp_path, database: RecordingDatabase, content: bytes, max_fraction: float = 0.5):
+    """
+    Load a vocabulary as a delta and commit it.
+    :param tmp_path:
+    :param database:
+    :param content:
+    :param max_fraction:
+    :return: Whether the delta was sent, and what was loaded in full otherwise.
+    """
+    full_loads = []
+    settings = DeltaSettings(str(tmp_path / "snapshots"), True, max_fraction)
+    loader = DeltaLoader(database, settings, GRAPH)
+    sent = loader.load(io.BytesIO(content), lambda fp: full_loads.append(fp.read()))
+    loader.commit()
+    return sent, full_loads
+
+
+@pytest.mark.parametrize("old, new, expected", [
+    ([], [], []),
+    (["a", "b"], [], [(False, "a"), (False, "b")]),
+    ([], ["a", "b"], [(True, "a"), (True, "b")]),
+    (["a", "c", "e"], ["a", "c", "e"], []),
+    (["a", "c", "e"], ["b", "c", "f"], [(False, "a"), (True, "b"), (False, "e"), (True, "f")]),
+    (["b"], ["a", "b", "c"], [(True, "a"), (True, "c")]),
+])
+def test_diff_sorted(old, new, expected):
+    """
+    The lines only in old are removed, the lines only in new are added.
+    :param old:
+    :param new:
+    :param expected:
+    :return:
+    """
+    assert list(diff_sorted(old, new)) == expected
+
+
+def test_sort_unique_merges_runs(tmp_path, monkeypatch):
+    """
+    Lines sorted in separate runs are merged, without duplicates.
+    :param tmp_path:
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setattr(delta, "SORT_CHUNK_LINES", 2)
+    lines = ["d\n", "a\n", "c\n", "a\n", "b\n", "d\n", "e\n"]
+    assert list(sort_unique(lines, str(tmp_path))) == ["a\n", "b\n", "c\n", "d\n", "e\n"]
+
+
+def test_delta_after_snapshot(tmp_path):
+    """
+    Without a snapshot the graph is replaced, afterwards only the changes are sent.
+    :param tmp_path:
+    :return:
+    """
+    database = RecordingDatabase()
+    sent, full_loads = load(tmp_path, database, triples('"b"', '"a"', '"c"', '"d"'))
+    assert not sent
+    assert full_loads == [triples('"a"', '"b"', '"c"', '"d"')]
+
+    sent, full_loads = load(tmp_path, database, triples('"a"', '"b"', '"e"', '"c"'))
+    assert sent
+    assert not full_loads
+    removed = triples('"d"').decode('utf-8')
+    added = triples('"e"').decode('utf-8')
+    assert database.updates == [
+        f"DELETE DATA {{ GRAPH <{GRAPH}> {{\n{removed}}} }} ;\n"
+        f"INSERT DATA {{ GRAPH <{GRAPH}> {{\n{added}}} }}"
+    ]
+
+
+def test_too_many_changes_replace_the_graph(tmp_path):
+    """
+    A delta larger than max_fraction of the triples replaces the graph.
+    :param tmp_path:
+    :return:
+    """
+    database = RecordingDatabase()
+    load(tmp_path, database, triples('"a"', '"b"', '"c"', '"d"'), 0.25)
+    sent, full_loads = load(tmp_path, database, triples('"a"', '"b"', '"e"', '"f"'), 0.25)
+
+    assert not sent
+    assert full_loads == [triples('"a"', '"b"', '"e"', '"f"')]
+    assert not database.updates
+
+
+def test_blank_nodes_replace_the_graph(tmp_path):
+    """
+    Blank nodes can't be matched in a delta, so the graph is replaced.
+    :param tmp_path:
+    :return:
+    """
+    database = RecordingDatabase()
+    load(tmp_path, database, triples('"a"', '"b"', '"c"', '"d"'))
+    blank_node = b"_:b1 <http://example.com/p> <http://example.com/o> .\n"
+    sent, full_loads = load(tmp_path, database, triples('"a"', '"b"', '"c"', '"d"') + blank_node)
+
+    assert not sent
+    assert full_loads == [triples('"a"', '"b"', '"c"', '"d"') + blank_node]
+    assert not database.updates
+
+    # The snapshot of a graph with blank nodes isn't used for the next delta either
+    sent, _ = load(tmp_path, database, triples('"a"', '"b"', '"c"', '"d"'))
+    assert not sent
@@ -0,0 +1,38 @@
+"""
+Tests for the Fuseki connector, against the stand-in triple store of the benchmarks.
+"""
+import io
+
+import pytest
+
+from src.database_connectors.fuseki import create_connector
+
+SOURCE = b"""<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:skos="http://www.w3.org/2004/02/skos/core#">
+  <skos:Concept rdf:about="http://example.com/a"/>
+</rdf:RDF>
+"""
+
+TWEAKS = "<http://example.com/a> <http://example.com/p> \"tweak\" .\n"
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_parts_are_sent_in_one_request(store, compress):
+    """
+    The source and tweaks replace the graph with a single request.
+    :param store:
+    :param compress:
+    :return:
+    """
+    connector = create_connector(store.sparql_endpoint("fuseki"))
+    connector.compress_uploads = compress
+    store.state.graphs["http://example.com/graph"] = 100
+    status = connector.add_vocabulary_parts(
+        [(io.BytesIO(SOURCE), "rdf"), (io.StringIO(TWEAKS), "nt")], "http://example.com/graph")
+
+    assert status == 201
+    assert store.state.reset_statistics()['requests'] == {'upload': 1}
+    assert store.state.graphs == {
+        "http://example.com/graph": SOURCE.count(b'\n') + TWEAKS.count('\n')
+    }
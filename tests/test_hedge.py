@@ -0,0 +1,153 @@
+"""
+Tests for hedging slow sources by downloading their fallback at the same time.
+"""
+import io
+import threading
+
+import pytest
+
+from src.exceptions import VocabularyLoadingException, VocabularyNotModifiedException
+from src.hedge import HedgedDownload, hedged_source, is_slow
+
+SOURCE = b"<http://example.com/s> <http://example.com/p> \"source\" .\n"
+FALLBACK = b"<http://example.com/s> <http://example.com/p> \"fallback\" .\n"
+
+
+class StalledSource(io.BytesIO):
+    """
+    A source which doesn't send anything until it is released.
+    """
+
+    def __init__(self, content: bytes, released: threading.Event):
+        super().__init__(content)
+        self.released = released
+
+
+    def read(self, size=-1) -> bytes:
+        """
+        Read once the source is released.
+        """
+        assert self.released.wait(5)
+        return super().read(size)
+
+
+def opened(content: bytes):
+    """
+    Opens a source with the given content.
+    :param content:
+    :return:
+    """
+    return lambda: ({'location': content.decode('utf-8')}, io.BytesIO(content))
+
+
+def failing(error: Exception):
+    """
+    Fails to open a source.
+    :param error:
+    :return:
+    """
+    def open_source():
+        raise error
+    return open_source
+
+
+@pytest.fixture(name="released")
+def fixture_released():
+    """
+    Releases the stalled sources at the end of a test, so their threads end.
+    :return:
+    """
+    released = threading.Event()
+    yield released
+    released.set()
+
+
+@pytest.mark.parametrize("bytes_read, min_throughput, slow", [
+    (0, 0, True),
+    (1, 0, False),
+    (999, 100, True),
+    (1000, 100, False),
+])
+def test_is_slow(bytes_read, min_throughput, slow):
+    """
+    A source is slow without any bytes, or below the throughput by the deadline.
+    :param bytes_read:
+    :param min_throughput:
+    :param slow:
+    :return:
+    """
+    download = HedgedDownload("source", opened(SOURCE))
+    download.bytes_read = bytes_read
+    assert is_slow(download, 10, min_throughput) == slow
+
+
+def test_fast_source_isnt_hedged():
+    """
+    The fallback isn't opened when the source completes before the deadline.
+    :return:
+    """
+    opens = []
+    fallback = HedgedDownload("fallback", lambda: opens.append("fallback") or opened(FALLBACK)())
+    download, (_, fp) = hedged_source(HedgedDownload("source", opened(SOURCE)), fallback, 5)
+
+    assert download.name == "source"
+    assert not opens
+    with fp:
+        assert fp.read() == SOURCE
+    assert download.bytes_read == len(SOURCE)
+
+
+def test_stalled_source_is_hedged(released):
+    """
+    The fallback is downloaded when the source has nothing by the deadline, and the source is
+    cancelled when the fallback completes first.
+    :param released:
+    :return:
+    """
+    primary = HedgedDownload("source", lambda: ({}, StalledSource(SOURCE, released)))
+    download, (_, fp) = hedged_source(primary, HedgedDownload("fallback", opened(FALLBACK)), 0.1)
+
+    assert download.name == "fallback"
+    with fp:
+        assert fp.read() == FALLBACK
+    assert primary.cancelled
+
+
+def test_failing_source_falls_back_at_once():
+    """
+    A source which fails uses the fallback without waiting for the deadline.
+    :return:
+    """
+    primary = HedgedDownload("source", failing(VocabularyLoadingException("Unavailable")))
+    download, (source_data, fp) = hedged_source(
+        primary, HedgedDownload("fallback", opened(FALLBACK)), 60)
+
+    assert download.name == "fallback"
+    assert source_data == {'location': FALLBACK.decode('utf-8')}
+    fp.close()
+
+
+def test_both_failing_raise():
+    """
+    When the fallback fails as well, its error is raised.
+    :return:
+    """
+    with pytest.raises(VocabularyLoadingException, match="Fallback unavailable"):
+        hedged_source(
+            HedgedDownload("source", failing(VocabularyLoadingException("Unavailable"))),
+            HedgedDownload("fallback", failing(VocabularyLoadingException("Fallback unavailable"))),
+            60)
+
+
+def test_not_modified_source_isnt_hedged():
+    """
+    A source which isn't modified is raised, without opening the fallback.
+    :return:
+    """
+    opens = []
+    fallback = HedgedDownload("fallback", lambda: opens.append("fallback") or opened(FALLBACK)())
+    primary = HedgedDownload("source", failing(VocabularyNotModifiedException("Not modified")))
+
+    with pytest.raises(VocabularyNotModifiedException):
+        hedged_source(primary, fallback, 60)
+    assert not opens
@@ -0,0 +1,89 @@
+"""
+Tests for a run of the loader against the stand-in triple store of the benchmarks.
+"""
+import shutil
+
+import pytest
+
+import entrypoint
+from src import skosmos_config
+from src.database import TIMESTAMP_PREDICATE
+from src.hierarchy import SKOS
+
+VOCABULARIES = ["a", "b", "c"]
+
+
+@pytest.fixture(name="data_dir")
+def fixture_data_dir(tmp_path, monkeypatch):
+    """
+    A data dir with a few N-Triples vocabularies, and a config dir for the Skosmos config.
+    :param tmp_path:
+    :param monkeypatch:
+    :return:
+    """
+    data_dir = tmp_path / "data"
+    config_dir = tmp_path / "config"
+    data_dir.mkdir()
+    config_dir.mkdir()
+    shutil.copy("config-docker-compose.ttl", data_dir / "config.ttl")
+    for name in VOCABULARIES:
+        (data_dir / f"{name}.config").write_text(
+            f":{name} a skosmos:Vocabulary ; skosmos:sparqlGraph <http://example.com/{name}> .\n")
+        (data_dir / f"{name}.nt").write_text(
+            f"<http://example.com/{name}/c> <http://example.com/p> \"{name}\" .\n")
+        (data_dir / f"{name}.yaml").write_text(
+            f"config:\n  type: file\n  location: {name}.config\n"
+            f"source:\n  type: file\n  location: {name}.nt\n")
+    monkeypatch.setattr(skosmos_config, "CONFIG_DIR", str(config_dir))
+    monkeypatch.setattr(entrypoint, "CONFIG_DIR", str(config_dir))
+    monkeypatch.setenv("DATA", str(data_dir))
+    return data_dir
+
+
+def test_failed_upload_keeps_the_other_vocabularies(store, data_dir, monkeypatch):
+    """
+    A vocabulary the store rejects isn't timestamped, while the others are loaded, and all of
+    them stay in the Skosmos config.
+    :param store:
+    :param data_dir:
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setenv("DATABASE_TYPE", "fuseki")
+    monkeypatch.setenv("SPARQL_ENDPOINT", store.sparql_endpoint("fuseki"))
+    store.rejected_graphs.add("http://example.com/b")
+    entrypoint.main()
+
+    assert sorted(store.state.metadata[TIMESTAMP_PREDICATE]) == [
+        "http://example.com/a", "http://example.com/c"
+    ]
+    config = data_dir.parent / "config" / "config-docker-compose.ttl"
+    for name in VOCABULARIES:
+        assert f"<http://example.com/{name}>" in config.read_text(encoding='utf-8')
+
+
+def test_companion_hierarchy_follows_the_published_graph(store, data_dir, monkeypatch):
+    """
+    The companion graph with the hierarchy is only replaced once the staged graph was moved
+    into place, so a failing MOVE leaves both as they were.
+    :param store:
+    :param data_dir:
+    :param monkeypatch:
+    :return:
+    """
+    for name in VOCABULARIES:
+        (data_dir / f"{name}.nt").write_text(
+            f"<http://example.com/{name}/c> <{SKOS}broader> <http://example.com/{name}/b> .\n")
+    monkeypatch.setenv("DATABASE_TYPE", "graphdb")
+    monkeypatch.setenv("SPARQL_ENDPOINT", store.sparql_endpoint("graphdb"))
+    monkeypatch.setenv("STAGING_LOAD", "true")
+    monkeypatch.setenv("MATERIALIZE_HIERARCHY", "true")
+    monkeypatch.setenv("HIERARCHY_GRAPH_SUFFIX", "/hierarchy")
+    store.rejected_graphs.add("http://example.com/b")
+    entrypoint.main()
+
+    assert sorted(store.state.graphs) == [
+        "http://example.com/a", "http://example.com/a/hierarchy",
+        "http://example.com/c", "http://example.com/c/hierarchy",
+    ]
+    assert "http://example.com/b/hierarchy" not in store.state.metadata[TIMESTAMP_PREDICATE]
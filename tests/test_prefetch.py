@@ -0,0 +1,135 @@
+"""
+Tests for prefetching the sources of the next vocabularies into a bounded spool.
+"""
+import io
+import threading
+
+import pytest
+
+from src.database import CHUNK_SIZE
+from src.prefetch import Prefetched, PrefetchSettings, SourcePrefetcher
+
+SOURCES = {
+    key: ''.join(f"<http://example.com/{key}/{i}> <http://example.com/p> \"{i}\" .\n"
+                 for i in range(1000)).encode('utf-8')
+    for key in ["a", "b", "c"]
+}
+
+
+class Fetcher:
+    """
+    Opens the sources (SOURCES by default), keeping track of the fetched and closed ones.
+    """
+
+    def __init__(self):
+        self.sources = SOURCES
+        self.fetched: list[str] = []
+        self.opened: list[io.BytesIO] = []
+        self.called = threading.Semaphore(0)
+
+
+    def __call__(self, key: str) -> Prefetched:
+        """
+        Open a source, see SourcePrefetcher.
+        """
+        self.fetched.append(key)
+        self.called.release()
+        if key not in self.sources:
+            return Prefetched(key, error=FileNotFoundError(key))
+        fp = io.BytesIO(self.sources[key])
+        self.opened.append(fp)
+        return Prefetched(key, ({'type': 'file'}, fp))
+
+
+    def wait(self, count: int, timeout: float = 5) -> bool:
+        """
+        Wait until count sources were fetched (since the last wait).
+        :param count:
+        :param timeout: Seconds to wait for each source.
+        :return: False when the timeout expired.
+        """
+        return all(self.called.acquire(timeout=timeout) for _ in range(count))
+
+
+def test_sources_are_taken_in_order():
+    """
+    The prefetched sources have the contents of the original ones, which are closed.
+    :return:
+    """
+    fetcher = Fetcher()
+    with SourcePrefetcher(PrefetchSettings(depth=2), fetcher) as prefetcher:
+        prefetcher.start(list(SOURCES))
+        for key, content in SOURCES.items():
+            prefetched = prefetcher.take(key)
+            assert prefetched.value == key
+            source_data, fp = prefetched.open_source()
+            assert source_data == {'type': 'file'}
+            with fp:
+                assert fp.read() == content
+        assert prefetcher.limits.used == 0
+    assert fetcher.fetched == list(SOURCES)
+    assert all(fp.closed for fp in fetcher.opened)
+
+
+def test_depth_limits_the_sources_ahead():
+    """
+    No more than depth sources are downloaded before they are taken.
+    :return:
+    """
+    fetcher = Fetcher()
+    with SourcePrefetcher(PrefetchSettings(depth=1), fetcher) as prefetcher:
+        prefetcher.start(list(SOURCES))
+        assert fetcher.wait(1)
+        assert not fetcher.wait(1, 0.2)
+        assert fetcher.fetched == ["a"]
+
+        prefetcher.take("a").open_source()[1].close()
+        assert fetcher.wait(1)
+        assert fetcher.fetched == ["a", "b"]
+
+
+def test_rest_is_read_from_the_source_over_the_budget():
+    """
+    A source larger than the disk budget is spooled up to a line end, the rest is read from the
+    original source.
+    :return:
+    """
+    content = SOURCES["a"] * (2 * CHUNK_SIZE // len(SOURCES["a"]))
+    fetcher = Fetcher()
+    fetcher.sources = {"large": content}
+    with SourcePrefetcher(PrefetchSettings(depth=1, disk_budget=1000), fetcher) as prefetcher:
+        prefetcher.start(["large"])
+        _, fp = prefetcher.take("large").open_source()
+        with fp:
+            assert CHUNK_SIZE <= prefetcher.limits.used < len(content)
+            assert list(fp) == content.splitlines(keepends=True)
+        assert prefetcher.limits.used == 0
+
+
+def test_errors_are_raised_when_taken():
+    """
+    A source which failed to open raises its error when it is used.
+    :return:
+    """
+    with SourcePrefetcher(PrefetchSettings(depth=1), Fetcher()) as prefetcher:
+        prefetcher.start(["missing"])
+        prefetched = prefetcher.take("missing")
+        assert prefetched.value == "missing"
+        with pytest.raises(FileNotFoundError):
+            prefetched.open_source()
+
+
+def test_close_removes_sources_which_werent_taken():
+    """
+    Closing the prefetcher closes the sources waiting in the spool, and stops prefetching.
+    :return:
+    """
+    fetcher = Fetcher()
+    prefetcher = SourcePrefetcher(PrefetchSettings(depth=1), fetcher)
+    prefetcher.start(list(SOURCES))
+    assert fetcher.wait(1)
+    prefetcher.close()
+
+    assert fetcher.fetched == ["a"]
+    assert all(fp.closed for fp in fetcher.opened)
+    assert prefetcher.limits.used == 0
@@ -0,0 +1,178 @@
+"""
+Tests for the fan-out of writes to read replicas and their catch-up, against stand-in triple stores.
+"""
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.store import StandInStore, StoreState
+from src.database import TIMESTAMP_PREDICATE
+from src.database_connectors.fuseki import create_connector
+from src.exceptions import VocabularyLoadingException
+from src.metrics import RunMetrics
+from src.replicas import ReplicatedDatabase, StreamFanOut
+
+GRAPH = "http://example.com/graph"
+SOURCE = ''.join(f"<http://example.com/{i}> <http://example.com/p> \"{i}\" .\n"
+                 for i in range(10)).encode('utf-8')
+
+
+@pytest.fixture(name="replica")
+def fixture_replica():
+    """
+    A second running stand-in triple store, for the replica.
+    :return:
+    """
+    replica = StandInStore(StoreState())
+    replica.start()
+    yield replica
+    replica.stop()
+
+
+@pytest.fixture(name="database")
+def fixture_database(store, replica):
+    """
+    A replicated database, with the stand-in store as primary and a replica.
+    :param store:
+    :param replica:
+    :return:
+    """
+    database = ReplicatedDatabase(create_connector(store.sparql_endpoint("fuseki")),
+                                  [create_connector(replica.sparql_endpoint("fuseki"))])
+    database.setup()
+    return database
+
+
+def failing_blocks():
+    """
+    A source which fails after its first block.
+    :return:
+    """
+    yield b"first"
+    raise OSError("Connection reset")
+
+
+def test_fan_out_hands_every_block_to_all_consumers():
+    """
+    Every consumer gets all blocks, also when another one stops reading.
+    :return:
+    """
+    blocks = [str(i).encode('utf-8') for i in range(50)]
+    fan_out = StreamFanOut(3)
+
+    def stop_early():
+        next(fan_out.consumer(2))
+        fan_out.finished(2)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(lambda index: list(fan_out.consumer(index)), index)
+                   for index in range(2)]
+        stopped = executor.submit(stop_early)
+        fan_out.pump(blocks)
+    assert [future.result() for future in futures] == [blocks, blocks]
+    stopped.result()
+
+
+def test_fan_out_failing_source():
+    """
+    The consumers fail when reading the source fails.
+    :return:
+    """
+    fan_out = StreamFanOut(2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(lambda index: list(fan_out.consumer(index)), index)
+                   for index in range(2)]
+        with pytest.raises(OSError):
+            fan_out.pump(failing_blocks())
+    for future in futures:
+        with pytest.raises(VocabularyLoadingException):
+            future.result()
+
+
+def test_writes_go_to_all_stores(store, replica, database):
+    """
+    A vocabulary and its timestamp are sent to the primary and the replica, reading the source once.
+    :param store:
+    :param replica:
+    :param database:
+    :return:
+    """
+    source = io.BytesIO(SOURCE)
+    assert database.add_vocabulary(source, GRAPH, "nt") < 400
+    database.set_timestamp(GRAPH, 1000)
+
+    assert source.tell() == len(SOURCE)
+    for stand_in in [store, replica]:
+        assert stand_in.state.graphs == {GRAPH: 10}
+        assert stand_in.state.metadata[TIMESTAMP_PREDICATE] == {GRAPH: "1000"}
+    assert database.get_loaded_vocabs() == {GRAPH: 1000}
+
+
+def test_failing_replica_is_left_out(store, replica, database):
+    """
+    A replica which fails a write doesn't receive the next writes, the primary is still loaded.
+    :param store:
+    :param replica:
+    :param database:
+    :return:
+    """
+    replica.rejected_graphs.add(GRAPH)
+    assert database.add_vocabulary(io.BytesIO(SOURCE), GRAPH, "nt") < 400
+    assert not database.active
+
+    database.add_vocabulary(io.BytesIO(SOURCE), "http://example.com/other", "nt")
+    assert store.state.graphs == {GRAPH: 10, "http://example.com/other": 10}
+    assert not replica.state.graphs
+
+
+def test_failing_primary_raises(store, database):
+    """
+    The errors of the primary are raised, the replica stays active.
+    :param store:
+    :param database:
+    :return:
+    """
+    store.rejected_graphs.add(GRAPH)
+    assert database.add_vocabulary(io.BytesIO(SOURCE), GRAPH, "nt") >= 400
+    assert database.active == database.replicas
+
+
+def test_sync_copies_the_graphs_behind(store, replica, database):
+    """
+    A replica which missed writes gets the graphs it is behind on, with their metadata.
+    :param store:
+    :param replica:
+    :param database:
+    :return:
+    """
+    replica.rejected_graphs.add(GRAPH)
+    database.add_vocabulary(io.BytesIO(SOURCE), GRAPH, "nt")
+    database.set_timestamp(GRAPH, 1000)
+    assert not database.active
+    replica.rejected_graphs.clear()
+
+    database.sync(RunMetrics())
+
+    assert database.active == database.replicas
+    assert replica.state.graphs == {GRAPH: 10}
+    assert replica.state.metadata[TIMESTAMP_PREDICATE] == {GRAPH: "1000"}
+    assert store.state.reset_statistics()['requests'].get('download') == 1
+
+    # Nothing is copied when the replica is up to date
+    database.sync(RunMetrics())
+    assert 'download' not in store.state.reset_statistics()['requests']
+
+
+def test_sync_leaves_out_unavailable_replicas(store):
+    """
+    A replica which isn't available is left out of the run.
+    :param store:
+    :return:
+    """
+    unavailable = StandInStore(StoreState())
+    unavailable.server_close()
+    database = ReplicatedDatabase(create_connector(store.sparql_endpoint("fuseki")),
+                                  [create_connector(unavailable.sparql_endpoint("fuseki"))])
+    database.sync(RunMetrics())
+    assert not database.active